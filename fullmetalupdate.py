@@ -6,9 +6,16 @@ from pathlib import Path
 import logging
 import argparse
 import asyncio
-import aiohttp
 from distutils.util import strtobool
-from fullmetalupdate.fullmetalupdate_ddi_client import FullMetalUpdateDDIClient
+from fullmetalupdate.fullmetalupdate_ddi_client import FullMetalUpdateDDIClient, DIR_NOTIFY_SOCKET
+from fullmetalupdate.trigger import TriggerServer
+from fullmetalupdate.metrics import MetricsServer, METRICS, http_trace_config, transport_collector
+from fullmetalupdate.peers import PeerServer, PeerDiscovery
+from fullmetalupdate.shaping import BandwidthProfile, ShapingProxy, TokenBucket
+from fullmetalupdate.bootenv import FileEnv
+from fullmetalupdate.maintenance import MaintenanceWindow
+from rauc_hawkbit.poll_scheduler import PollScheduler
+from rauc_hawkbit.ddi.transport import HTTPTransport, TransportProfile
 
 
 async def main():
@@ -61,6 +68,40 @@ async def main():
     AUTH_TOKEN = config.get('client', 'hawkbit_auth_token')
     ATTRIBUTES = {'FullMetalUpdate': config.get('client', 'hawkbit_target_name')}
 
+    POLLING = {'jitter': config.getfloat('client', 'polling_jitter', fallback=0.1),
+               'backoff_base': config.getfloat('client', 'polling_backoff_base', fallback=10),
+               'backoff_max': config.getfloat('client', 'polling_backoff_max', fallback=3600)}
+
+    # gateway mode: each [target:<controller id>] section registers an additional
+    # HawkBit target served by this process
+    GATEWAY_TARGETS = []
+    for section in config.sections():
+        if section.startswith('target:'):
+            GATEWAY_TARGETS.append((section[len('target:'):],
+                                    config.get(section, 'hawkbit_tenant_id', fallback=TENANT_ID),
+                                    config.get(section, 'hawkbit_auth_token')))
+
+    TRANSPORT_PROFILE = TransportProfile.from_config(config)
+
+    # 'unix:<path>' or '<host>:<port>', empty to disable
+    METRICS_ADDRESS = config.get('client', 'metrics_address', fallback='')
+
+    # file holding the boot environment instead of the u-boot one (development hosts), empty for u-boot
+    BOOTENV_FILE = config.get('client', 'bootenv_file', fallback='')
+
+    # daily window the reboots are deferred to, e.g. '01:00-03:00' (local time), empty to reboot at once
+    MAINTENANCE_WINDOW = config.get('client', 'maintenance_window', fallback='')
+
+    # fastest way to boot a staged OS: 'soft', 'kexec' or 'full', see Rebooter
+    REBOOT_STRATEGY = config.get('client', 'reboot_strategy', fallback='full')
+
+    # download bandwidth cap by time of day, e.g. '08:00-18:00=256,*=0' (kB/s, 0 unlimited), empty for none
+    BANDWIDTH_PROFILE = config.get('client', 'bandwidth_profile', fallback='')
+    RATE_LIMITER = TokenBucket(BandwidthProfile(BANDWIDTH_PROFILE)) if BANDWIDTH_PROFILE else None
+
+    TRIGGER_SOCKET = config.get('client', 'trigger_socket',
+                                fallback=DIR_NOTIFY_SOCKET + 'fullmetalupdate_trigger.sock')
+
     if strtobool(config.get('ostree', 'ostree_ssl')):
         url_type = 'https://'
     else:
@@ -68,7 +109,37 @@ async def main():
 
     OSTREE_REMOTE_ATTRIBUTES = {'name': config.get('ostree', 'ostree_name_remote'),
                                 'gpg-verify': strtobool(config.get('ostree', 'ostree_gpg-verify')),
-                                'url': url_type + local_domain_name + ":" + config.get('ostree', 'ostree_url_port')}
+                                'url': url_type + local_domain_name + ":" + config.get('ostree', 'ostree_url_port'),
+                                'stall-timeout': config.getfloat('ostree', 'ostree_stall_timeout', fallback=120),
+                                'pull-retries': config.getint('ostree', 'ostree_pull_retries', fallback=3),
+                                'retry-delay': config.getfloat('ostree', 'ostree_retry_delay', fallback=10),
+                                # comma separated mirrors, or 'mirrorlist=<url>' entries
+                                'mirrors': [m.strip() for m in config.get('ostree', 'ostree_mirrors', fallback='').split(',')
+                                            if m.strip()],
+                                'peers': [p.strip() for p in config.get('ostree', 'ostree_peers', fallback='').split(',')
+                                          if p.strip()],
+                                # shared token required by the peers, and sent to them
+                                'peer-token': config.get('ostree', 'ostree_peer_token', fallback=''),
+                                'keep-revisions': config.getint('ostree', 'ostree_keep_revisions', fallback=1),
+                                # 0 disables the budget
+                                'disk-budget': config.getint('ostree', 'ostree_disk_budget_mb', fallback=0) * 1024 * 1024,
+                                # space left free by a deployment on /apps and /ostree, checked before pulling it
+                                'free-margin': config.getint('ostree', 'ostree_free_margin_mb', fallback=32) * 1024 * 1024,
+                                'prune-interval': config.getfloat('ostree', 'ostree_prune_interval', fallback=24 * 3600),
+                                # 0 disables the background scrub
+                                'scrub-rate': config.getint('ostree', 'ostree_scrub_rate_kb', fallback=1024) * 1024,
+                                'scrub-step': config.getfloat('ostree', 'ostree_scrub_step', fallback=5),
+                                # priority of the thread doing the pulls, checkouts and chowns
+                                'worker-nice': config.getint('ostree', 'ostree_worker_nice', fallback=0),
+                                # 'idle', 'best-effort[:<0-7>]' or 'realtime[:<0-7>]', empty for the default
+                                'worker-ionice': config.get('ostree', 'ostree_worker_ionice', fallback='')}
+
+    # peer mode: serve the local OSTree repositories (OS and containers, unencrypted) to the LAN on this port, 0 to
+    # disable. The address to listen on must be given, the allowed networks and the token restrict the clients.
+    PEER_PORT = config.getint('ostree', 'ostree_peer_port', fallback=0)
+    PEER_ADDRESS = config.get('ostree', 'ostree_peer_address', fallback='')
+    PEER_ALLOW = [n.strip() for n in config.get('ostree', 'ostree_peer_allow', fallback='').split(',') if n.strip()]
+    PEER_DISCOVERY = config.getboolean('ostree', 'ostree_peer_discovery', fallback=False)
 
     if args.debug:
         LOG_LEVEL = logging.DEBUG
@@ -77,9 +148,16 @@ async def main():
                         format='%(asctime)s %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-    async with aiohttp.ClientSession() as session:
+    async with HTTPTransport(TRANSPORT_PROFILE, [http_trace_config()]) as transport:
+        METRICS.add_collector(transport_collector(transport))
+        session = transport.session
         client = FullMetalUpdateDDIClient(session, HOST, SSL, TENANT_ID, TARGET_NAME,
-                                          AUTH_TOKEN, ATTRIBUTES)
+                                          AUTH_TOKEN, ATTRIBUTES, PollScheduler(**POLLING),
+                                          bulk_session=transport.bulk_session,
+                                          bootenv=FileEnv(BOOTENV_FILE) if BOOTENV_FILE else None,
+                                          maintenance_window=MaintenanceWindow(MAINTENANCE_WINDOW) if MAINTENANCE_WINDOW
+                                          else None,
+                                          reboot_strategy=REBOOT_STRATEGY, rate_limiter=RATE_LIMITER)
 
         if not client.init_checkout_existing_containers():
             client.logger.info("There is no containers pre-installed on the target")
@@ -87,7 +165,54 @@ async def main():
         if not client.init_ostree_remotes(OSTREE_REMOTE_ATTRIBUTES):
             client.logger.error("Cannot initialize OSTree remote from config file '{}'".format(cfg_path.name))
         else:
-            await client.start_polling()
+            shaper = None
+            if RATE_LIMITER is not None:
+                shaper = ShapingProxy(RATE_LIMITER, transport.bulk_session)
+                await shaper.start()
+                client.shaper = shaper
+            # the secondary targets share the HTTP session and the OSTree repositories of the primary one
+            clients = [client]
+            for controller_id, tenant_id, auth_token in GATEWAY_TARGETS:
+                client.logger.info("Gateway mode: serving target {}".format(controller_id))
+                clients.append(FullMetalUpdateDDIClient(session, HOST, SSL, tenant_id, controller_id,
+                                                        auth_token, {'FullMetalUpdate': controller_id},
+                                                        PollScheduler(**POLLING), parent=client,
+                                                        bulk_session=transport.bulk_session,
+                                                        rate_limiter=RATE_LIMITER))
+
+            trigger = None
+            if TRIGGER_SOCKET:
+                trigger = TriggerServer(TRIGGER_SOCKET, {c.ddi.controller_id: c.scheduler for c in clients})
+                await trigger.start()
+            metrics = None
+            if METRICS_ADDRESS:
+                metrics = MetricsServer(METRICS_ADDRESS)
+                await metrics.start()
+            peer_server = None
+            discovery = None
+            if PEER_PORT and not PEER_ADDRESS:
+                client.logger.error("Peer mode disabled: ostree_peer_address is not set")
+            elif PEER_PORT:
+                peer_server = PeerServer(PEER_ADDRESS, PEER_PORT,
+                                         {'containers': client.repo_containers, 'os': client.repo_os},
+                                         client.executor, PEER_ALLOW, OSTREE_REMOTE_ATTRIBUTES['peer-token'])
+                await peer_server.start()
+                if PEER_DISCOVERY:
+                    discovery = PeerDiscovery(PEER_PORT, client.peers)
+                    await discovery.start()
+            try:
+                await asyncio.gather(*[c.start_polling() for c in clients])
+            finally:
+                if trigger is not None:
+                    trigger.close()
+                if metrics is not None:
+                    await metrics.close()
+                if discovery is not None:
+                    discovery.close()
+                if peer_server is not None:
+                    await peer_server.close()
+                if shaper is not None:
+                    await shaper.close()
 
 if __name__ == '__main__':
     # create event loop, open aiohttp client session and start polling
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from threading import RLock
+
+from fullmetalupdate.metrics import METRICS
+
+
+class BootEnvError(Exception):
+    pass
+
+
+def parse_env(text):
+    """ Parse an environment in the fw_printenv format, one 'name=value' per line. """
+    values = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition('=')
+        if sep:
+            values[name] = value
+    return values
+
+
+class BootEnv(object):
+    """ Bootloader environment, read once and written by transactions.
+
+    The variables are read on first use and cached. The changes are buffered until commit(), which writes them all
+    at once and drops those which do not change the stored value, so that a variable already set costs no write to
+    the flash. Outside a transaction, set() commits immediately; inside one, the changes are written when it ends,
+    e.g. the trial boot armed before a soft-reboot or a kexec (see Rebooter.boot_unit()):
+
+        with bootenv.transaction():
+            bootenv.set('success', '0')
+            bootenv.set('init_var', '1')
+
+    Subclasses provide load() and store().
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('fullmetalupdate_bootenv')
+        self.values = None
+        self.pending = {}
+        self.depth = 0
+        self.lock = RLock()
+
+    def load(self):
+        """ Returns the environment as a dictionnary. """
+        raise NotImplementedError
+
+    def store(self, changes):
+        """ Write changes to the environment in one operation.
+
+        :param dictionnary changes: New value of each changed variable, None to delete it.
+        :raises BootEnvError: The environment could not be written.
+        """
+        raise NotImplementedError
+
+    def read(self):
+        if self.values is None:
+            self.values = self.load()
+        return self.values
+
+    def get(self, name, default=None):
+        """ Returns the value of a variable, including the changes not committed yet. """
+        with self.lock:
+            if name in self.pending:
+                value = self.pending[name]
+            else:
+                value = self.read().get(name)
+            return default if value is None else value
+
+    def set(self, name, value):
+        """ Set a variable, None deletes it. """
+        if value is not None:
+            value = str(value)
+            if '\n' in value:
+                raise BootEnvError("Value of {} holds a new line".format(name))
+        with self.lock:
+            self.pending[name] = value
+            if not self.depth:
+                self.commit()
+
+    def unset(self, name):
+        self.set(name, None)
+
+    @contextmanager
+    def transaction(self):
+        """ Group the changes made in the block into one write; they are dropped if the block raises. """
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self.depth == 1:
+                    self.pending = {}
+                raise
+            finally:
+                self.depth -= 1
+            if not self.depth:
+                self.commit()
+
+    def commit(self):
+        """
+        Write the pending changes.
+
+        :returns: True if the environment was written, False if there was nothing to change.
+        :raises BootEnvError: The environment could not be written, the cache is reloaded on next access.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            values = self.read()
+            changes = {name: value for name, value in pending.items() if values.get(name) != value}
+            if not changes:
+                return False
+            try:
+                self.store(changes)
+            except BootEnvError:
+                self.values = None
+                raise
+            for name, value in changes.items():
+                if value is None:
+                    values.pop(name, None)
+                else:
+                    values[name] = value
+            METRICS.inc('fmu_bootenv_writes_total')
+            self.logger.info("Boot environment updated: {}".format(
+                ', '.join(name if value is None else '{}={}'.format(name, value)
+                          for name, value in sorted(changes.items()))))
+            return True
+
+
+class UBootEnv(BootEnv):
+    """ U-Boot environment, through the u-boot-fw-utils: fw_printenv reads it once, and fw_setenv -s applies all the
+    changes of a commit with a single write of the (redundant) environment.
+
+    :param string printenv: Command printing the environment.
+    :param string setenv: Command writing the environment.
+    """
+
+    def __init__(self, printenv='fw_printenv', setenv='fw_setenv'):
+        super(UBootEnv, self).__init__()
+        self.printenv = printenv
+        self.setenv = setenv
+
+    def load(self):
+        try:
+            result = subprocess.run([self.printenv], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                                    universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise BootEnvError("Reading the u-boot environment failed ({})".format(e))
+        return parse_env(result.stdout)
+
+    def store(self, changes):
+        # fw_setenv script: 'name value' sets a variable, 'name' alone deletes it
+        with tempfile.NamedTemporaryFile('w', prefix='fw_setenv-', suffix='.script') as script:
+            for name, value in sorted(changes.items()):
+                script.write(name + '\n' if value is None else '{} {}\n'.format(name, value))
+            script.flush()
+            try:
+                subprocess.run([self.setenv, '-s', script.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               check=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise BootEnvError("Writing the u-boot environment failed ({})".format(e))
+
+
+class FileEnv(BootEnv):
+    """ Boot environment stored in a text file in the fw_printenv format, replaced atomically on each commit.
+    Stand-in for the u-boot environment on development hosts, and for bootloaders reading their environment from a
+    file.
+
+    :param string path: Environment file, created on first commit.
+    """
+
+    def __init__(self, path):
+        super(FileEnv, self).__init__()
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return parse_env(f.read())
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            raise BootEnvError("Reading {} failed ({})".format(self.path, e))
+
+    def store(self, changes):
+        values = dict(self.read())
+        for name, value in changes.items():
+            if value is None:
+                values.pop(name, None)
+            else:
+                values[name] = value
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(''.join('{}={}\n'.format(name, value) for name, value in sorted(values.items())))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            raise BootEnvError("Writing {} failed ({})".format(self.path, e))
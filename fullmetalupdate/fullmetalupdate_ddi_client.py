@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
 import os
 import os.path
-import re
 import logging
 import json
 from threading import Lock, Thread
 import socket as s
-import subprocess
 import asyncio
+import functools
+import time
 import gi
 
-from fullmetalupdate.updater import AsyncUpdater
+gi.require_version("OSTree", "1.0")
+from gi.repository import GLib
+
+from fullmetalupdate.updater import PATH_REPO_APPS, PATH_REPO_OS, AsyncUpdater, PullRetry
+from fullmetalupdate.journal import (PATH_JOURNALS, STEP_CHECKED_OUT, STEP_PULLED, STEP_ROLLED_BACK, STEP_STAGED,
+                                     STEP_STARTED, STEP_UNIT_INSTALLED, STEP_VERDICT, DeploymentJournal)
+from fullmetalupdate.metrics import METRICS
+from fullmetalupdate.ordering import order_chunks, order_restarts
+from fullmetalupdate.plan import FREE_MARGIN, UpdatePlan
+from fullmetalupdate.progress import ProgressReporter
+from fullmetalupdate.reboot import Rebooter
+from fullmetalupdate.tracing import Tracer
 from rauc_hawkbit.ddi.client import DDIClient, APIError
 from rauc_hawkbit.ddi.client import (
     ConfigStatusExecution, ConfigStatusResult)
@@ -20,10 +30,17 @@ from rauc_hawkbit.ddi.deployment_base import (
     DeploymentStatusExecution, DeploymentStatusResult)
 from rauc_hawkbit.ddi.cancel_action import (
     CancelStatusExecution, CancelStatusResult)
+from rauc_hawkbit.ddi.model import (
+    DeploymentCache, DocumentParseError, parse_base, parse_cancel)
+from rauc_hawkbit.poll_scheduler import PollScheduler
 from aiohttp.client_exceptions import ClientOSError, ClientResponseError
 
 PATH_REBOOT_DATA = '/var/local/fullmetalupdate/reboot_data.json'
 DIR_NOTIFY_SOCKET = '/tmp/fullmetalupdate/'
+# default delay between two prunes of an idle target, in seconds
+PRUNE_INTERVAL = 24 * 3600
+# chunk metadata holding integers
+INT_METADATA = ('autostart', 'autoremove', 'notify', 'timeout', 'bluegreen', 'priority')
 
 
 class FullMetalUpdateDDIClient(AsyncUpdater):
@@ -33,55 +50,158 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
     :param logging logger: Logger used to print information regarding the update proceedings or to report errors.
     :param DDIClient ddi: Client enabling easy GET / POST / PUT request to Hawkbit Server.
     :param int action_id: Unique identifier of an Hawkbit update.
-    :param list feedbackThreads: List of feedback threads to make accesses easier.
+    :param dictionnary feedbackThreads: Feedback threads of the notify containers being updated, by container name.
+    :param DeploymentJournal journal: Steps done by the deployment in progress.
     :param dictionnary feedbackResults: Each feedback thread is associated with a status_update and a message, which describes if
         the starting process of the associated container went well or not.
         feedbackResults =  {container-sd-notify : {status_result : ... , msg : ...}}
     :param Lock mutexResults: Mutex that protects feedbackResults from concurrent accesses (accesses from main thread and accesses
         from feedback threads). 
+    :param PollScheduler scheduler: Computes the delays between two polls, with jitter and backoff on errors.
+    :param DeploymentCache deployments: Parsed deployments, downloaded once per action.
+    :param float last_prune: Monotonic time of the last prune of the containers repository.
+    :param string primary_target: Controller id of the primary target of the gateway, owning the containers
+        installed beforehand (see AsyncUpdater.claim_containers).
     """
 
-    def __init__(self, session, host, ssl, tenant_id, target_name, auth_token, attributes):
+    def __init__(self, session, host, ssl, tenant_id, target_name, auth_token, attributes, poll_scheduler=None,
+                 parent=None, bulk_session=None, bootenv=None, maintenance_window=None, reboot_strategy='full',
+                 rate_limiter=None):
         """ Constructor of FullMetalUpdateDDIClient Class.
+
+        :param FullMetalUpdateDDIClient parent: Primary client of a gateway, see AsyncUpdater.
+        :param aiohttp.ClientSession bulk_session: Session dedicated to artifact downloads, see HTTPTransport.
+        :param BootEnv bootenv: Bootloader environment of the primary client, see AsyncUpdater.
+        :param MaintenanceWindow maintenance_window: Window the reboots are deferred to, None to reboot at once.
+        :param string reboot_strategy: Fastest way to boot a staged OS, see Rebooter.
+        :param TokenBucket rate_limiter: Bandwidth cap of the artifact downloads, shared with the OSTree pulls.
         """
-        super(FullMetalUpdateDDIClient, self).__init__()
+        super(FullMetalUpdateDDIClient, self).__init__(parent, bootenv)
 
         self.attributes = attributes
 
         self.logger = logging.getLogger('fullmetalupdate_hawkbit')
-        self.ddi = DDIClient(session, host, ssl, auth_token, tenant_id, target_name)
+        self.ddi = DDIClient(session, host, ssl, auth_token, tenant_id, target_name, bulk_session=bulk_session,
+                             rate_limiter=rate_limiter)
+        self.primary_target = parent.ddi.controller_id if parent is not None else target_name
         self.action_id = None
-        self.feedbackThreads = []
+        self.feedbackThreads = {}
         self.feedbackResults = None
+        self.journal = None
         self.mutexResults = Lock()
+        self.scheduler = poll_scheduler or PollScheduler()
+        self.deployments = DeploymentCache()
+        self.last_prune = time.monotonic()
+        self.maintenance_window = maintenance_window
+        self.reboot_pending = False
+        self.rebooter = Rebooter(self, reboot_strategy)
+        # actions being downloaded ahead of their installation, and those already downloaded
+        self.prefetching = {}
+        self.prefetched = set()
 
         os.makedirs(os.path.dirname(PATH_REBOOT_DATA), exist_ok=True)
         os.makedirs(DIR_NOTIFY_SOCKET, exist_ok=True)
 
-    async def start_polling(self, wait_on_error=60):
+    async def start_polling(self):
         """ 
         Wrapper around self.poll_base_resource() for exception handling.
-        
-        :param int wait_on_error: Timeout before retry on polling failled
+
+        The delay before a retry is given by self.scheduler: it grows exponentially with the number of consecutive
+        failures and honors the Retry-After sent by the server.
         """
 
         while True:
+            error = None
             try:
                 await self.poll_base_resource()
             except asyncio.CancelledError:
                 self.logger.info('Polling cancelled')
                 break
-            except asyncio.TimeoutError:
+            except asyncio.TimeoutError as e:
                 self.logger.warning('Polling failed due to TimeoutError')
+                error = e
             except (APIError, TimeoutError, ClientOSError, ClientResponseError) as e:
                 # log error and start all over again
                 self.logger.warning('Polling failed with a temporary error: {}'.format(e))
-            except Exception:
+                error = e
+            except Exception as e:
                 self.logger.exception('Polling failed with an unexpected exception:')
+                error = e
             self.action_id = None
-            self.logger.info('Retry will happen in {} seconds'.format(
+            self.tracer.finish_trace()
+            wait_on_error = self.scheduler.on_error(error)
+            self.logger.info('Retry will happen in {:.0f} seconds'.format(
                 wait_on_error))
-            await asyncio.sleep(wait_on_error)
+            await self.scheduler.wait(wait_on_error)
+
+    async def run_blocking(self, func, *args):
+        """
+        Run a blocking update step (OSTree, systemd) in self.executor, so that the event loop
+        keeps sending feedbacks and polling the other targets meanwhile. The step is attached to the current span.
+
+        :param callable func: Blocking function.
+        :returns: Result of func(*args).
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.tracer.wrap(functools.partial(func, *args)))
+
+    async def pull(self, is_container, rev, name=None, progress_callback=None):
+        """
+        Pull a revision in the worker, one attempt per step (see AsyncUpdater.pull_ostree_ref()): the delay before a
+        retry is awaited on the event loop, so that the worker runs the steps of the other targets meanwhile. The
+        update steps pulling the revision afterwards find it complete in the repository.
+
+        :param boolean is_container: - True to pull a container image
+                                     - False to pull an OS image
+        :param string rev: Commit revision.
+        :param string name: Name of the container.
+        :param callable progress_callback: See AsyncUpdater.pull_ostree_ref().
+        :returns: - True if the revision is in the repository
+                  - False otherwise
+        """
+        attempt = 1
+        try:
+            if is_container:
+                await self.run_blocking(self.init_container_remote, name)
+            while True:
+                try:
+                    await self.run_blocking(self.pull_ostree_ref, is_container, rev, name, progress_callback, attempt)
+                    return True
+                except PullRetry as e:
+                    self.logger.warning("Retrying the pull of {} in {}s".format(name or 'the OS', e.delay))
+                    await asyncio.sleep(e.delay)
+                    attempt += 1
+        except Exception as e:
+            self.logger.error("Pulling {} failed ({})".format(name or 'the OS', e))
+            return False
+
+    async def prune(self):
+        """
+        Prune the containers repository in the worker thread, see AsyncUpdater.prune_containers_repo(). A failed prune
+        is logged and does not affect the deployment.
+        """
+        self.last_prune = time.monotonic()
+        try:
+            reclaimed = await self.run_blocking(self.prune_containers_repo)
+            self.logger.info("Pruning reclaimed {} bytes".format(reclaimed))
+        except Exception as e:
+            self.logger.error("Pruning the containers repository failed ({})".format(e))
+
+    async def scrub(self):
+        """
+        Run a step of the background scrub in the worker thread, then the repair of the corrupt objects it found if
+        any, as a separate job, and report its results to HawkBit as configData attributes when they changed.
+        """
+        try:
+            changed = await self.run_blocking(self.scrubber.step)
+            if self.scrubber.repair_pending():
+                changed |= await self.run_blocking(self.scrubber.repair)
+        except Exception as e:
+            self.logger.error("Scrubbing the containers repository failed ({})".format(e))
+            return
+        if changed:
+            self.attributes.update(self.scrubber.attributes())
+            await self.identify()
 
     async def identify(self):
         """
@@ -100,16 +220,11 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
 
         TODO : Implement Hawkbit Update cancelation (this method does not seem to do what it is meant to do)
         
-        :param dictionnary base: Dictionnary storing information about a Hawkbit update.
+        :param BaseResource base: Parsed base poll resource.
         """
         self.logger.info('Received cancelation request')
-        # retrieve action id from URL
-        deployment = base['_links']['cancelAction']['href']
-        match = re.search('/cancelAction/(.+)$', deployment)
-        action_id, = match.groups()
         # retrieve stop_id
-        stop_info = await self.ddi.cancelAction[action_id]()
-        stop_id = stop_info['cancelAction']['stopId']
+        stop_id = parse_cancel(await self.ddi.cancelAction[base.cancel_action]())
         # Reject cancel request
         self.logger.info('Rejecting cancelation request')
         await self.ddi.cancelAction[stop_id].feedback(
@@ -121,33 +236,56 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
         """
         This method performs a Hawkbit update in several steps :
             - Retrieves information about the Hawkbit update based on base dictionnary ;
-            - Notifies Hawkbit server about the appropriate start of the update ;
+            - Only downloads it in the background when its installation is not allowed yet (download only action,
+              maintenance window unavailable), see prefetch() ;
+            - Refuses the containers owned by another target of the gateway (see AsyncUpdater.claim_containers) ;
+            - Estimates the objects and bytes to pull (see plan_deployment) and fails at once if the update does not fit
+              on the disk ;
+            - Notifies Hawkbit server about the appropriate start of the update, with the estimate ;
+            - Opens the journal of the update, so that an update interrupted by a crash or a power loss resumes from
+              the steps already done (see DeploymentJournal) ;
             - All chunks are then parsed and processed, ie 
                 1) OS chunks cause a system update (see update_system method) and a system reboot ;
                 2) Apps chunks cause apps updates (see update_container method). An app / container that implements the notify feature of systemd is 
                     associated with a feedback thread, which monitors its execution and feedbacks the FMU client if the app succesfully started or not;
+                   Along with an OS update, the apps are only checked out aside and applied at the reboot (see AsyncUpdater.stage_container),
+                    so that they restart once, into the new OS ;
             - Systemd dependency tree is regenerated in order to take into account every change in service files (new service files or updated
                 service files), including new dependencies, changes in startup scripts, etc ;
             - Containers are then restarted ;
             - Finally, Hawkbit server is notified with the result of the update (failure or success) : the details (exit code, name, etc) about 
                 which app failed to start is given.
 
-        :param dictionnary base: Dictionnary storing information about a Hawkbit update.
+        :param BaseResource base: Parsed base poll resource.
         """
         
         if self.action_id is not None:
             self.logger.info('Deployment is already in progress')
             return
 
-        # retrieve action id and resource parameter from URL
-        deployment = base['_links']['deploymentBase']['href']
-        match = re.search('/deploymentBase/(.+)\?c=(.+)$', deployment)
-        action_id, resource = match.groups()
-        # fetch deployment information
-        deploy_info = await self.ddi.deploymentBase[action_id](resource)
+        action_id = base.deployment_action
+        # fetch deployment information, a malformed deployment is refused before anything is installed
+        try:
+            deployment = await self.deployments.fetch(self.ddi, action_id, base.deployment_resource, INT_METADATA)
+        except DocumentParseError as e:
+            msg = 'Malformed deployment: {}'.format(e)
+            await self.ddi.deploymentBase[action_id].feedback(
+                DeploymentStatusExecution.closed, DeploymentStatusResult.failure, [msg])
+            raise
+
+        if deployment.maintenance_window == 'unavailable' or deployment.update == 'skip':
+            self.prefetch(action_id, deployment)
+            return
+        prefetch = self.prefetching.get(action_id)
+        if prefetch is not None:
+            # the installation pulls the same revisions, let the download finish first
+            await prefetch
+        self.prefetched.discard(action_id)
+
         reboot_needed = False
+        os_rev = None
 
-        chunks_qty = len(deploy_info['deployment']['chunks'])
+        chunks_qty = len(deployment.chunks)
 
         if chunks_qty == 0:
             msg = 'Deployment without chunks found. Ignoring'
@@ -157,112 +295,259 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
                 status_execution, status_result, [msg])
             raise APIError(msg)
         else:
+            if not await self.claim_deployment(action_id, deployment):
+                return
+            # a deployment which does not fit on the disk fails before the transfer
+            plan = await self.run_blocking(self.plan_deployment, deployment.chunks)
+            if not plan.fits():
+                msg = "Not enough disk space for the deployment"
+                self.logger.error("{}: {}".format(msg, '; '.join(plan.summary())))
+                await self.ddi.deploymentBase[action_id].feedback(
+                    DeploymentStatusExecution.closed, DeploymentStatusResult.failure, [msg] + plan.summary())
+                return
             msg = "FullMetalUpdate:Proceeding"
-            percentage = {"cnt": 0, "of": chunks_qty}
+            percentage = {"cnt": 0, "of": 100}
             status_execution = DeploymentStatusExecution.proceeding
             status_result = DeploymentStatusResult.none
             await self.ddi.deploymentBase[action_id].feedback(
-                status_execution, status_result, [msg],
+                status_execution, status_result, [msg] + plan.summary(),
                 percentage=percentage)
 
         self.action_id = action_id
+        self.tracer.start_trace('deployment', action_id=action_id, chunks=chunks_qty)
+        self.journal = DeploymentJournal(action_id, os.path.join(PATH_JOURNALS, self.ddi.controller_id))
 
-        seq = ('name', 'version', 'rev', 'part', 'autostart', 'autoremove', 'status_execution', 'status_update', 'status_result', 'notify', 'timeout')
+        seq = ('name', 'version', 'rev', 'part', 'autostart', 'autoremove', 'status_execution', 'status_update', 'status_result', 'notify', 'timeout', 'skipped', 'bluegreen', 'slot', 'staged', 'verdict')
         updates = []
+        self.feedbackThreads = {}
+        reporter = ProgressReporter(self.ddi.deploymentBase[action_id], chunks_qty, asyncio.get_event_loop())
 
-        # Update process
-        for chunk in deploy_info['deployment']['chunks']:
+        # Update process, small and high priority containers first
+        for chunk in order_chunks(deployment.chunks, plan.download_sizes()):
             update = dict.fromkeys(seq)
-            # parse the metadata included in the update
-            for meta in chunk['metadata']:
-                if meta['key'] == 'rev':
-                    update['rev'] = meta['value']
-                if meta['key'] == 'autostart':
-                    update['autostart'] = int(meta['value'])
-                if meta['key'] == 'autoremove':
-                    update['autoremove'] = int(meta['value'])
-                if meta['key'] == 'notify':
-                    update['notify'] = int(meta['value'])
-                if meta['key'] == 'timeout':
-                    update['timeout'] = int(meta['value'])
-            update['name'] = chunk['name']
-            update['version'] = chunk['version']
-            update['part'] = chunk['part']
+            for key in ('rev',) + INT_METADATA:
+                update[key] = chunk.metadata.get(key)
+            update['name'] = chunk.name
+            update['version'] = chunk.version
+            update['part'] = chunk.part
 
             self.logger.info("Updating chunk part: {}".format(update['part']))
-
-            if update['part'] == 'os':
-
-                # checking if we just rebooted and we need to send the feedback in which
-                # case we don't need to pull the update image again
-                [feedback, reboot_data] = self.feedback_for_os_deployment(update['rev'])
-                if feedback:
-                    await self.ddi.deploymentBase[reboot_data['action_id']].feedback(
-                        DeploymentStatusExecution(reboot_data['status_execution']),
-                        DeploymentStatusResult(reboot_data['status_result']),
-                        [reboot_data['msg']])
-                    self.action_id = None
-                    return
-
-                self.logger.info("OS {} v.{} - updating...".format(update['name'], update['version']))
-                update['status_update'] = self.update_system(update['rev'])
+            reporter.chunk_started(update['name'])
+
+            if update['part'] == 'os' and not self.manages_os:
+                msg = "OS {} v.{} Deployment refused: target {} does not manage the OS".format(
+                    update['name'], update['version'], self.ddi.controller_id)
+                self.logger.error(msg)
+                await self.ddi.deploymentBase[self.action_id].feedback(
+                    DeploymentStatusExecution.closed, DeploymentStatusResult.failure, [msg])
+                self.close_journal()
+                self.action_id = None
+                self.tracer.finish_trace()
+                return
+
+            elif update['part'] == 'os':
+
+                if self.step_done(update['name'], update['rev'], STEP_STAGED) and \
+                        await self.run_blocking(self.is_os_staged, update['rev']):
+                    # interrupted before the reboot, the OS is still staged
+                    self.logger.info("OS {} v.{} - already staged".format(update['name'], update['version']))
+                    update['status_update'] = True
+                else:
+                    # checking if we just rebooted and we need to send the feedback in which
+                    # case we don't need to pull the update image again
+                    [feedback, reboot_data] = self.feedback_for_os_deployment(update['rev'])
+                    if feedback:
+                        await self.ddi.deploymentBase[reboot_data['action_id']].feedback(
+                            DeploymentStatusExecution(reboot_data['status_execution']),
+                            DeploymentStatusResult(reboot_data['status_result']),
+                            [reboot_data['msg']])
+                        self.close_journal()
+                        self.action_id = None
+                        self.tracer.finish_trace()
+                        return
+
+                    self.logger.info("OS {} v.{} - updating...".format(update['name'], update['version']))
+                    with self.tracer.span('update_system', rev=update['rev'], version=update['version']):
+                        update['status_update'] = await self.pull(False, update['rev'],
+                                                                  progress_callback=reporter.pull_progress)
+                        if update['status_update']:
+                            update['status_update'] = await self.run_blocking(self.update_system, update['rev'],
+                                                                              reporter.pull_progress)
+                    if update['status_update']:
+                        self.record_step(update['name'], update['rev'], STEP_STAGED)
                 update['status_execution'] = DeploymentStatusExecution.closed
+                reporter.chunk_done(update['name'], update['status_update'])
                 if not update['status_update']:
                     msg = "OS {} v.{} Deployment failed".format(update['name'], update['version'])
                     self.logger.error(msg)
                     update['status_result'] = DeploymentStatusResult.failure
+                    await reporter.flush()
                     await self.ddi.deploymentBase[self.action_id].feedback(
-                        update['status_execution'], update['status_result'], [msg])
+                        update['status_execution'], update['status_result'],
+                        [msg] + Tracer.summary(self.tracer.finish_trace()))
+                    self.close_journal()
+                    self.action_id = None
                     return
                 else:
                     msg = "OS {} v.{} Deployment succeed".format(update['name'], update['version'])
                     self.logger.info(msg)
                     update['status_result'] = DeploymentStatusResult.success
                     reboot_needed = True
+                    os_rev = update['rev']
                     self.write_reboot_data(self.action_id,
                                            update['status_execution'],
                                            update['status_result'],
                                            msg)
 
             elif update['part'] == 'bApp':
-                self.logger.info("App {} v.{} - updating...".format(update['name'], update['version']))
-                update['status_update'] = self.update_container(update['name'], update['rev'], update['autostart'], update['autoremove'], update['notify'], update['timeout'])
+                verdict = self.journal.get(update['name'], update['rev'], STEP_VERDICT)
+                rolled_back = self.journal.get(update['name'], update['rev'], STEP_ROLLED_BACK)
+                if verdict is None and rolled_back is not None:
+                    # the checkout holds the previous revision again, the update failed
+                    verdict = {'status_update': False, 'msg': "App {} v.{} Deployment failed\n {}".format(
+                        update['name'], update['version'], rolled_back)}
+                if verdict is not None and not reboot_needed:
+                    # reported before the interruption, see the feedback process below. The staged containers go
+                    # through their journaled steps again, to be listed for the reboot.
+                    self.logger.info("App {} v.{} - already done".format(update['name'], update['version']))
+                    update['status_update'] = verdict['status_update']
+                    update['verdict'] = verdict['msg']
+                elif update['autoremove'] != 1 and self.is_container_up_to_date(update['name'], update['rev'], update['autostart']):
+                    self.logger.info("App {} v.{} - revision {} already installed, skipping".format(update['name'], update['version'], update['rev']))
+                    update['status_update'] = True
+                    update['skipped'] = True
+                elif reboot_needed:
+                    self.logger.info("App {} v.{} - staging for the reboot...".format(update['name'], update['version']))
+                    update['staged'] = True
+                    with self.tracer.span('update_container', container=update['name'], rev=update['rev'],
+                                          version=update['version'], staged=True):
+                        update['status_update'] = await self.pull(True, update['rev'], update['name'],
+                                                                  reporter.pull_progress)
+                        if update['status_update']:
+                            update['status_update'] = await self.run_blocking(
+                                self.update_container, update['name'], update['rev'], update['autostart'],
+                                update['autoremove'], update['notify'], update['timeout'], reporter.pull_progress,
+                                None, True)
+                else:
+                    self.logger.info("App {} v.{} - updating...".format(update['name'], update['version']))
+                    if update['bluegreen'] == 1 and update['autostart'] == 1 and update['autoremove'] != 1:
+                        # warm start from the idle slot, see handle_slot()
+                        update['slot'] = self.idle_slot(update['name'])
+                    with self.tracer.span('update_container', container=update['name'], rev=update['rev'],
+                                          version=update['version']):
+                        update['status_update'] = await self.pull(True, update['rev'], update['name'],
+                                                                  reporter.pull_progress)
+                        if update['status_update']:
+                            update['status_update'] = await self.run_blocking(
+                                self.update_container, update['name'], update['rev'], update['autostart'],
+                                update['autoremove'], update['notify'], update['timeout'], reporter.pull_progress,
+                                update['slot'])
                 update['status_execution'] = DeploymentStatusExecution.closed
+                reporter.chunk_done(update['name'], update['status_update'])
                 updates.append(update)
 
-        self.systemd.Reload()
+        staged = {update['name']: {'rev': update['rev'], 'autostart': update['autostart'],
+                                   'autoremove': update['autoremove']}
+                  for update in updates if update['staged'] and update['status_update']}
+        if staged:
+            self.write_staged_containers(os_rev, staged)
+
+        await self.run_blocking(self.reload_units)
 
         seq = [update['name'] for update in updates]
         self.mutexResults.acquire()
         self.feedbackResults = dict.fromkeys(seq)
         self.mutexResults.release()
 
-        # Container restart process
-        for update in updates:
-            update['status_update'] &= self.handle_container(update['name'], update['autostart'], update['autoremove'])
+        # Container restart process, unchanged containers keep running, dependencies first
+        dependencies = await self.run_blocking(self.unit_dependencies,
+                                               [update['name'] for update in updates if update['autoremove'] != 1])
+        restart_order = order_restarts([update['name'] for update in updates], dependencies)
+        for update in sorted(updates, key=lambda update: restart_order.index(update['name'])):
+            if update['verdict'] is not None:
+                continue
+            elif update['slot'] is not None:
+                if update['status_update']:
+                    with self.tracer.span('handle_slot', container=update['name'], slot=update['slot']):
+                        update['status_update'] &= await self.run_blocking(self.handle_slot, update['name'],
+                                                                           update['slot'], update['notify'],
+                                                                           update['timeout'])
+            elif not update['skipped'] and not update['staged']:
+                started = self.step_get(update['name'], update['rev'], STEP_STARTED)
+                if started is not None and update['notify'] != 1:
+                    # a notify container is started again, its feedback thread needs the notification
+                    update['status_update'] &= started
+                    continue
+                with self.tracer.span('handle_container', container=update['name'], autostart=update['autostart'],
+                                      autoremove=update['autoremove']):
+                    started = await self.run_blocking(self.handle_container, update['name'],
+                                                      update['autostart'], update['autoremove'])
+                self.record_step(update['name'], update['rev'], STEP_STARTED, started)
+                update['status_update'] &= started
 
         final_result = True
         fails = ""
-        feedbackThreadIt = iter(self.feedbackThreads)
 
         # Hawkbit server feedback process
         for update in updates:
-            if update['notify'] == 1:
-                next(feedbackThreadIt).join()
+            feedbackMsg = ""
+            feedback_thread = self.feedbackThreads.get(update['name'])
+            if feedback_thread is not None:
+                # the verdict can take the whole notify timeout, the worker stays available meanwhile
+                await asyncio.get_event_loop().run_in_executor(None, feedback_thread.join)
                 self.mutexResults.acquire()
-                update['status_update'] &= self.feedbackResults[update['name']]['status_update']
+                started = self.feedbackResults[update['name']]['status_update']
                 feedbackMsg = self.feedbackResults[update['name']]['msg']
                 self.mutexResults.release()
-
-            if not update['status_update']:
+                update['status_update'] &= started
+                if not started:
+                    # the feedback thread only gives the verdict, the worker rolls the container back
+                    with self.tracer.span('rollback_container', container=update['name']):
+                        feedbackMsg += await self.run_blocking(self.rollback_container, update['name'],
+                                                               update['autostart'], update['autoremove'],
+                                                               update['slot'])
+                    if update['slot'] is None:
+                        # a resumed deployment must not check the failed revision out again
+                        self.record_step(update['name'], update['rev'], STEP_ROLLED_BACK, feedbackMsg)
+                if update['slot'] is not None:
+                    # the feedback thread only gives the verdict, the worker hands the container over
+                    with self.tracer.span('finish_slot', container=update['name'], slot=update['slot']):
+                        update['status_update'] = await self.run_blocking(self.finish_slot, update['name'],
+                                                                          update['slot'], update['status_update'])
+                    if update['status_update']:
+                        self.set_current_revision(update['name'], update['rev'])
+
+            if update['verdict'] is not None:
+               msg = update['verdict']
+               self.logger.info(msg)
+               if update['status_update']:
+                   update['status_result'] = DeploymentStatusResult.success
+               else:
+                   update['status_result'] = DeploymentStatusResult.failure
+                   fails += update['name'] + " "
+            elif not update['status_update']:
                msg = "App {} v.{} Deployment failed\n {}".format(update['name'], update['version'], feedbackMsg)
                self.logger.error(msg)
                update['status_result'] = DeploymentStatusResult.failure
                fails += update['name'] + " "
+            elif update['skipped']:
+               msg = "App {} v.{} already up to date".format(update['name'], update['version'])
+               self.logger.info(msg)
+               update['status_result'] = DeploymentStatusResult.success
+            elif update['staged']:
+               msg = "App {} v.{} Deployment staged, applied at the reboot".format(update['name'], update['version'])
+               self.logger.info(msg)
+               update['status_result'] = DeploymentStatusResult.success
             else:
                msg = "App {} v.{} Deployment succeed".format(update['name'], update['version'])
                self.logger.info(msg)
                update['status_result'] = DeploymentStatusResult.success
+               if update['notify'] != 1 and update['autoremove'] != 1:
+                   # notify containers record their revision once they reported a successful start
+                   self.set_current_revision(update['name'], update['rev'])
+            if update['verdict'] is None:
+                self.record_step(update['name'], update['rev'], STEP_VERDICT,
+                                 {'status_update': bool(update['status_update']), 'msg': msg})
 
             final_result &= (update['status_result'] == DeploymentStatusResult.success)
         
@@ -274,26 +559,202 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
             msg = "Hawkbit Update Failure : " + fails + "failed to update and / or to restart."
             self.logger.error(msg)
             status_result = DeploymentStatusResult.failure
-        await self.ddi.deploymentBase[self.action_id].feedback(DeploymentStatusExecution.closed, status_result, [msg])
+        await reporter.flush()
+        await self.ddi.deploymentBase[self.action_id].feedback(DeploymentStatusExecution.closed, status_result,
+                                                               [msg] + Tracer.summary(self.tracer.finish_trace()))
+        self.close_journal()
 
         self.action_id = None
+        if final_result and not reboot_needed and self.manages_os:
+            # only the primary target of a gateway prunes the shared repository
+            await self.prune()
         if reboot_needed:
+            await self.reboot()
+
+    async def claim_deployment(self, action_id, deployment):
+        """
+        Claim the containers of a deployment for this target, see AsyncUpdater.claim_containers(). A deployment
+        holding containers of another target of the gateway is closed as failed.
+
+        :param int action_id: Unique identifier of an Hawkbit update.
+        :param Deployment deployment: Parsed deployment.
+        :returns: - True if the deployment can go on
+                  - False if it was refused
+        """
+        names = [chunk.name for chunk in deployment.chunks if chunk.part == 'bApp']
+        conflicts = await self.run_blocking(self.claim_containers, self.ddi.controller_id, names,
+                                            self.primary_target)
+        if not conflicts:
+            return True
+        msg = "Deployment refused: containers owned by other targets ({})".format(
+            ', '.join('{} by {}'.format(name, owner) for name, owner in sorted(conflicts.items())))
+        self.logger.error(msg)
+        await self.ddi.deploymentBase[action_id].feedback(
+            DeploymentStatusExecution.closed, DeploymentStatusResult.failure, [msg])
+        return False
+
+    def plan_deployment(self, chunks):
+        """
+        Estimate the objects and bytes moved by a deployment before pulling anything, see UpdatePlan. The commit of
+        each chunk is resolved against its remote (see get_commit_objects()); a chunk which cannot be resolved is
+        left out of the estimate, its pull reports the error.
+
+        :param list chunks: Chunks of the deployment.
+        :returns: The UpdatePlan of the deployment.
+        """
+        attributes = self.ostree_remote_attributes or {}
+        plan = UpdatePlan(attributes.get('free-margin', FREE_MARGIN))
+        for chunk in chunks:
+            if chunk.part == 'os' and self.manages_os:
+                repo, repo_path = self.repo_os, PATH_REPO_OS
+            elif chunk.part == 'bApp' and chunk.metadata.get('autoremove') != 1:
+                repo, repo_path = self.repo_containers, PATH_REPO_APPS
+            else:
+                continue
             try:
-                subprocess.run("reboot")
-            except subprocess.CalledProcessError as e:
-                self.logger.error("Reboot failed: {}".format(e))
+                objects = self.get_commit_objects(chunk.part != 'os', chunk.metadata.get('rev'), chunk.name)
+                plan.add(chunk.name, repo, repo_path, objects)
+            except (GLib.Error, OSError, ValueError) as e:
+                self.logger.warning("Planning the update of {} failed ({})".format(chunk.name, e))
+                plan.add(chunk.name, repo, repo_path, None)
+        return plan
+
+    def step_get(self, name, rev, step):
+        """ Returns the value journaled for a step of a chunk, None if it was not done. See DeploymentJournal. """
+        return self.journal.get(name, rev, step) if self.journal is not None else None
+
+    def step_done(self, name, rev, step):
+        return self.step_get(name, rev, step) is not None
+
+    def record_step(self, name, rev, step, value=True):
+        if self.journal is not None:
+            self.journal.record(name, rev, step, value)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def prefetch(self, action_id, deployment):
+        """
+        Start downloading a deployment whose installation is not allowed yet, in the background: the polls go on
+        meanwhile, and the installation, once allowed, only checks out objects already in the repositories.
+            - a download only action (update 'skip') is closed once downloaded ;
+            - an action waiting for its maintenance window stays open, it is installed when HawkBit reports the
+              window available.
+
+        :param int action_id: Unique identifier of an Hawkbit update.
+        :param Deployment deployment: Parsed deployment.
+        """
+        if action_id in self.prefetched or action_id in self.prefetching:
+            return
+        self.prefetching[action_id] = asyncio.ensure_future(self.prefetch_deployment(action_id, deployment))
+
+    async def prefetch_deployment(self, action_id, deployment):
+        action = self.ddi.deploymentBase[action_id]
+        download_only = deployment.maintenance_window != 'unavailable'
+        try:
+            if not await self.claim_deployment(action_id, deployment):
+                self.prefetched.add(action_id)
+                return
+            self.logger.info("Deployment {}: downloading {}".format(
+                action_id, 'only' if download_only else 'until the maintenance window'))
+            await action.feedback(DeploymentStatusExecution.download, DeploymentStatusResult.none,
+                                  ["FullMetalUpdate:Downloading"])
+            reporter = ProgressReporter(action, len(deployment.chunks), asyncio.get_event_loop(),
+                                        execution=DeploymentStatusExecution.download)
+            result = True
+            for chunk in order_chunks(deployment.chunks):
+                reporter.chunk_started(chunk.name)
+                if chunk.part == 'os' and not self.manages_os:
+                    self.logger.error("OS {} not downloaded: target {} does not manage the OS".format(
+                        chunk.name, self.ddi.controller_id))
+                    status = False
+                else:
+                    status = await self.pull(chunk.part != 'os', chunk.metadata.get('rev'),
+                                             chunk.name if chunk.part != 'os' else None, reporter.pull_progress)
+                    if status:
+                        status = await self.run_blocking(self.prefetch_chunk, chunk.part != 'os', chunk.name,
+                                                         chunk.metadata.get('rev'), reporter.pull_progress)
+                reporter.chunk_done(chunk.name, status)
+                result &= status
+            await reporter.flush()
+
+            if not result:
+                msg = "Downloading failed"
+                self.logger.error("Deployment {}: {}".format(action_id, msg))
+                if download_only:
+                    await action.feedback(DeploymentStatusExecution.closed, DeploymentStatusResult.failure, [msg])
+                    self.prefetched.add(action_id)
+                else:
+                    # retried on the next poll
+                    await action.feedback(DeploymentStatusExecution.download, DeploymentStatusResult.none,
+                                          [msg + ", retrying"])
+                return
+            if download_only:
+                msg = "FullMetalUpdate:Downloaded"
+                await action.feedback(DeploymentStatusExecution.downloaded, DeploymentStatusResult.success, [msg])
+            else:
+                msg = "FullMetalUpdate:Downloaded, waiting for the maintenance window"
+                await action.feedback(DeploymentStatusExecution.downloaded, DeploymentStatusResult.none, [msg])
+            self.logger.info("Deployment {}: {}".format(action_id, msg))
+            self.prefetched.add(action_id)
+        except Exception as e:
+            self.logger.error("Deployment {}: downloading failed ({})".format(action_id, e))
+        finally:
+            del self.prefetching[action_id]
+
+    def prefetch_chunk(self, is_container, name, rev, progress_callback=None):
+        """
+        Pull a chunk ahead of its installation, see AsyncUpdater.prefetch_revision().
+
+        :returns: - True if the chunk was pulled
+                  - False otherwise
+        """
+        try:
+            self.prefetch_revision(is_container, rev, name, progress_callback)
+        except Exception as e:
+            self.logger.error("Downloading {} failed ({})".format(name, e))
+            return False
+        return True
+
+    async def reboot(self):
+        """
+        Reboot into the staged OS, at once or when the maintenance window opens: a deferred reboot is retried by
+        sleep() between two polls.
+        """
+        if self.maintenance_window is not None and not self.maintenance_window.is_open():
+            if not self.reboot_pending:
+                self.logger.info("Reboot deferred to the maintenance window {}".format(self.maintenance_window))
+            self.reboot_pending = True
+            return
+        self.reboot_pending = False
+        await self.run_blocking(self.rebooter.reboot)
 
     async def sleep(self, base):
         """ 
-        Timeout between two Hawkbit server polling tryouts. This sleep time is suggested by HawkBit. 
+        Timeout between two Hawkbit server polling tryouts. This sleep time is suggested by HawkBit and spread
+        by self.scheduler to avoid synchronized polls across the fleet.
 
-        :param dictionnary base: Dictionnary storing information about a Hawkbit update.
+        :param BaseResource base: Parsed base poll resource.
         """
-        sleep_str = base['config']['polling']['sleep']
-        self.logger.info('Will sleep for {}'.format(sleep_str))
-        t = datetime.strptime(sleep_str, '%H:%M:%S')
-        delta = timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
-        await asyncio.sleep(delta.total_seconds())
+        prune_interval = (self.ostree_remote_attributes or {}).get('prune-interval', PRUNE_INTERVAL)
+        if self.manages_os and prune_interval and time.monotonic() - self.last_prune > prune_interval:
+            # idle prune, only run by the primary target of a gateway as the repository is shared
+            await self.prune()
+        if self.manages_os and self.scrubber is not None:
+            await self.scrub()
+        if self.reboot_pending:
+            await self.reboot()
+
+        sleep_str = base.sleep
+        delay = self.scheduler.on_success(sleep_str)
+        if self.reboot_pending:
+            # wake up for the maintenance window
+            delay = min(delay, self.maintenance_window.seconds_until_open())
+        self.logger.info('Will sleep for {:.0f} seconds (suggested {})'.format(delay, sleep_str))
+        if await self.scheduler.wait(delay):
+            self.logger.info('Woken up before the end of the polling interval')
 
     async def poll_base_resource(self):
         """
@@ -303,19 +764,19 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
         """
 
         while True:
-            base = await self.ddi()
+            base = parse_base(await self.ddi())
 
-            if '_links' in base:
-                if 'configData' in base['_links']:
-                    await self.identify()
-                if 'deploymentBase' in base['_links']:
-                    await self.process_deployment(base)
-                if 'cancelAction' in base['_links']:
-                    await self.cancel(base)
+            if base.config_data:
+                await self.identify()
+            if base.deployment_action is not None:
+                await self.process_deployment(base)
+            if base.cancel_action is not None:
+                await self.cancel(base)
 
             await self.sleep(base)
 
-    def update_container(self, container_name, rev_number, autostart, autoremove, notify=None, timeout=None):
+    def update_container(self, container_name, rev_number, autostart, autoremove, notify=None, timeout=None,
+                         progress_callback=None, slot=None, staged=False, journaled=True):
         """
         Wrapper method to execute the different steps of a container update.
 
@@ -326,30 +787,107 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
         :param int action_id: Unique identifier of an Hawkbit update.
         :param int notify: Set to 1 if the container is a notify container.
         :param int timeout: Timeout value of the communication socket.
+        :param callable progress_callback: Receives the pull progress, see AsyncUpdater.pull_ostree_ref().
+        :param string slot: Blue/green slot to check out into while the current revision keeps running, None to
+            replace the current checkout.
+        :param boolean staged: Only stage the checkout, applied at the reboot into the OS updated along with the
+            container (see AsyncUpdater.stage_container).
+        :param boolean journaled: Skip the steps journaled before an interruption and journal the new ones, see
+            DeploymentJournal. A rollback is not journaled, the journal keeps the steps of the target revision.
         """
+        step_done = self.step_done if journaled else lambda name, rev, step: False
+        record_step = self.record_step if journaled else lambda name, rev, step: None
         try:
-            self.init_container_remote(container_name)
-            self.pull_ostree_ref(True, rev_number, container_name)
-            self.checkout_container(container_name, rev_number)
-            self.update_container_ids(container_name)
+            if not step_done(container_name, rev_number, STEP_PULLED):
+                self.init_container_remote(container_name)
+                self.pull_ostree_ref(True, rev_number, container_name, progress_callback)
+                record_step(container_name, rev_number, STEP_PULLED)
+            self.forget_prefetched_revisions(container_name)
+            if staged:
+                if autoremove != 1 and not step_done(container_name, rev_number, STEP_CHECKED_OUT):
+                    self.stage_container(container_name, rev_number)
+                    record_step(container_name, rev_number, STEP_CHECKED_OUT)
+                return True
+            self.drop_staged_container(container_name)
+            if slot is not None:
+                # the slots swap on each hand over, a blue/green checkout is always done again
+                self.checkout_slot(container_name, rev_number, slot)
+            elif not step_done(container_name, rev_number, STEP_CHECKED_OUT):
+                self.checkout_container(container_name, rev_number)
+                self.update_container_ids(container_name)
+                self.write_checkout_manifest(container_name)
+                record_step(container_name, rev_number, STEP_CHECKED_OUT)
             if (autostart == 1) and (notify == 1) and (autoremove != 1):
-                feedback_thread = self.create_and_start_feedback_thread(container_name, rev_number, autostart, autoremove, timeout)
-                self.feedbackThreads.append(feedback_thread)
-            self.create_unit(container_name)
+                feedback_thread = self.create_and_start_feedback_thread(container_name, rev_number, timeout, slot)
+                self.feedbackThreads[container_name] = feedback_thread
+            if slot is None and not step_done(container_name, rev_number, STEP_UNIT_INSTALLED):
+                self.create_unit(container_name)
+                record_step(container_name, rev_number, STEP_UNIT_INSTALLED)
         except Exception as e:
             self.logger.error("Updating {} failed ({})".format(container_name, e))
             return False
         return True
 
-    def update_system(self, rev_number):
+    def handle_slot(self, container_name, slot, notify, timeout):
+        """
+        Start a blue/green container from the slot prepared by update_container(). For a notify container, the
+        hand over happens once its feedback thread reports its successful start, see finish_slot(); otherwise as
+        soon as the unit is active. The previous instance keeps running if the new one fails.
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot prepared by update_container().
+        :param int notify: Set to 1 if the container is a notify container.
+        :param int timeout: Delay for the new instance to become active, in seconds.
+        :returns: - True if the new instance started, or if the verdict is left to the feedback thread
+                  - False otherwise
+        """
+        try:
+            self.start_slot(container_name, slot)
+            if notify == 1:
+                return True
+            if self.wait_slot_active(container_name, slot, timeout):
+                self.cutover_slot(container_name, slot)
+                return True
+            self.abort_slot(container_name, slot)
+        except Exception as e:
+            self.logger.error("Starting {} from slot {} failed ({})".format(container_name, slot, e))
+            try:
+                self.abort_slot(container_name, slot)
+            except Exception:
+                pass
+        return False
+
+    def finish_slot(self, container_name, slot, started):
+        """
+        Hand a notify blue/green container over to its slot once it reported a successful start, or stop the slot
+        if it failed to start, after the verdict of its feedback thread. See handle_slot().
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot started by handle_slot().
+        :param boolean started: Verdict of the feedback thread.
+        :returns: - True if the slot took over
+                  - False otherwise
+        """
+        try:
+            if started:
+                self.cutover_slot(container_name, slot)
+                return True
+            self.abort_slot(container_name, slot)
+        except Exception as e:
+            self.logger.error("Handing {} over to slot {} failed ({})".format(container_name, slot, e))
+        return False
+
+    def update_system(self, rev_number, progress_callback=None):
         """
         Wrapper method to execute the different steps of a OS update.
 
         :param string rev_number: Commit revision.
+        :param callable progress_callback: Receives the pull progress, see AsyncUpdater.pull_ostree_ref().
         """
         try:
-            self.pull_ostree_ref(False, rev_number)
+            self.pull_ostree_ref(False, rev_number, progress_callback=progress_callback)
             self.ostree_stage_tree(rev_number)
+            self.forget_prefetched_revisions()
             self.delete_init_var()
         except Exception as e:
             self.logger.error("Updating the OS failed ({})".format(e))
@@ -408,17 +946,16 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
 
         return (True, reboot_data)
 
-    def create_and_start_feedback_thread(self, container_name, rev, autostart, autoremove, timeout):
+    def create_and_start_feedback_thread(self, container_name, rev, timeout, slot=None):
         """
         This method is called to initialize and start the feedback thread used to
         feedback the server the status of a container whose notify variable is set. See the
         container_feedbacker thread method.
 
         :param string container_name: Name of the container.
-        :param string rev: Commit revision, used for rollbacking.
-        :param int autostart: Autostart variable of the container, used for rollbacking.
-        :param int autoremove: Autoremove of the container, used for rollbacking.
+        :param string rev: Commit revision.
         :param int timeout: Timeout value of the communication socket.
+        :param string slot: Blue/green slot the container starts from, see handle_slot().
         """
         sock_name = "fullmetalupdate_notify_" + container_name + ".sock"
         self.logger.info("Creating socket {}".format(sock_name))
@@ -433,8 +970,8 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
             args=(sock,
                   container_name,
                   rev,
-                  autostart,
-                  autoremove),
+                  self.tracer.current(),
+                  slot),
             name= "container-feedback-" + container_name)
         container_feedbackd.start()
         return container_feedbackd
@@ -443,59 +980,59 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
                              socket,
                              container_name,
                              rev_number,
-                             autostart,
-                             autoremove):
+                             parent_span=None,
+                             slot=None):
         """
         This thread method is used to feedback the server for containers which provide
-        the notify feature of systemd. It will trigger a rollback on the container in case
-        of failure (if possible).
+        the notify feature of systemd. It only gives the verdict: in case of failure, the
+        container is rolled back by the worker once the thread is joined, see rollback_container().
 
         This method will wait on an Unix socket for information about the notify result,
         and proceed in consequence.
 
         :param socket socket: Socket used for communication between the container service and this thread.
         :param string container_name: Name of the container.
-        :param string rev: Commit revision, used for rollbacking.
-        :param int autostart: Autostart variable of the container, used for rollbacking.
-        :param int autoremove: Autoremove of the container, used for rollbacking.
+        :param string rev: Commit revision.
+        :param Span parent_span: Span of the container update, parent of the notify verdict span.
+        :param string slot: Blue/green slot the container starts from, handed over or stopped by finish_slot()
+            instead of rolling back on failure.
         """
 
-        try:
+        with self.tracer.span('notify_verdict', parent=parent_span, container=container_name,
+                              rev=rev_number) as span:
             sock_name = "fullmetalupdate_notify_" + container_name + ".sock"
-            socket.listen(1)
-            [conn, _] = socket.accept()
-            datagram = conn.recv(1024)
-
-            if datagram:
-                systemd_info = datagram.strip().decode("utf-8").split()
-                self.logger.debug("Datagram received : {}".format(systemd_info))
-
-                if systemd_info[0] == 'success':
-                    # feedback the server positively
-                    msg = "Container " + container_name + " started successfully"
-                    status_update = True
-                    self.logger.info(msg)
-                    # Write this new revision for future updates
-                    self.set_current_revision(container_name, rev_number)
-                else:
-                    # rollback + feedback the server negatively
-                    status_update = False
-                    end_msg = self.rollback_container(container_name, autostart, autoremove)
-                    msg = "Container " + container_name + " failed to start with result :" \
-                        + "\n\tSERVICE_RESULT=" + systemd_info[0] \
-                        + "\n\tEXIT_CODE=" + systemd_info[1] \
-                        + "\n\tEXIT_STATUS=" + systemd_info[2] \
-                        + end_msg
-                    self.logger.info(msg)
-        except s.timeout:
-            # socket timeout, try to rollback if possible
-            status_update = False
-            msg = "Container " + container_name + " failed to start : the socket timed out."
-            self.logger.error(msg)
-            end_msg = self.rollback_container(container_name,
-                                              autostart,
-                                              autoremove)
-            msg += end_msg
+            try:
+                with METRICS.timed('notify_wait'):
+                    socket.listen(1)
+                    [conn, _] = socket.accept()
+                    datagram = conn.recv(1024)
+
+                if datagram:
+                    systemd_info = datagram.strip().decode("utf-8").split()
+                    self.logger.debug("Datagram received : {}".format(systemd_info))
+
+                    if systemd_info[0] == 'success':
+                        # feedback the server positively
+                        msg = "Container " + container_name + " started successfully"
+                        status_update = True
+                        self.logger.info(msg)
+                        if slot is None:
+                            # Write this new revision for future updates, see finish_slot() for a slot
+                            self.set_current_revision(container_name, rev_number)
+                    else:
+                        # feedback the server negatively, the worker rolls back
+                        status_update = False
+                        msg = "Container " + container_name + " failed to start with result :" \
+                            + "\n\tSERVICE_RESULT=" + systemd_info[0] \
+                            + "\n\tEXIT_CODE=" + systemd_info[1] \
+                            + "\n\tEXIT_STATUS=" + systemd_info[2]
+                        self.logger.info(msg)
+            except s.timeout:
+                # socket timeout, the worker rolls back if possible
+                status_update = False
+                msg = "Container " + container_name + " failed to start : the socket timed out."
+                self.logger.error(msg)
+            span.set(result='success' if status_update else 'failure')
 
         socket.close()
         self.logger.info("Removing socket {}".format(sock_name))
@@ -510,27 +1047,31 @@ class FullMetalUpdateDDIClient(AsyncUpdater):
         self.feedbackResults[container_name]["msg"] = msg
         self.mutexResults.release()
 
-    def rollback_container(self, container_name, autostart, autoremove):
+    def rollback_container(self, container_name, autostart, autoremove, slot=None):
         """
         This method Rollbacks the container, if possible, and returns a message that will
-        be sent to the server.
+        be sent to the server. Run in the worker once the feedback thread of the container gave its verdict.
 
         :param string container_name: Name of the container.
         :param int autostart: Autostart variable of the container, used for rollbacking.
         :param int autoremove: Autoremove of the container, used for rollbacking.
+        :param string slot: Blue/green slot which failed to start, the previous instance is still running (the slot
+            is stopped by finish_slot()).
 
         :returns: End of the message that will be sent, which depends on the status of the rollback (performed or not)
         :rtype: string
         """
 
         end_msg = ""
+        if slot is not None:
+            return "\nThe previous instance of the container keeps running."
         previous_rev = self.get_previous_rev(container_name)
 
         if previous_rev is None:
             end_msg = "\nFirst installation of the container, cannot rollback."
         else:
-            res = self.update_container(container_name, previous_rev, autostart, autoremove)
-            self.systemd.Reload()
+            res = self.update_container(container_name, previous_rev, autostart, autoremove, journaled=False)
+            self.reload_units()
             res &= self.handle_container(container_name, autostart, autoremove)
             if res:
                 end_msg = "\nContainer has rollbacked."
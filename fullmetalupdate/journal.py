@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+from threading import Lock
+
+PATH_JOURNALS = '/var/local/fullmetalupdate/journal'
+
+# steps of a container update, in order
+STEP_PULLED = 'pulled'
+STEP_CHECKED_OUT = 'checked_out'
+STEP_UNIT_INSTALLED = 'unit_installed'
+STEP_STARTED = 'started'
+STEP_VERDICT = 'verdict'
+# failed start of a notify container, rolled back by its feedback thread before the verdict
+STEP_ROLLED_BACK = 'rolled_back'
+# step of an OS update, the OS is staged until the reboot
+STEP_STAGED = 'staged'
+
+
+class DeploymentJournal(object):
+    """ Steps done by a deployment, so that a deployment interrupted by a crash of the daemon or a power loss resumes
+    where it stopped instead of starting over.
+
+    The journal of an action is <path>/<action_id>.json: for each chunk, the revision it is updated to and
+    the steps done, with their value ('verdict' holds the result and message reported to HawkBit). Each record
+    replaces the file atomically. The entries of a chunk whose revision changed are ignored. The journal is removed
+    once the final feedback of the action is sent.
+
+    :param int action_id: Unique identifier of an Hawkbit update.
+    :param string path: Directory of the journals of the target.
+    """
+
+    def __init__(self, action_id, path=PATH_JOURNALS):
+        self.logger = logging.getLogger('fullmetalupdate_hawkbit')
+        self.action_id = action_id
+        self.path = path
+        self.file = os.path.join(path, '{}.json'.format(action_id))
+        self.lock = Lock()
+        self.closed = False
+        os.makedirs(path, exist_ok=True)
+        self.chunks = self.load()
+        self.discard_others()
+
+    def load(self):
+        try:
+            with open(self.file, 'r') as f:
+                chunks = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            self.logger.warning("Journal of action {} unreadable, starting over ({})".format(self.action_id, e))
+            return {}
+        if chunks:
+            self.logger.info("Resuming action {} from its journal".format(self.action_id))
+        return chunks
+
+    def discard_others(self):
+        """ Remove the journals of the other actions, HawkBit only hands out one action at a time to a target. """
+        for name in os.listdir(self.path):
+            if name != os.path.basename(self.file):
+                os.remove(os.path.join(self.path, name))
+
+    def get(self, name, rev, step):
+        """
+        Returns the value recorded for a step of a chunk, None if the step was not done.
+
+        :param string name: Name of the chunk.
+        :param string rev: Revision the chunk is updated to.
+        :param string step: Step of the update.
+        """
+        with self.lock:
+            entry = self.chunks.get(name)
+            if entry is None or entry.get('rev') != rev:
+                return None
+            return entry['steps'].get(step)
+
+    def done(self, name, rev, step):
+        return self.get(name, rev, step) is not None
+
+    def record(self, name, rev, step, value=True):
+        """
+        Record that a step of a chunk is done, from any thread. Nothing is recorded once the journal is closed.
+
+        :param string name: Name of the chunk.
+        :param string rev: Revision the chunk is updated to.
+        :param string step: Step of the update.
+        :param value: Value of the step, JSON serializable.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            entry = self.chunks.get(name)
+            if entry is None or entry.get('rev') != rev:
+                entry = self.chunks[name] = {'rev': rev, 'steps': {}}
+            entry['steps'][step] = value
+            tmp = self.file + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(self.chunks, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.file)
+            except OSError as e:
+                self.logger.error("Writing the journal of action {} failed ({})".format(self.action_id, e))
+
+    def close(self):
+        """ Remove the journal, once the action is over. """
+        with self.lock:
+            self.closed = True
+            self.chunks = {}
+            try:
+                os.remove(self.file)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_time(text):
+    """ Returns the minutes elapsed since midnight at 'HH:MM'. """
+    hours, sep, minutes = text.strip().partition(':')
+    try:
+        hours, minutes = int(hours), int(minutes)
+    except ValueError:
+        raise ValueError("Malformed time {!r}, expected HH:MM".format(text))
+    if not sep or not 0 <= hours < 24 or not 0 <= minutes < 60:
+        raise ValueError("Malformed time {!r}, expected HH:MM".format(text))
+    return hours * 60 + minutes
+
+
+class MaintenanceWindow(object):
+    """ Daily maintenance window, in local time, during which the disruptive steps (reboots) are allowed.
+
+    The window is a comma separated list of 'HH:MM-HH:MM' ranges, e.g. '01:00-03:00,13:00-13:30'. A range ending
+    before its start spans midnight ('22:00-04:00'), a range ending at its start covers the whole day.
+
+    :param string spec: Ranges of the window.
+    :raises ValueError: The window is malformed.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.ranges = []
+        for item in spec.split(','):
+            start, sep, end = item.partition('-')
+            if not sep:
+                raise ValueError("Malformed maintenance window range {!r}, expected HH:MM-HH:MM".format(item))
+            self.ranges.append((parse_time(start), parse_time(end)))
+
+    def __str__(self):
+        return self.spec
+
+    def seconds_until_open(self, now=None):
+        """
+        Returns the delay before the window opens, in seconds, 0 if it is open.
+
+        :param datetime.datetime now: Local time, the current one by default.
+        """
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute + now.second / 60
+        delays = []
+        for start, end in self.ranges:
+            if start == end or \
+                    (start < end and start <= minute < end) or \
+                    (start > end and (minute >= start or minute < end)):
+                return 0
+            delays.append((start - minute) % MINUTES_PER_DAY)
+        return min(delays) * 60
+
+    def is_open(self, now=None):
+        return self.seconds_until_open(now) == 0
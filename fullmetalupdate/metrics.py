@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+import aiohttp
+import aiohttp.web
+
+# latency buckets in seconds, from a fast HTTP call to a full container pull
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# media type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels)) + '}'
+
+
+class Metric(object):
+    """ Base class of the metrics: a value per set of labels.
+
+    :param string name: Name of the metric.
+    :param string help: Description of the metric.
+    """
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def samples(self):
+        """ Returns the (name, labels, value) samples of the metric. """
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        counts, _, _ = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key][1] += 1
+        self.values[key][2] += value
+
+    def samples(self):
+        samples = []
+        for labels, (counts, count, total) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket', labels + (('le', repr(float(bound))),), bucket_count))
+            samples.append((self.name + '_bucket', labels + (('le', '+Inf'),), count))
+            samples.append((self.name + '_count', labels, count))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+
+class Registry(object):
+    """ Thread safe set of metrics rendered in the Prometheus text format.
+
+    The metrics are updated from the event loop, the executor threads and the notify feedback threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def inc(self, name, amount=1, **labels):
+        metric = self.metrics[name]
+        with self.lock:
+            metric.inc(amount, **labels)
+
+    def set(self, name, value, **labels):
+        metric = self.metrics[name]
+        with self.lock:
+            metric.set(value, **labels)
+
+    def observe(self, name, value, **labels):
+        metric = self.metrics[name]
+        with self.lock:
+            metric.observe(value, **labels)
+
+    def add_collector(self, collector):
+        """ Register a callable refreshing some metrics right before they are rendered. """
+        self.collectors.append(collector)
+
+    @contextmanager
+    def timed(self, phase):
+        """ Context manager recording the duration of an update phase, and its failure if an exception is raised.
+
+        :param string phase: Name of the phase.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.inc('fmu_phase_failures_total', phase=phase)
+            raise
+        finally:
+            self.observe('fmu_phase_duration_seconds', time.monotonic() - start, phase=phase)
+
+    def render(self):
+        """ Returns all the metrics in the Prometheus text exposition format. """
+        for collector in self.collectors:
+            collector(self)
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+                for name, labels, value in metric.samples():
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Registry()
+METRICS.histogram('fmu_phase_duration_seconds', 'Duration of the update phases.')
+METRICS.counter('fmu_phase_failures_total', 'Number of failed update phases.')
+METRICS.histogram('fmu_http_request_duration_seconds', 'Duration of the HTTP requests to the HawkBit server.')
+METRICS.counter('fmu_http_request_errors_total', 'Number of HTTP requests which failed without response.')
+METRICS.counter('fmu_ostree_pull_bytes_total', 'Bytes transferred by OSTree pulls.')
+METRICS.gauge('fmu_ostree_pull_throughput_bytes', 'Throughput of the last OSTree pull, in bytes per second.')
+METRICS.counter('fmu_ostree_pull_retries_total', 'Number of OSTree pulls retried after a stall or an error.')
+METRICS.gauge('fmu_ostree_mirror_latency_seconds', 'Average probe latency of the OSTree mirrors.')
+METRICS.gauge('fmu_ostree_mirror_throughput_bytes', 'Average pull throughput of the OSTree mirrors.')
+METRICS.counter('fmu_ostree_pruned_bytes_total', 'Space reclaimed by pruning the OSTree repositories.')
+METRICS.gauge('fmu_ostree_repo_bytes', 'Disk space used by the objects of the OSTree repositories.')
+METRICS.counter('fmu_scrub_verified_bytes_total', 'Bytes of OSTree objects verified by the background scrub.')
+METRICS.counter('fmu_scrub_repaired_objects_total', 'Number of corrupt OSTree objects repaired by the scrub.')
+METRICS.counter('fmu_trash_deleted_entries_total', 'Number of files and directories deleted from the trash.')
+METRICS.counter('fmu_peer_pulls_total', 'Number of OSTree pulls from LAN peers, by result.')
+METRICS.counter('fmu_peer_served_bytes_total', 'Bytes of OSTree objects served to the LAN peers.')
+METRICS.counter('fmu_bootenv_writes_total', 'Number of writes of the bootloader environment.')
+METRICS.gauge('fmu_http_pool_stat', 'Connection reuse statistics of the HTTP connection pools.')
+
+
+def timed(phase):
+    """ Decorator recording the duration of an update phase in METRICS, see Registry.timed().
+
+    :param string phase: Name of the phase.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timed(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def http_trace_config():
+    """ Returns an aiohttp TraceConfig recording the duration of the HTTP requests in METRICS. """
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.start = time.monotonic()
+
+    async def on_request_end(session, ctx, params):
+        METRICS.observe('fmu_http_request_duration_seconds', time.monotonic() - ctx.start,
+                        method=params.method, status=params.response.status)
+
+    async def on_request_exception(session, ctx, params):
+        METRICS.inc('fmu_http_request_errors_total', method=params.method)
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+
+class MetricsServer(object):
+    """ Serves METRICS in the Prometheus text format on GET /metrics.
+
+    :param string address: Either 'unix:<path>' for a UNIX socket or '<host>:<port>' for a TCP socket.
+    """
+
+    def __init__(self, address, registry=METRICS):
+        self.logger = logging.getLogger('fullmetalupdate_metrics')
+        self.address = address
+        self.registry = registry
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        return aiohttp.web.Response(body=self.registry.render().encode('utf-8'),
+                                    headers={'Content-Type': CONTENT_TYPE, 'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = aiohttp.web.AppRunner(app)
+        await self.runner.setup()
+
+        if self.address.startswith('unix:'):
+            path = self.address[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+            site = aiohttp.web.UnixSite(self.runner, path)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            site = aiohttp.web.TCPSite(self.runner, host, int(port))
+        await site.start()
+        self.logger.info("Serving metrics on {}".format(self.address))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def transport_collector(transport):
+    """ Returns a collector exporting the connection reuse statistics of an HTTPTransport.
+
+    :param HTTPTransport transport: Transport used by the DDI clients.
+    """
+    def collect(registry):
+        for pool, stats in transport.stats.items():
+            for stat, value in stats.as_dict().items():
+                registry.set('fmu_http_pool_stat', value, pool=pool, stat=stat)
+    return collect
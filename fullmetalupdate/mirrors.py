@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import urllib.request
+from threading import Lock
+
+from fullmetalupdate.metrics import METRICS
+
+# delay between two latency probes of the mirrors, in seconds
+PROBE_INTERVAL = 600
+PROBE_TIMEOUT = 5
+# a failed mirror is skipped for this delay (seconds), doubled on each consecutive failure
+FAILURE_COOLDOWN = 60
+FAILURE_COOLDOWN_MAX = 3600
+# weight of the last measure in the moving averages
+EWMA_WEIGHT = 0.3
+# size used to compare the mirrors: score = latency + REFERENCE_BYTES / throughput
+REFERENCE_BYTES = 1024 * 1024
+
+
+class Mirror(object):
+    """ Mirror of the OSTree server, with its measured performance.
+
+    :param string url: Base URL of the mirror, given to the OSTree pulls as their override-url.
+    :param float latency: Moving average of the probe latency, in seconds (None until probed).
+    :param float throughput: Moving average of the pull throughput, in bytes per second (None until used).
+    :param int failures: Number of consecutive failures.
+    :param float down_until: Monotonic time until which the mirror is skipped.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.down_until = 0
+
+    @staticmethod
+    def average(current, value):
+        return value if current is None else (1 - EWMA_WEIGHT) * current + EWMA_WEIGHT * value
+
+    @property
+    def score(self):
+        """ Estimated time to fetch REFERENCE_BYTES from the mirror, lower is better. """
+        score = self.latency if self.latency is not None else PROBE_TIMEOUT
+        if self.throughput:
+            score += REFERENCE_BYTES / self.throughput
+        return score
+
+
+class MirrorSet(object):
+    """ Mirrors of the OSTree remotes (regional caches, CDN...), ranked by measured latency and throughput.
+
+    A pull fetches from the selected mirror through its override-url option, the config of the remotes is left
+    alone. The commits are pulled by checksum, a mirror cannot alter them. A mirror which fails is skipped for a
+    while, and the origin is used when no mirror is available.
+
+    Each entry of urls is either the base URL of a mirror or 'mirrorlist=<url>', a file listing one mirror URL per
+    line which is downloaded on each probe.
+
+    :param list urls: Mirror entries from the configuration.
+    :param float probe_interval: Delay between two latency probes, in seconds.
+    """
+
+    def __init__(self, urls, probe_interval=PROBE_INTERVAL):
+        self.logger = logging.getLogger('fullmetalupdate_container_updater')
+        self.entries = list(urls)
+        self.probe_interval = probe_interval
+        self.mirrors = {}
+        self.last_probe = None
+        self.lock = Lock()
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def fetch_mirrorlist(self, url):
+        try:
+            with urllib.request.urlopen(url, timeout=PROBE_TIMEOUT) as response:
+                lines = response.read().decode('utf-8').splitlines()
+        except (OSError, ValueError) as e:
+            self.logger.warning("Fetching mirror list {} failed ({})".format(url, e))
+            return []
+        return [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+
+    def probe(self, mirror):
+        """ Measure the latency of a mirror by downloading the config file of its repository. """
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(mirror.url + '/config', timeout=PROBE_TIMEOUT) as response:
+                response.read()
+        except (OSError, ValueError) as e:
+            self.logger.warning("Probing mirror {} failed ({})".format(mirror.url, e))
+            self.failed(mirror.url)
+            return
+        latency = time.monotonic() - start
+        with self.lock:
+            mirror.latency = Mirror.average(mirror.latency, latency)
+        METRICS.set('fmu_ostree_mirror_latency_seconds', mirror.latency, mirror=mirror.url)
+
+    def refresh(self):
+        """ Expand the mirror lists and probe the mirrors, at most once per probe_interval. """
+        now = time.monotonic()
+        if self.last_probe is not None and now - self.last_probe < self.probe_interval:
+            return
+        self.last_probe = now
+
+        urls = []
+        for entry in self.entries:
+            if entry.startswith('mirrorlist='):
+                urls.extend(self.fetch_mirrorlist(entry[len('mirrorlist='):]))
+            else:
+                urls.append(entry)
+        with self.lock:
+            self.mirrors = {url.rstrip('/'): self.mirrors.get(url.rstrip('/')) or Mirror(url) for url in urls}
+        for mirror in list(self.mirrors.values()):
+            if mirror.down_until <= now:
+                self.probe(mirror)
+
+    def ranked(self):
+        """ Returns the available mirrors, the best first. """
+        now = time.monotonic()
+        with self.lock:
+            available = [m for m in self.mirrors.values() if m.down_until <= now]
+        return sorted(available, key=lambda m: m.score)
+
+    def select(self):
+        """ Returns the URL of the best available mirror, or None to fetch from the origin. """
+        if not self.entries:
+            return None
+        self.refresh()
+        ranked = self.ranked()
+        return ranked[0].url if ranked else None
+
+    def record(self, url, transferred, duration):
+        """ Update the throughput of a mirror after a successful pull.
+
+        :param string url: URL of the mirror.
+        :param int transferred: Bytes transferred by the pull.
+        :param float duration: Duration of the pull, in seconds.
+        """
+        with self.lock:
+            mirror = self.mirrors.get(url)
+            if mirror is None:
+                return
+            mirror.failures = 0
+            # a pull of objects already in the repository says nothing about the mirror
+            if transferred >= REFERENCE_BYTES and duration > 0:
+                mirror.throughput = Mirror.average(mirror.throughput, transferred / duration)
+                METRICS.set('fmu_ostree_mirror_throughput_bytes', mirror.throughput, mirror=url)
+
+    def failed(self, url):
+        """ Skip a mirror which failed, for a delay growing with its consecutive failures. """
+        with self.lock:
+            mirror = self.mirrors.get(url)
+            if mirror is None:
+                return
+            mirror.failures += 1
+            cooldown = min(FAILURE_COOLDOWN * 2 ** (mirror.failures - 1), FAILURE_COOLDOWN_MAX)
+            mirror.down_until = time.monotonic() + cooldown
+        self.logger.warning("Mirror {} disabled for {}s".format(url, cooldown))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+# systemd dependencies ordering a unit after the listed ones
+AFTER_PROPERTIES = ('After', 'Requires', 'BindsTo', 'Requisite')
+
+
+def order_chunks(chunks, sizes=None):
+    """ Order the chunks of a deployment for the update process.
+
+    The OS chunks come first, as they keep their specific handling (reboot feedback), then the containers by
+    decreasing 'priority' metadata and by increasing transfer size, so that small critical containers are ready
+    first. The order of HawkBit breaks ties.
+
+    The artifacts of a chunk say nothing about the OSTree objects actually pulled: the transfer size is the estimate
+    of the UpdatePlan when known, the size of the artifacts otherwise.
+
+    :param list chunks: Chunks of the deployment (rauc_hawkbit.ddi.model.Chunk).
+    :param dictionnary sizes: Bytes to download per chunk name, see UpdatePlan.download_sizes().
+    :returns: New list of chunks.
+    """
+    sizes = sizes or {}
+
+    def key(indexed):
+        index, chunk = indexed
+        return (chunk.part != 'os', -(chunk.metadata.get('priority') or 0), sizes.get(chunk.name, chunk.size),
+                index)
+    return [chunk for _, chunk in sorted(enumerate(chunks), key=key)]
+
+
+def order_restarts(names, dependencies):
+    """ Order the containers restarts so that a container starts after the containers it depends on.
+
+    :param list names: Names of the containers, in their default order.
+    :param dictionnary dependencies: For each name, the names it must start after.
+    :returns: New list of names; the containers in a dependency cycle keep their default order, at the end.
+    """
+    remaining = list(names)
+    ordered = []
+    while remaining:
+        ready = [name for name in remaining
+                 if not any(dep in remaining and dep != name for dep in dependencies.get(name, ()))]
+        if not ready:
+            logging.getLogger('fullmetalupdate_hawkbit').warning(
+                "Dependency cycle between the containers {}, keeping their order".format(', '.join(remaining)))
+            ordered.extend(remaining)
+            break
+        ordered.append(ready[0])
+        remaining.remove(ready[0])
+    return ordered
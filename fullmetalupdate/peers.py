@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hmac
+import ipaddress
+import logging
+import random
+import re
+import socket
+import time
+import urllib.request
+import uuid
+from threading import Lock
+
+import aiohttp.web
+import gi
+
+gi.require_version("OSTree", "1.0")
+from gi.repository import OSTree, GLib
+
+from fullmetalupdate.metrics import METRICS
+
+# seconds between two announces on the LAN, a peer is forgotten after PEER_EXPIRY seconds without announce
+ANNOUNCE_INTERVAL = 30
+PEER_EXPIRY = 3 * ANNOUNCE_INTERVAL
+ANNOUNCE_PREFIX = 'fullmetalupdate-peer'
+# number of peers tried before falling back to the origin
+PEER_MAX_ATTEMPTS = 3
+PEER_CHECK_TIMEOUT = 2
+STREAM_CHUNK_SIZE = 64 * 1024
+# a failed peer is skipped for this delay, in seconds
+PEER_FAILURE_COOLDOWN = 300
+# header carrying the shared token of the peers
+TOKEN_HEADER = 'X-FullMetalUpdate-Peer-Token'
+
+CHECKSUM_RE = re.compile('^[0-9a-f]{64}$')
+METADATA_TYPES = {
+    'commit': OSTree.ObjectType.COMMIT,
+    'dirtree': OSTree.ObjectType.DIR_TREE,
+    'dirmeta': OSTree.ObjectType.DIR_META,
+}
+# the peers serve bare repositories as archive ones, the only mode which can be pulled over HTTP
+ARCHIVE_CONFIG = "[core]\nrepo_version=1\nmode=archive-z2\n"
+
+
+class PeerSet(object):
+    """ Neighbouring devices serving their OSTree repositories, either configured or discovered on the LAN.
+
+    :param list urls: Base URLs of the configured peers ('http://<host>:<port>').
+    :param string token: Shared token the peers require, see PeerServer.
+    """
+
+    def __init__(self, urls=(), token=None):
+        self.logger = logging.getLogger('fullmetalupdate_peers')
+        self.configured = [url.rstrip('/') for url in urls]
+        self.token = token or None
+        self.discovered = {}
+        self.down_until = {}
+        self.lock = Lock()
+
+    def __bool__(self):
+        return bool(self.configured or self.discovered)
+
+    def add(self, url):
+        """ Register a peer which announced itself on the LAN. """
+        with self.lock:
+            if url not in self.discovered:
+                self.logger.info("Discovered peer {}".format(url))
+            self.discovered[url] = time.monotonic()
+
+    def failed(self, url):
+        with self.lock:
+            self.down_until[url] = time.monotonic() + PEER_FAILURE_COOLDOWN
+
+    def candidates(self):
+        """ Returns the available peers in random order, so that a site rollout spreads over all of them. """
+        now = time.monotonic()
+        with self.lock:
+            for url, seen in list(self.discovered.items()):
+                if now - seen > PEER_EXPIRY:
+                    del self.discovered[url]
+            urls = set(self.configured) | set(self.discovered)
+            urls = [url for url in urls if self.down_until.get(url, 0) <= now]
+        random.shuffle(urls)
+        return urls
+
+    def headers(self):
+        """ Returns the HTTP headers of the requests to the peers. """
+        return {TOKEN_HEADER: self.token} if self.token is not None else {}
+
+    def has_commit(self, url, rev):
+        """ Check that a peer holds a complete commit, before pulling from it.
+
+        :param string url: Base URL of the peer repository.
+        :param string rev: Checksum of the commit.
+        """
+        request = urllib.request.Request('{}/objects/{}/{}.commit'.format(url, rev[:2], rev[2:]), method='HEAD',
+                                         headers=self.headers())
+        try:
+            with urllib.request.urlopen(request, timeout=PEER_CHECK_TIMEOUT) as response:
+                return response.status == 200
+        except (OSError, ValueError):
+            return False
+
+
+class PeerServer(object):
+    """ Serves the local OSTree repositories read-only over HTTP, as archive repositories:
+    GET /<repo>/config and GET /<repo>/objects/<xx>/<checksum>.<type>.
+
+    Only complete commits are served. The objects are checksummed and the commits verified by the pulling device
+    as they are when pulled from the origin.
+
+    Exposure: the server hands the whole content of both repositories (OS and containers images, including any
+    data they embed) to whoever can reach it, without TLS. It listens on an explicit address only, answers the
+    clients of the allowed networks only, and requires the shared token in the TOKEN_HEADER header of each request
+    when one is set. The repositories are read in the worker executor of the updater, so that the reads never run
+    along a prune or a pull: a device busy with an update serves its peers between two steps, a pulling peer which
+    stalls meanwhile falls back to the origin.
+
+    :param string host: Address to listen on, e.g. the address of the device on the LAN of its peers.
+    :param int port: TCP port to listen on.
+    :param dictionnary repos: OSTree repositories by name ('containers', 'os').
+    :param ThreadPoolExecutor executor: Worker executor of the updater.
+    :param list allowed: Networks allowed to connect ('192.168.1.0/24'), empty to allow any client.
+    :param string token: Shared token of the peers, None to require none.
+    """
+
+    def __init__(self, host, port, repos, executor, allowed=(), token=None):
+        self.logger = logging.getLogger('fullmetalupdate_peers')
+        self.host = host
+        self.port = port
+        self.repos = repos
+        self.executor = executor
+        self.allowed = [ipaddress.ip_network(network, strict=False) for network in allowed]
+        self.token = token or None
+        self.runner = None
+
+    def authorized(self, request):
+        """ Returns True if the client of request may read the repositories. """
+        if self.allowed:
+            try:
+                address = ipaddress.ip_address(request.remote)
+            except ValueError:
+                return False
+            if not any(address in network for network in self.allowed):
+                return False
+        if self.token is not None:
+            return hmac.compare_digest(request.headers.get(TOKEN_HEADER, ''), self.token)
+        return True
+
+    @aiohttp.web.middleware
+    async def check_client(self, request, handler):
+        if not self.authorized(request):
+            self.logger.warning("Refused peer request from {}".format(request.remote))
+            raise aiohttp.web.HTTPForbidden()
+        return await handler(request)
+
+    async def handle_config(self, request):
+        if request.match_info['repo'] not in self.repos:
+            raise aiohttp.web.HTTPNotFound()
+        return aiohttp.web.Response(text=ARCHIVE_CONFIG)
+
+    def load_metadata(self, repo, checksum, objtype):
+        """ Returns the serialized metadata object, None if it is missing or belongs to a partial commit. """
+        try:
+            if objtype == 'commit':
+                [_, variant, state] = repo.load_commit(checksum)
+                if state & OSTree.RepoCommitState.PARTIAL:
+                    return None
+            elif objtype == 'commitmeta':
+                [_, variant] = repo.read_commit_detached_metadata(checksum, None)
+                if variant is None:
+                    return None
+            else:
+                [_, variant] = repo.load_variant(METADATA_TYPES[objtype], checksum)
+        except GLib.Error:
+            return None
+        return variant.get_data_as_bytes().get_data()
+
+    def open_file(self, repo, checksum):
+        """ Returns the content object as an archive-z2 stream, None if it is missing. """
+        try:
+            [_, stream, file_info, xattrs] = repo.load_file(checksum, None)
+            [_, archive] = OSTree.raw_file_to_archive_z2_stream(stream, file_info, xattrs, None)
+        except GLib.Error:
+            return None
+        return archive
+
+    async def handle_object(self, request):
+        repo = self.repos.get(request.match_info['repo'])
+        checksum = request.match_info['prefix'] + request.match_info['rest']
+        objtype = request.match_info['type']
+        if repo is None or not CHECKSUM_RE.match(checksum):
+            raise aiohttp.web.HTTPNotFound()
+        loop = asyncio.get_event_loop()
+
+        if objtype in METADATA_TYPES or objtype == 'commitmeta':
+            data = await loop.run_in_executor(self.executor, self.load_metadata, repo, checksum, objtype)
+            if data is None:
+                raise aiohttp.web.HTTPNotFound()
+            if request.method == 'HEAD':
+                return aiohttp.web.Response(headers={'Content-Length': str(len(data))})
+            return aiohttp.web.Response(body=data, content_type='application/octet-stream')
+
+        if objtype != 'filez':
+            raise aiohttp.web.HTTPNotFound()
+        archive = await loop.run_in_executor(self.executor, self.open_file, repo, checksum)
+        if archive is None:
+            raise aiohttp.web.HTTPNotFound()
+        response = aiohttp.web.StreamResponse(headers={'Content-Type': 'application/octet-stream'})
+        await response.prepare(request)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, archive.read_bytes, STREAM_CHUNK_SIZE, None)
+                if chunk.get_size() == 0:
+                    break
+                await response.write(chunk.get_data())
+                METRICS.inc('fmu_peer_served_bytes_total', chunk.get_size())
+        finally:
+            archive.close(None)
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = aiohttp.web.Application(middlewares=[self.check_client])
+        app.router.add_get('/{repo}/config', self.handle_config)
+        app.router.add_get('/{repo}/objects/{prefix:[0-9a-f]{2}}/{rest:[0-9a-f]{62}}.{type}', self.handle_object)
+        self.runner = aiohttp.web.AppRunner(app)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.logger.info("Serving OSTree objects to the peers on {}:{} (allowed: {}, token {})".format(
+            self.host, self.port, ', '.join(str(network) for network in self.allowed) or 'any',
+            'required' if self.token is not None else 'not required'))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class PeerDiscovery(asyncio.DatagramProtocol):
+    """ Announces the local PeerServer on the LAN with UDP broadcasts, and registers the peers announcing theirs.
+
+    The announce is '<ANNOUNCE_PREFIX> <node id> <port>', the node id is used to ignore our own announces.
+
+    :param int port: UDP port of the announces, also the TCP port of the PeerServer.
+    :param PeerSet peers: Set receiving the discovered peers.
+    """
+
+    def __init__(self, port, peers):
+        self.logger = logging.getLogger('fullmetalupdate_peers')
+        self.port = port
+        self.peers = peers
+        self.node_id = uuid.uuid4().hex
+        self.transport = None
+        self.task = None
+
+    def datagram_received(self, data, addr):
+        try:
+            prefix, node_id, port = data.decode('utf-8').split()
+            port = int(port)
+        except ValueError:
+            return
+        if prefix == ANNOUNCE_PREFIX and node_id != self.node_id:
+            self.peers.add('http://{}:{}'.format(addr[0], port))
+
+    async def announce(self):
+        message = '{} {} {}'.format(ANNOUNCE_PREFIX, self.node_id, self.port).encode('utf-8')
+        while True:
+            self.transport.sendto(message, ('<broadcast>', self.port))
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', self.port))
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.task = asyncio.ensure_future(self.announce())
+        self.logger.info("Discovering peers on UDP port {}".format(self.port))
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from fullmetalupdate.progress import format_bytes
+
+# commit metadata listing the objects of the commit with their sizes, see 'ostree commit --generate-sizes'
+METADATA_SIZES = 'ostree.sizes'
+# OSTree.ObjectType.FILE, the type of the entries without one
+OBJECT_TYPE_FILE = 1
+# space left free after the update on each filesystem, in bytes
+FREE_MARGIN = 32 * 1024 * 1024
+
+
+def read_varint(data, offset):
+    """ Returns (value, next offset) of the unsigned LEB128 integer at data[offset]. """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def parse_sizes(entries):
+    """
+    Returns the objects listed by the ostree.sizes metadata of a commit, as (checksum, object type, archived size,
+    unpacked size) tuples, the type being an OSTree.ObjectType value.
+
+    Each entry is the binary checksum of an object and its archived and unpacked sizes as varints, followed by its
+    type since OSTree 2020.1 (the older entries only list content objects).
+
+    :param list entries: Unpacked ostree.sizes metadata (a(ayay)), (checksum, data) byte strings.
+    :raises ValueError: The metadata is malformed.
+    """
+    objects = []
+    for checksum, data in entries:
+        checksum, data = bytes(checksum), bytes(data)
+        if len(checksum) != 32:
+            raise ValueError("Malformed {} entry".format(METADATA_SIZES))
+        archived, offset = read_varint(data, 0)
+        unpacked, offset = read_varint(data, offset)
+        objtype = data[offset] if offset < len(data) else OBJECT_TYPE_FILE
+        objects.append((checksum.hex(), objtype, archived, unpacked))
+    return objects
+
+
+def free_space(path):
+    """ Returns (device, bytes available to the daemon) of the filesystem holding path. """
+    stat = os.statvfs(path)
+    return os.stat(path).st_dev, stat.f_bavail * stat.f_frsize
+
+
+class UpdatePlan(object):
+    """ Estimate of the data moved by a deployment, made before pulling anything.
+
+    Each chunk adds the objects of its target commit missing from its local repository (see add()): the bytes to
+    download (archived sizes) and the disk space they take once stored (unpacked sizes). The objects shared by
+    several chunks of a repository count once, and the space needed is summed per filesystem, /apps and /ostree
+    being the same one on some targets. A chunk whose commit lists no sizes is reported as unknown and left out of
+    the estimate.
+
+    :param int margin: Space to leave free on each filesystem, in bytes.
+    """
+
+    def __init__(self, margin=FREE_MARGIN):
+        self.margin = margin
+        self.chunks = []
+        # {repository path: set of checksums}, the objects already counted
+        self.counted = {}
+        # {device: [bytes needed, bytes available, paths]}
+        self.filesystems = {}
+
+    def add(self, name, repo, repo_path, objects):
+        """
+        Add a chunk to the plan.
+
+        :param string name: Name of the chunk.
+        :param OSTree.Repo repo: Local repository the chunk is pulled into.
+        :param string repo_path: Path of the repository.
+        :param list objects: Objects of the target commit (see parse_sizes()), None if unknown.
+        """
+        if objects is None:
+            self.chunks.append({'name': name, 'known': False})
+            return
+        counted = self.counted.setdefault(repo_path, set())
+        missing = download = disk = 0
+        for checksum, objtype, archived, unpacked in objects:
+            if checksum in counted:
+                continue
+            counted.add(checksum)
+            if repo.has_object(objtype, checksum, None)[1]:
+                continue
+            missing += 1
+            download += archived
+            disk += unpacked
+        self.chunks.append({'name': name, 'known': True, 'objects': len(objects), 'missing': missing,
+                            'download': download, 'disk': disk})
+
+        device, available = free_space(repo_path)
+        filesystem = self.filesystems.setdefault(device, [0, available, []])
+        filesystem[0] += disk
+        if repo_path not in filesystem[2]:
+            filesystem[2].append(repo_path)
+
+    def shortages(self):
+        """ Returns the filesystems the deployment does not fit in, as (paths, bytes needed, bytes available). """
+        return [(paths, needed, available) for needed, available, paths in self.filesystems.values()
+                if needed and needed + self.margin > available]
+
+    def fits(self):
+        return not self.shortages()
+
+    def download_sizes(self):
+        """ Returns the bytes to download per chunk name, for the chunks whose size is known. """
+        return {chunk['name']: chunk['download'] for chunk in self.chunks if chunk['known']}
+
+    def summary(self):
+        """ Returns the plan as feedback details, one line per chunk and per shortage. """
+        lines = []
+        for chunk in self.chunks:
+            if chunk['known']:
+                lines.append("Plan {}: {}/{} objects missing, {} to download, {} on disk".format(
+                    chunk['name'], chunk['missing'], chunk['objects'], format_bytes(chunk['download']),
+                    format_bytes(chunk['disk'])))
+            else:
+                lines.append("Plan {}: size unknown".format(chunk['name']))
+        for paths, needed, available in self.shortages():
+            lines.append("Plan: {} needs {}, {} available".format(
+                ', '.join(paths), format_bytes(needed + self.margin), format_bytes(available)))
+        return lines
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+from threading import Lock
+
+from rauc_hawkbit.ddi.deployment_base import (
+    DeploymentStatusExecution, DeploymentStatusResult)
+
+# minimum delay between two pull progress feedbacks, in seconds
+PROGRESS_INTERVAL = 10
+
+
+def format_bytes(value):
+    for unit in ('B', 'kB', 'MB'):
+        if value < 1000:
+            return "{:.1f} {}".format(value, unit)
+        value /= 1000.0
+    return "{:.1f} GB".format(value)
+
+
+class ProgressReporter(object):
+    """
+    Forwards the progress of a deployment to HawkBit as 'proceeding' feedbacks ('download' ones while only
+    downloading), whose percentage covers the whole deployment: each chunk weighs the same, and the chunk being pulled counts for its fraction of fetched objects.
+
+    The OSTree pull progress is reported from the worker thread doing the pull; it is rate limited to one feedback
+    every `interval` seconds. The completion of each chunk is always reported.
+
+    :param DeploymentBaseAction action: Action of the deployment (self.ddi.deploymentBase[action_id]).
+    :param int chunks_qty: Number of chunks of the deployment.
+    :param loop: Event loop running the DDI client.
+    :param float interval: Minimum delay between two pull progress feedbacks, in seconds.
+    :param DeploymentStatusExecution execution: Execution status of the feedbacks.
+    """
+
+    def __init__(self, action, chunks_qty, loop, interval=PROGRESS_INTERVAL,
+                 execution=DeploymentStatusExecution.proceeding):
+        self.logger = logging.getLogger('fullmetalupdate_hawkbit')
+        self.action = action
+        self.chunks_qty = max(chunks_qty, 1)
+        self.loop = loop
+        self.interval = interval
+        self.execution = execution
+        self.done = 0
+        self.current = None
+        self.last_sent = 0
+        self.pending = []
+        self.lock = Lock()
+
+    def percentage(self, fraction=0.0):
+        return int(100 * (self.done + min(fraction, 1.0)) / self.chunks_qty)
+
+    def chunk_started(self, name):
+        """
+        Called before processing a chunk.
+
+        :param string name: Name of the chunk.
+        """
+        with self.lock:
+            self.current = name
+
+    def chunk_done(self, name, status_update):
+        """
+        Called once a chunk has been processed (pulled, checked out...).
+
+        :param string name: Name of the chunk.
+        :param boolean status_update: Result of the chunk update.
+        """
+        with self.lock:
+            self.done += 1
+            self.current = None
+            percentage = self.percentage()
+        self.send("{} {} ({}/{})".format(name, 'ready' if status_update else 'failed',
+                                         self.done, self.chunks_qty), percentage)
+
+    def pull_progress(self, status):
+        """
+        Callback given to AsyncUpdater.pull_ostree_ref(), called from the worker thread on each OSTree progress change.
+
+        :param dictionnary status: Pull status, see AsyncUpdater.on_pull_progress().
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sent < self.interval:
+                return
+            self.last_sent = now
+            fraction = status['fetched'] / status['requested'] if status['requested'] else 0.0
+            percentage = self.percentage(fraction)
+            name = self.current
+        self.send("Pulling {}: {}/{} objects, {} at {}/s".format(
+            name, status['fetched'], status['requested'],
+            format_bytes(status['bytes_transferred']), format_bytes(status['bytes_sec'])), percentage)
+
+    def send(self, detail, percentage):
+        """
+        Post a progress feedback, from any thread.
+        """
+        coro = self.action.feedback(self.execution,
+                                    DeploymentStatusResult.none, [detail],
+                                    percentage={"cnt": percentage, "of": 100})
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self.check_feedback)
+        with self.lock:
+            self.pending.append(future)
+
+    def check_feedback(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            # progress is informative, a lost feedback must not fail the deployment
+            self.logger.warning("Progress feedback failed ({})".format(future.exception()))
+
+    async def flush(self):
+        """
+        Wait for the feedbacks in flight, so that none of them reaches the server after the final feedback.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            await asyncio.wait([asyncio.wrap_future(f) for f in pending])
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import logging
+import os
+import subprocess
+
+# from the fastest to the safest, each one is the fallback of the previous one
+REBOOT_STRATEGIES = ('soft', 'kexec', 'full')
+# finalizes the staged deployment when stopped, normally on the way down
+FINALIZE_UNIT = 'ostree-finalize-staged.service'
+
+
+def find_kernel(deploy_path, bootcsum):
+    """ Returns the (kernel, initramfs) paths of an OSTree deployment, initramfs is None if there is none.
+
+    :param string deploy_path: Root of the deployment.
+    :param string bootcsum: Boot checksum of the deployment, naming its kernel in the legacy layouts.
+    :raises FileNotFoundError: The deployment has no kernel.
+    """
+    for kernel in sorted(glob.glob(deploy_path + '/usr/lib/modules/*/vmlinuz')):
+        initramfs = os.path.join(os.path.dirname(kernel), 'initramfs.img')
+        return kernel, initramfs if os.path.exists(initramfs) else None
+    for boot_dir in ('/usr/lib/ostree-boot', '/boot'):
+        kernel = '{}{}/vmlinuz-{}'.format(deploy_path, boot_dir, bootcsum)
+        if os.path.exists(kernel):
+            initramfs = '{}{}/initramfs-{}.img'.format(deploy_path, boot_dir, bootcsum)
+            return kernel, initramfs if os.path.exists(initramfs) else None
+    raise FileNotFoundError("No kernel found in {}".format(deploy_path))
+
+
+class Rebooter(object):
+    """ Boots the staged OS deployment, with the fastest allowed strategy:
+        - 'soft': systemd soft-reboot, only the userspace restarts, into the staged deployment. Only possible when
+          the staged deployment has the kernel and initramfs of the booted one (same boot checksum) ;
+        - 'kexec': the staged deployment is finalized, then its kernel is booted directly with the arguments of its
+          bootloader entry, without the firmware and U-Boot ;
+        - 'full': regular reboot.
+    A strategy which fails falls back to the next one. check_for_rollback() compares the booted revision after the
+    reboot as usual.
+
+    U-Boot runs the trial boot of a new OS: before booting a new deployment it clears success and sets init_var, and
+    a boot finding success still cleared with init_var set boots the previous deployment instead. The fast
+    strategies skip U-Boot, so they arm the trial the same way themselves, in one write of the environment, right
+    before going down (see boot_unit()). The new OS sets success again once it runs the client
+    (mark_os_successful()). If it hangs instead, the next boot through U-Boot, after a watchdog reset or a power
+    cycle, rolls back to the previous deployment as after a failed full reboot; as with a full reboot, a hang only
+    ends with a reset if a hardware watchdog is armed (systemd RuntimeWatchdogSec).
+
+    :param AsyncUpdater updater: Updater of the primary target, owning the sysroot, the boot environment and the
+        systemd connection.
+    :param string strategy: Fastest strategy to try, see REBOOT_STRATEGIES.
+    :raises ValueError: The strategy is unknown.
+    """
+
+    def __init__(self, updater, strategy='full'):
+        if strategy not in REBOOT_STRATEGIES:
+            raise ValueError("Unknown reboot strategy {!r}, expected one of {}".format(
+                strategy, ', '.join(REBOOT_STRATEGIES)))
+        self.logger = logging.getLogger('fullmetalupdate_container_updater')
+        self.updater = updater
+        self.strategy = strategy
+
+    def strategies(self, staged, booted):
+        """ Returns the strategies to try, the fastest first. """
+        strategies = list(REBOOT_STRATEGIES[REBOOT_STRATEGIES.index(self.strategy):])
+        if staged is None or booted is None:
+            return ['full']
+        if 'soft' in strategies and staged.get_bootcsum() != booted.get_bootcsum():
+            self.logger.info("The staged deployment changes the kernel, no soft-reboot")
+            strategies.remove('soft')
+        return strategies
+
+    def reboot(self):
+        """ Boot the staged deployment. Returns only if every strategy failed. """
+        staged, booted = self.updater.get_boot_deployments()
+
+        for strategy in self.strategies(staged, booted):
+            self.logger.info("Rebooting ({})".format(strategy))
+            try:
+                if strategy == 'soft':
+                    self.soft_reboot()
+                elif strategy == 'kexec':
+                    self.kexec(staged)
+                else:
+                    subprocess.run("reboot", check=True)
+                return
+            except Exception as e:
+                self.logger.error("Reboot ({}) failed: {}".format(strategy, e))
+
+    def soft_reboot(self):
+        # the staged deployment is the first one, ostree mounts it on /run/nextroot for systemd
+        subprocess.run(['ostree', 'admin', 'prepare-soft-reboot', '0'], stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+        self.boot_unit('soft-reboot.target')
+
+    def kexec(self, staged):
+        """ Finalize the staged deployment, load its kernel with the arguments of its bootloader entry, then go down
+        through kexec.target. Without a finalized entry, the root of the deployment is unknown and the strategy fails.
+        """
+        subprocess.run(['systemctl', 'stop', FINALIZE_UNIT], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       check=True)
+        deploy_path, options = self.updater.get_finalized_entry(staged)
+        kernel, initramfs = find_kernel(deploy_path, staged.get_bootcsum())
+
+        command = ['kexec', '-l', kernel, '--append=' + options]
+        if initramfs is not None:
+            command.append('--initrd=' + initramfs)
+        subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        self.boot_unit('kexec.target')
+
+    def boot_unit(self, unit):
+        """
+        Arm the trial boot of the new OS, then start the unit going down. The previous values of the variables are
+        written back if the unit could not be started, so that the next strategy is not taken for a failed trial.
+
+        :param string unit: Target of the reboot.
+        """
+        bootenv = self.updater.bootenv
+        previous = {name: bootenv.get(name) for name in ('success', 'init_var')}
+        with bootenv.transaction():
+            bootenv.set('success', '0')
+            bootenv.set('init_var', '1')
+        try:
+            self.updater.systemd.StartUnit(unit, 'replace-irreversibly')
+        except Exception:
+            with bootenv.transaction():
+                for name, value in previous.items():
+                    bootenv.set(name, value)
+            raise
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import stat
+import time
+
+import gi
+
+gi.require_version("OSTree", "1.0")
+from gi.repository import OSTree, GLib, Gio
+
+from fullmetalupdate.metrics import METRICS
+
+PATH_SCRUB_STATE = '/var/local/fullmetalupdate/scrub_state.json'
+# bytes verified per second, and duration of a scrub step, in seconds
+SCRUB_RATE = 1024 * 1024
+SCRUB_STEP = 5
+# checksums of the repaired objects remembered to detect the checkouts still linking their corrupt copy
+REPAIRED_MAX = 1000
+# problems recorded per checkout
+PROBLEMS_MAX = 10
+
+OBJECT_TYPES = {
+    'file': OSTree.ObjectType.FILE,
+    'dirtree': OSTree.ObjectType.DIR_TREE,
+    'dirmeta': OSTree.ObjectType.DIR_META,
+    'commit': OSTree.ObjectType.COMMIT,
+}
+TREE_ATTRIBUTES = 'standard::name,standard::type,standard::size,standard::symlink-target'
+
+
+class Scrubber(object):
+    """ Background verification of the containers repository and of the containers checkouts.
+
+    Each call to step() works for at most step_duration seconds at rate bytes per second, so that it can run
+    between two polls without delaying a deployment nor competing with the containers for the I/O. The position
+    reached is saved, the next step resumes from it:
+        - the 'objects' phase checks the checksum of each object of the repository ;
+        - the 'checkouts' phase compares each PATH_APPS/<container> checkout with its commit.
+
+    Corrupt objects are repaired by repair(), a separate job run after the step which found them as its pulls do not
+    fit in a step: they are deleted, the commits are marked partial and the kept ones pulled again, which fetches the
+    deleted objects before a deployment needs them.
+
+    :param AsyncUpdater updater: Updater owning the containers repository.
+    :param string repo_path: Path of the containers repository.
+    :param string apps_path: Directory of the containers checkouts.
+    :param int rate: Bytes verified per second.
+    :param float step_duration: Duration of a step, in seconds.
+    :param string path: File storing the scrub position and results.
+    """
+
+    def __init__(self, updater, repo_path, apps_path, rate=SCRUB_RATE, step_duration=SCRUB_STEP,
+                 path=PATH_SCRUB_STATE):
+        self.logger = logging.getLogger('fullmetalupdate_scrub')
+        self.updater = updater
+        self.repo = updater.repo_containers
+        self.repo_path = repo_path
+        self.apps_path = apps_path
+        self.rate = rate
+        self.step_duration = step_duration
+        self.path = path
+        self.state = self.load()
+
+    def load(self):
+        state = {'phase': 'objects', 'cursor': '', 'corrupt': [], 'broken_checkouts': {},
+                 'found': [], 'repaired': [], 'last_pass': None, 'repair_pending': False}
+        try:
+            with open(self.path, 'r') as f:
+                state.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+        return state
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.state, f)
+        except IOError as e:
+            self.logger.error("Writing scrub state failed ({})".format(e))
+
+    def attributes(self):
+        """ Returns the scrub results as configData attributes. """
+        return {'scrub.last_pass': self.state['last_pass'] or 'never',
+                'scrub.corrupt_objects': str(len(self.state['corrupt'])),
+                'scrub.repaired_objects': str(len(self.state['repaired'])),
+                'scrub.broken_checkouts': ','.join(sorted(self.state['broken_checkouts'])) or 'none'}
+
+    def objects_after(self, cursor):
+        """ Yields the (relative path, checksum, object type) of the objects following cursor, in order. """
+        objects_path = os.path.join(self.repo_path, 'objects')
+        try:
+            prefixes = sorted(os.listdir(objects_path))
+        except FileNotFoundError:
+            return
+        for prefix in prefixes:
+            if prefix < cursor[:2]:
+                continue
+            for name in sorted(os.listdir(os.path.join(objects_path, prefix))):
+                relpath = prefix + '/' + name
+                if relpath <= cursor:
+                    continue
+                checksum, _, extension = name.partition('.')
+                if extension in OBJECT_TYPES:
+                    yield (relpath, prefix + checksum, OBJECT_TYPES[extension])
+
+    def throttle(self, start, verified):
+        """ Sleep so that the verified bytes do not exceed self.rate. """
+        ahead = verified / self.rate - (time.monotonic() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def step(self):
+        """
+        Scrub for step_duration seconds, from the saved position.
+
+        :returns: True if the results changed (problems found or repaired), so that they must be reported.
+        """
+        start = time.monotonic()
+        verified = 0
+        changed = False
+        objects = None
+        while time.monotonic() - start < self.step_duration:
+            if self.state['phase'] == 'objects':
+                if objects is None:
+                    objects = self.objects_after(self.state['cursor'])
+                item = next(objects, None)
+                if item is None:
+                    changed |= self.end_objects_phase()
+                    continue
+                relpath, checksum, objtype = item
+                verified += self.verify_object(relpath, checksum, objtype)
+                self.state['cursor'] = relpath
+            else:
+                containers = sorted(name for name in os.listdir(self.apps_path)
+                                    if self.updater.get_checkout_revision(name) is not None)
+                remaining = [name for name in containers if name > self.state['cursor']]
+                if not remaining:
+                    changed |= self.end_checkouts_phase()
+                    break
+                changed |= self.verify_checkout(remaining[0])
+                self.state['cursor'] = remaining[0]
+            self.throttle(start, verified)
+        METRICS.inc('fmu_scrub_verified_bytes_total', verified)
+        self.save()
+        return changed
+
+    def verify_object(self, relpath, checksum, objtype):
+        """ Check the checksum of an object, returns its size. """
+        path = os.path.join(self.repo_path, 'objects', relpath)
+        try:
+            size = os.lstat(path).st_size
+        except FileNotFoundError:
+            # pruned meanwhile
+            return 0
+        try:
+            self.repo.fsck_object(objtype, checksum, None)
+        except GLib.Error as e:
+            if os.path.exists(path):
+                self.logger.error("Object {} is corrupt ({})".format(relpath, e))
+                self.state['found'].append(relpath)
+        return size
+
+    def end_objects_phase(self):
+        """ Schedule the repair of the corrupt objects found during the pass, then move on to the checkouts. """
+        changed = set(self.state['found']) != set(self.state['corrupt'])
+        self.state['corrupt'] = self.state['found']
+        self.state['found'] = []
+        if self.state['corrupt']:
+            self.state['repair_pending'] = True
+        self.state['phase'] = 'checkouts'
+        self.state['cursor'] = ''
+        self.state['next_broken_checkouts'] = {}
+        return changed
+
+    def end_checkouts_phase(self):
+        broken = self.state.pop('next_broken_checkouts', {})
+        changed = broken != self.state['broken_checkouts']
+        self.state['broken_checkouts'] = broken
+        self.state['phase'] = 'objects'
+        self.state['cursor'] = ''
+        self.state['last_pass'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.logger.info("Scrub pass done: {} corrupt objects, {} broken checkouts".format(
+            len(self.state['corrupt']), len(broken)))
+        return changed
+
+    def repair_pending(self):
+        return bool(self.state.get('repair_pending'))
+
+    def queue_repair(self, relpaths):
+        """ Schedule the repair of objects found corrupt out of a scrub pass (checkout verification). """
+        self.state['corrupt'] = sorted(set(self.state['corrupt']) | set(relpaths))
+        self.state['repair_pending'] = True
+        self.save()
+
+    def repair(self):
+        """
+        Delete the corrupt objects, mark every commit partial and pull the kept revisions again (the previous ones
+        kept for the rollbacks included): the pull fetches the missing objects of a partial commit. Any commit may
+        reference the deleted objects; the ones not pulled again stay partial, so that neither a checkout nor a
+        peer relies on them, until the next prune.
+
+        Unlike step(), the repair is not bounded in time.
+
+        :returns: True if a repair was pending, its results must be reported.
+        """
+        if not self.repair_pending():
+            return False
+        for relpath in self.state['corrupt']:
+            try:
+                os.remove(os.path.join(self.repo_path, 'objects', relpath))
+            except FileNotFoundError:
+                pass
+
+        [_, commits] = self.repo.list_commit_objects_starting_with('', None)
+        for variant in commits:
+            rev = variant.get_child_value(0).get_string()
+            try:
+                self.repo.mark_commit_partial(rev, True)
+            except GLib.Error:
+                pass
+
+        for container_name, revs in self.updater.get_kept_revisions(self.updater.keep_revisions()).items():
+            for rev in revs:
+                try:
+                    self.updater.pull_ostree_ref(True, rev, container_name)
+                except Exception as e:
+                    self.logger.error("Repairing {} ({}) failed ({})".format(container_name, rev, e))
+
+        repaired = []
+        for relpath in self.state['corrupt']:
+            if os.path.exists(os.path.join(self.repo_path, 'objects', relpath)):
+                repaired.append(relpath)
+        self.logger.info("Repaired {} of {} corrupt objects".format(len(repaired), len(self.state['corrupt'])))
+        METRICS.inc('fmu_scrub_repaired_objects_total', len(repaired))
+        self.state['corrupt'] = [relpath for relpath in self.state['corrupt'] if relpath not in repaired]
+        self.state['repaired'] = (self.state['repaired'] + repaired)[-REPAIRED_MAX:]
+        self.state['repair_pending'] = False
+        self.save()
+        return True
+
+    def verify_checkout(self, container_name):
+        """
+        Compare a checkout with its commit: every entry must exist with the same type, the symbolic links must
+        have the same target and the regular files the same size. A file linking an object repaired since its
+        checkout still holds the corrupt data, it is reported too.
+
+        :returns: True if the container became broken.
+        """
+        rev = self.updater.get_checkout_revision(container_name)
+        problems = []
+        try:
+            [_, root, _] = self.repo.read_commit(rev, None)
+            root.ensure_resolved()
+            repaired = set(relpath.replace('/', '').split('.')[0] for relpath in self.state['repaired'])
+            self.compare_tree(root, os.path.join(self.apps_path, container_name), '', repaired, problems)
+        except GLib.Error as e:
+            problems.append("commit {} unreadable ({})".format(rev, e))
+
+        broken = self.state.setdefault('next_broken_checkouts', {})
+        if problems:
+            self.logger.error("Checkout of {} is broken: {}".format(container_name, ', '.join(problems)))
+            broken[container_name] = problems
+        return bool(problems) and container_name not in self.state['broken_checkouts']
+
+    def compare_tree(self, directory, path, relpath, repaired, problems):
+        children = directory.enumerate_children(TREE_ATTRIBUTES, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)
+        for info in children:
+            if len(problems) >= PROBLEMS_MAX:
+                break
+            name = info.get_name()
+            child_relpath = relpath + '/' + name
+            child_path = os.path.join(path, name)
+            try:
+                st = os.lstat(child_path)
+            except FileNotFoundError:
+                problems.append(child_relpath + ' missing')
+                continue
+            file_type = info.get_file_type()
+            if file_type == Gio.FileType.DIRECTORY:
+                if not stat.S_ISDIR(st.st_mode):
+                    problems.append(child_relpath + ' not a directory')
+                else:
+                    self.compare_tree(directory.get_child(name), child_path, child_relpath, repaired, problems)
+            elif file_type == Gio.FileType.SYMBOLIC_LINK:
+                if not stat.S_ISLNK(st.st_mode) or os.readlink(child_path) != info.get_symlink_target():
+                    problems.append(child_relpath + ' symbolic link changed')
+            elif not stat.S_ISREG(st.st_mode) or st.st_size != info.get_size():
+                problems.append(child_relpath + ' modified')
+            elif directory.get_child(name).get_checksum() in repaired:
+                problems.append(child_relpath + ' links a corrupt object')
+        children.close(None)
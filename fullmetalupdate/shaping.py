@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import base64
+import ctypes
+import logging
+import os
+import platform
+import socket
+import time
+
+import aiohttp
+import aiohttp.web
+
+from fullmetalupdate.maintenance import MaintenanceWindow
+
+# bytes the bucket can hold, i.e. the largest burst above the rate
+BUCKET_BURST = 256 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# default level of the realtime and best-effort classes, as ionice
+IONICE_LEVEL = 4
+# ioprio_set(2) syscall number per architecture, see <asm/unistd.h>
+SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'armv6l': 314,
+                  'riscv64': 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+
+def parse_ionice(ionice):
+    """ Returns the ioprio value of an I/O scheduling class, 'idle', 'best-effort[:<0-7>]' or 'realtime[:<0-7>]'.
+
+    :raises ValueError: The I/O scheduling class is malformed.
+    """
+    ioclass, sep, level = ionice.partition(':')
+    if ioclass not in IONICE_CLASSES:
+        raise ValueError("Unknown I/O scheduling class {!r}".format(ioclass))
+    if ioclass == 'idle':
+        level = 0
+    elif sep:
+        if not level.isdigit() or not 0 <= int(level) <= 7:
+            raise ValueError("Malformed I/O scheduling level {!r}, expected 0 to 7".format(level))
+        level = int(level)
+    else:
+        level = IONICE_LEVEL
+    return (IONICE_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+
+
+def set_thread_priority(nice=0, ionice=''):
+    """ Set the CPU and I/O priority of the calling thread. Linux schedules them per thread: both calls target
+    the calling thread when given 0 as process id, and the threads and processes it starts afterwards inherit them.
+
+    :param int nice: Nice value, from -20 (highest priority) to 19 (lowest), 0 keeps the default.
+    :param string ionice: I/O scheduling class, see parse_ionice(), empty keeps the default.
+    :raises ValueError: The I/O scheduling class is malformed.
+    :raises OSError: The priority could not be changed.
+    """
+    if nice:
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+    if ionice:
+        ioprio = parse_ionice(ionice)
+        syscall = SYS_IOPRIO_SET.get(platform.machine())
+        if syscall is None:
+            raise OSError("ioprio_set unknown on {}".format(platform.machine()))
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "ioprio_set failed ({})".format(os.strerror(errno)))
+
+
+class BandwidthProfile(object):
+    """ Download bandwidth cap depending on the time of day.
+
+    The profile is a comma separated list of '<window>=<kB/s>' entries, the window being a MaintenanceWindow range
+    or '*' for the rest of the day, e.g. '08:00-18:00=256,*=2048'. The first matching entry applies, 0 means
+    unlimited, and so does a time matching no entry.
+
+    :param string spec: Entries of the profile.
+    :raises ValueError: The profile is malformed.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.entries = []
+        for item in spec.split(','):
+            window, sep, rate = item.strip().rpartition('=')
+            if not sep:
+                raise ValueError("Malformed bandwidth profile entry {!r}, expected <window>=<kB/s>".format(item))
+            self.entries.append((None if window.strip() == '*' else MaintenanceWindow(window.strip()),
+                                 int(rate) * 1024))
+
+    def __str__(self):
+        return self.spec
+
+    def rate(self, now=None):
+        """ Returns the current cap in bytes per second, 0 if unlimited. """
+        for window, rate in self.entries:
+            if window is None or window.is_open(now):
+                return rate
+        return 0
+
+
+class TokenBucket(object):
+    """ Token bucket shared by the downloads of the event loop, refilled at the rate of a BandwidthProfile.
+
+    :param BandwidthProfile profile: Cap of the downloads.
+    :param int burst: Bytes the bucket can hold.
+    """
+
+    def __init__(self, profile, burst=BUCKET_BURST):
+        self.profile = profile
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    async def consume(self, size):
+        """ Wait until size bytes can be downloaded. """
+        rate = self.profile.rate()
+        now = time.monotonic()
+        if not rate:
+            self.tokens = self.burst
+            self.last = now
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens < 0:
+            # the debt is paid by sleeping, the next consumers wait behind it
+            await asyncio.sleep(-self.tokens / rate)
+
+
+class ShapingProxy(object):
+    """ Local HTTP proxy capping the bandwidth of the OSTree pulls, which have no rate limit of their own.
+
+    The OSTree pulls are given wrap(<upstream>) as override-url, the repository config is left alone as the port
+    changes on each start: libostree fetches the objects from the proxy over the loopback, the proxy fetches them
+    from the upstream with a pooled session and forwards the bodies at the pace of the token bucket. The proxy runs
+    on the event loop, the pulls must run in another thread.
+
+    :param TokenBucket bucket: Bucket shared with the other downloads.
+    :param aiohttp.ClientSession session: Session used to reach the upstreams.
+    """
+
+    def __init__(self, bucket, session, host='127.0.0.1'):
+        self.logger = logging.getLogger('fullmetalupdate_container_updater')
+        self.bucket = bucket
+        self.session = session
+        self.host = host
+        self.port = None
+        self.runner = None
+
+    def wrap(self, url):
+        """ Returns the proxy URL forwarding to url. """
+        upstream = base64.urlsafe_b64encode(url.rstrip('/').encode('utf-8')).decode('ascii')
+        return 'http://{}:{}/{}'.format(self.host, self.port, upstream)
+
+    async def handle(self, request):
+        try:
+            upstream = base64.urlsafe_b64decode(request.match_info['upstream']).decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            raise aiohttp.web.HTTPNotFound()
+        url = upstream + '/' + request.match_info['path']
+        response = None
+        try:
+            async with self.session.get(url) as upstream_response:
+                response = aiohttp.web.StreamResponse(status=upstream_response.status)
+                if upstream_response.content_length is not None:
+                    response.content_length = upstream_response.content_length
+                await response.prepare(request)
+                while True:
+                    chunk = await upstream_response.content.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await self.bucket.consume(len(chunk))
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning("Shaping proxy: fetching {} failed ({})".format(url, e))
+            if response is None or not response.prepared:
+                raise aiohttp.web.HTTPBadGateway()
+            # the headers are gone, libostree sees a truncated body and retries the pull
+            if request.transport is not None:
+                request.transport.close()
+            return response
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/{upstream}/{path:.*}', self.handle)
+        self.runner = aiohttp.web.AppRunner(app)
+        await self.runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        self.port = sock.getsockname()[1]
+        site = aiohttp.web.SockSite(self.runner, sock)
+        await site.start()
+        self.logger.info("Capping the OSTree pulls through port {} ({})".format(self.port, self.bucket.profile))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
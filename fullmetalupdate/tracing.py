@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+
+PATH_TRACES = '/var/local/fullmetalupdate/traces.json'
+TRACES_MAX_BYTES = 1024 * 1024
+TRACES_BACKUP_COUNT = 3
+
+_handlers_lock = Lock()
+
+
+def _trace_logger(path):
+    """ Returns the logger writing the traces, one JSON document per line, in a rotating file. The handler is only
+    created once per file, even when several tracers (gateway mode) write to it.
+    """
+    logger = logging.getLogger('fullmetalupdate_traces.' + path)
+    with _handlers_lock:
+        if not logger.handlers:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=TRACES_MAX_BYTES,
+                                                           backupCount=TRACES_BACKUP_COUNT)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+    return logger
+
+
+class Span(object):
+    """ Timed step of a deployment.
+
+    :param string name: Name of the step.
+    :param dictionnary attributes: Attributes of the step (container, rev, bytes...).
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.children = []
+        self.lock = Lock()
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_child(self, span):
+        with self.lock:
+            self.children.append(span)
+
+    def as_dict(self):
+        return {'name': self.name,
+                'start': round(self.start, 3),
+                'end': round(self.end, 3) if self.end is not None else None,
+                'attributes': self.attributes,
+                'children': [child.as_dict() for child in self.children]}
+
+
+class Tracer(object):
+    """ Builds the span tree of a deployment, from process_deployment down to the notify verdicts, and writes it to a
+    rotating JSON file when the deployment is over.
+
+    Spans opened in the same thread are nested automatically; threads started during a deployment pass their parent
+    span explicitly.
+
+    :param string path: Path of the traces file.
+    """
+
+    def __init__(self, path=PATH_TRACES):
+        self.path = path
+        self.root = None
+        self.stacks = local()
+
+    def _stack(self):
+        if not hasattr(self.stacks, 'spans'):
+            self.stacks.spans = []
+        return self.stacks.spans
+
+    def current(self):
+        """ Returns the innermost open span of the calling thread, or the root span. """
+        stack = self._stack()
+        return stack[-1] if stack else self.root
+
+    def start_trace(self, name, **attributes):
+        """ Start the span tree of a new deployment.
+
+        :param string name: Name of the root span.
+        :returns: The root span.
+        """
+        self.root = Span(name, **attributes)
+        return self.root
+
+    def finish_trace(self):
+        """ Close the current span tree and write it to the traces file.
+
+        :returns: The root span, or None if no trace was started.
+        """
+        root, self.root = self.root, None
+        if root is None:
+            return None
+        root.end = time.time()
+        try:
+            _trace_logger(self.path).info(json.dumps(root.as_dict(), default=str))
+        except (IOError, OSError) as e:
+            logging.getLogger('fullmetalupdate_container_updater').error(
+                "Writing deployment trace failed ({})".format(e))
+        return root
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """ Context manager timing a step of the deployment.
+
+        :param string name: Name of the step.
+        :param Span parent: Parent span, defaults to current().
+        :returns: The new span, whose attributes can be completed with Span.set().
+        """
+        span = Span(name, **attributes)
+        parent = parent or self.current()
+        if parent is not None:
+            parent.add_child(span)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=str(e))
+            raise
+        finally:
+            span.end = time.time()
+            stack.remove(span)
+
+    def wrap(self, func):
+        """ Bind a function to the current span, so that the spans it opens from another thread (executor) are
+        attached to it.
+
+        :param callable func: Function to call from another thread.
+        """
+        parent = self.current()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self._stack()
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def annotate(self, **attributes):
+        """ Add attributes to the innermost open span, if any. """
+        span = self.current()
+        if span is not None:
+            span.set(**attributes)
+
+    @staticmethod
+    def summary(root):
+        """ Summarize a span tree for the HawkBit feedback details.
+
+        :param Span root: Root span of a deployment.
+        :returns: One line per first level step, with the duration of its own steps.
+        """
+        if root is None:
+            return []
+        lines = ["Timeline: {} took {:.1f}s".format(root.name, root.duration)]
+        for span in root.children:
+            label = span.name
+            if 'container' in span.attributes:
+                label += ' ' + str(span.attributes['container'])
+            steps = ', '.join('{} {:.1f}s'.format(child.name, child.duration) for child in span.children)
+            lines.append(" - {} {:.1f}s{}".format(label, span.duration, ' (' + steps + ')' if steps else ''))
+        return lines
+
+
+def traced(name):
+    """ Decorator opening a span around a method of an object holding a ``tracer`` attribute.
+
+    :param string name: Name of the span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+import uuid
+from threading import Event, Thread
+
+from fullmetalupdate.metrics import METRICS
+
+# entries deleted between two pauses of the reaper, and length of the pause in seconds
+REAP_BATCH = 500
+REAP_PAUSE = 0.1
+
+
+class TrashReaper(object):
+    """ Deferred deletion of the container directories.
+
+    A directory is moved to the trash with a rename, which is instantaneous as the trash lives on the same
+    filesystem; a background thread deletes the content of the trash later, by batches of REAP_BATCH entries
+    separated by a pause so that it does not compete with the containers for the I/O. The trash is emptied again
+    at start, so that the deletions interrupted by a restart are completed.
+
+    :param string path: Trash directory, on the same filesystem as the directories moved to it.
+    :param int batch: Entries deleted between two pauses.
+    :param float pause: Pause between two batches, in seconds.
+    """
+
+    def __init__(self, path, batch=REAP_BATCH, pause=REAP_PAUSE):
+        self.logger = logging.getLogger('fullmetalupdate_container_updater')
+        self.path = path
+        self.batch = batch
+        self.pause = pause
+        self.wakeup = Event()
+        os.makedirs(self.path, exist_ok=True)
+        self.thread = Thread(target=self.run, name='trash-reaper', daemon=True)
+        self.thread.start()
+
+    def move(self, path):
+        """ Move a directory to the trash, its content is deleted in the background.
+
+        :param string path: Directory to delete.
+        """
+        name = '{}-{}'.format(os.path.basename(path.rstrip('/')), uuid.uuid4().hex[:8])
+        os.makedirs(self.path, exist_ok=True)
+        os.rename(path, os.path.join(self.path, name))
+        self.logger.info("Moved {} to the trash".format(path))
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                names = sorted(os.listdir(self.path))
+            except FileNotFoundError:
+                # the trash was removed, move() creates it again
+                names = []
+            for name in names:
+                try:
+                    self.reap(os.path.join(self.path, name))
+                except OSError as e:
+                    self.logger.error("Deleting {} from the trash failed ({})".format(name, e))
+            self.wakeup.wait()
+
+    def reap(self, path):
+        """ Delete a trashed directory, by batches. An entry already gone is skipped. """
+        start = time.monotonic()
+        if not os.path.lexists(path):
+            return
+        if os.path.islink(path):
+            os.unlink(path)
+            return
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                os.unlink(os.path.join(dirpath, name))
+            for name in dirnames:
+                entry = os.path.join(dirpath, name)
+                # os.walk lists the symbolic links to directories with the directories
+                if os.path.islink(entry):
+                    os.unlink(entry)
+                else:
+                    os.rmdir(entry)
+            count += len(filenames) + len(dirnames)
+            if count >= self.batch:
+                METRICS.inc('fmu_trash_deleted_entries_total', count)
+                count = 0
+                time.sleep(self.pause)
+        if os.path.isdir(path):
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+        METRICS.inc('fmu_trash_deleted_entries_total', count + 1)
+        self.logger.info("Deleted {} from the trash in {:.1f}s".format(os.path.basename(path),
+                                                                     time.monotonic() - start))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+
+
+class TriggerServer(object):
+    """
+    Local UNIX socket used to request an immediate poll of the HawkBit server, without waiting for the end of the
+    polling interval.
+
+    The protocol is line based: a client sends ``poll`` to wake up every target, or ``poll <controller id>`` to wake
+    up a single one, and receives ``ok`` or ``error: <reason>``. For instance::
+
+        echo poll | socat - UNIX-CONNECT:/tmp/fullmetalupdate/fullmetalupdate_trigger.sock
+
+    :param string path: Path of the UNIX socket.
+    :param dictionnary schedulers: PollScheduler of each target, indexed by controller id.
+    """
+
+    def __init__(self, path, schedulers):
+        self.logger = logging.getLogger('fullmetalupdate_trigger')
+        self.path = path
+        self.schedulers = schedulers
+        self.server = None
+
+    async def start(self):
+        """
+        Bind the socket and start serving requests.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        os.chmod(self.path, 0o660)
+        self.logger.info("Listening for poll triggers on {}".format(self.path))
+
+    def close(self):
+        """
+        Stop serving requests and remove the socket.
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def handle_request(self, line):
+        """
+        Execute a request.
+
+        :param string line: Request received on the socket.
+        :returns: Answer to send back.
+        """
+        words = line.split()
+        if not words or words[0] != 'poll' or len(words) > 2:
+            return "error: unknown request"
+
+        if len(words) == 1:
+            targets = list(self.schedulers.values())
+        elif words[1] in self.schedulers:
+            targets = [self.schedulers[words[1]]]
+        else:
+            return "error: unknown target {}".format(words[1])
+
+        for scheduler in targets:
+            scheduler.trigger()
+        return "ok"
+
+    async def handle_client(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            answer = self.handle_request(line.decode('utf-8', 'replace'))
+            self.logger.debug("Trigger request {} -> {}".format(line.strip(), answer))
+            writer.write((answer + '\n').encode('utf-8'))
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.logger.warning("Trigger request failed ({})".format(e))
+        finally:
+            writer.close()
@@ -3,29 +3,143 @@
 import logging
 import os
 import shutil
-import subprocess
+import stat
 import json
+import re
+import time
 import gi
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
 
 gi.require_version("OSTree", "1.0")
 from gi.repository import OSTree, GLib, Gio
 from pydbus import SystemBus
 
+from fullmetalupdate.bootenv import BootEnvError, UBootEnv
+from fullmetalupdate.metrics import METRICS, timed
+from fullmetalupdate.mirrors import MirrorSet
+from fullmetalupdate.ordering import AFTER_PROPERTIES
+from fullmetalupdate.peers import PEER_MAX_ATTEMPTS, PeerSet
+from fullmetalupdate.plan import METADATA_SIZES, parse_sizes
+from fullmetalupdate.scrub import SCRUB_STEP, Scrubber
+from fullmetalupdate.shaping import set_thread_priority
+from fullmetalupdate.trash import TrashReaper
+from fullmetalupdate.tracing import Tracer, traced
+
 PATH_APPS = '/apps'
 PATH_REPO_OS = '/ostree/repo/'
 PATH_REPO_APPS = PATH_APPS + '/ostree_repo'
 PATH_SYSTEMD_UNITS = '/etc/systemd/system/'
+PATH_TRASH = PATH_APPS + '/.trash'
+# blue/green checkouts, PATH_SLOTS/<container>/<slot>
+PATH_SLOTS = PATH_APPS + '/.slots'
+SLOTS = ('blue', 'green')
+# delay for a blue/green container without notify to become active, in seconds
+SLOT_READY_TIMEOUT = 60
+# container checkouts applied at the reboot into a staged OS, see apply_staged_containers()
+PATH_STAGED = PATH_APPS + '/.staged'
+PATH_STAGED_CONTAINERS = '/var/local/fullmetalupdate/staged_containers.json'
 PATH_CURRENT_REVISIONS = '/var/local/fullmetalupdate/current_revs.json'
+# revisions pulled ahead of their installation, see prefetch_revision()
+PATH_PREFETCHED_REVISIONS = '/var/local/fullmetalupdate/prefetched_revs.json'
+PATH_REVISION_HISTORY = '/var/local/fullmetalupdate/revision_history.json'
+# target of a gateway owning each container, see claim_containers()
+PATH_CONTAINER_OWNERS = '/var/local/fullmetalupdate/container_owners.json'
 VALIDATE_CHECKOUT = 'CheckoutDone'
+# stat index of a checkout, see write_checkout_manifest()
+FILE_MANIFEST = 'CheckoutManifest.json'
 FILE_AUTOSTART = 'auto.start'
 CONTAINER_UID = 1000
 CONTAINER_GID = 1000
 OSTREE_DEPTH = 1
+# a pull whose counters do not move during this delay (seconds) is cancelled and retried
+PULL_STALL_TIMEOUT = 120
+PULL_RETRIES = 3
+# delay before the first retry of a pull, doubled on each retry
+PULL_RETRY_DELAY = 10
+PULL_RETRY_DELAY_MAX = 300
+# local refs pinning the revisions kept by prune_containers_repo()
+REF_KEEP_PREFIX = 'fullmetalupdate/keep/'
+# ref of the OS revision pulled ahead of its installation, protecting it from the sysroot cleanup
+REF_PREFETCH_OS = 'fullmetalupdate/prefetch/os'
+# number of previous revisions kept per container, besides the current one
+KEEP_REVISIONS = 1
+# length of the revision history, the upper bound of the keep-revisions setting
+KEEP_REVISIONS_MAX = 10
 
 class DBUSException(Exception):
     pass
 
 
+def repo_disk_usage(path):
+    """ Returns the disk space used by the objects of an OSTree repository, in bytes.
+
+    :param string path: Path of the repository.
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(os.path.join(path, 'objects')):
+        for fname in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fname)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class PullRetry(Exception):
+    """ Raised by a pull attempt which failed and may be retried, after delay seconds. """
+
+    def __init__(self, error, delay):
+        super(PullRetry, self).__init__(error)
+        self.delay = delay
+
+
+class PullWatchdog(object):
+    """ Watches the counters of an OSTree pull from a separate thread, and cancels the pull when they did not move
+    during stall_timeout seconds (e.g. dead TCP connection).
+
+    :param OSTree.AsyncProgress progress: Progress of the pull.
+    :param Gio.Cancellable cancellable: Cancellable given to the pull.
+    :param float stall_timeout: Delay without progress before cancelling the pull, in seconds.
+    :param boolean stalled: True once the pull has been cancelled by the watchdog.
+    """
+
+    def __init__(self, progress, cancellable, stall_timeout):
+        self.progress = progress
+        self.cancellable = cancellable
+        self.stall_timeout = stall_timeout
+        self.stalled = False
+        self.stopped = Event()
+        self.thread = Thread(target=self.watch, name='ostree-pull-watchdog', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+
+    def counters(self):
+        return (self.progress.get_uint64('bytes-transferred'),
+                self.progress.get_uint('fetched'),
+                self.progress.get_uint('scanned-metadata'))
+
+    def watch(self):
+        last = self.counters()
+        last_change = time.monotonic()
+        interval = min(self.stall_timeout / 4.0, 5)
+        while not self.stopped.wait(interval):
+            counters = self.counters()
+            now = time.monotonic()
+            if counters != last:
+                last, last_change = counters, now
+            elif now - last_change >= self.stall_timeout:
+                self.stalled = True
+                self.cancellable.cancel()
+                return
+
+
 class AsyncUpdater(object):
     """ FullMetalUpdate client updater library.
 
@@ -36,53 +150,93 @@ class AsyncUpdater(object):
         :param OSTree.Sysroot sysroot: Python instance of rootfs (root file system) of the system.
         :param OSTree.Repo repo_containers: Python instance of the OSTree remote repository for containers.
         :param OSTree.Repo repo_os: Python instance of the OSTree remote repository for the OS.
+        :param boolean manages_os: False for the secondary targets of a gateway, which only handle containers.
+        :param Tracer tracer: Builds the timeline of the current deployment.
+        :param MirrorSet mirrors: Mirrors of the OSTree remotes.
+        :param PeerSet peers: Neighbouring devices the commits are pulled from before the origin.
+        :param Scrubber scrubber: Background verification of the containers repository, None when disabled.
+        :param TrashReaper trash: Deletes the removed or replaced container directories in the background.
+        :param BootEnv bootenv: Bootloader environment, written by transactions.
+        :param ShapingProxy shaper: Local proxy capping the bandwidth of the pulls, None when uncapped.
+        :param ThreadPoolExecutor executor: Single worker thread running the blocking update steps (pulls, checkouts,
+            systemd calls) out of the event loop. Shared by all the targets of a gateway, so that they never work on
+            the repositories concurrently.
     """
 
-    def __init__(self):
+    def __init__(self, parent=None, bootenv=None):
         """ Constructor of AsyncUpdater Class.
+
+        :param AsyncUpdater parent: In gateway mode, updater of the primary target whose D-Bus connection, sysroot and
+            OSTree repositories are shared instead of being opened again. The OS is only managed by the primary target.
+        :param BootEnv bootenv: Bootloader environment, the u-boot one by default.
         """
 
         self.ostree_remote_attributes = None
+        self.mirrors = MirrorSet(())
+        self.peers = PeerSet()
+        self.scrubber = None
+        self.shaper = None
 
         self.logger = logging.getLogger('fullmetalupdate_container_updater')
 
-        self.mark_os_successful()
+        self.manages_os = parent is None
+        self.tracer = Tracer()
+
+        if parent is not None:
+            self.executor = parent.executor
+            self.bus = parent.bus
+            self.systemd = parent.systemd
+            self.sysroot = parent.sysroot
+            self.repo_os = parent.repo_os
+            self.remote_name_os = parent.remote_name_os
+            self.repo_containers = parent.repo_containers
+            self.ostree_remote_attributes = parent.ostree_remote_attributes
+            self.mirrors = parent.mirrors
+            self.peers = parent.peers
+            self.scrubber = parent.scrubber
+            self.trash = parent.trash
+            self.bootenv = parent.bootenv
+            self.shaper = parent.shaper
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.trash = TrashReaper(PATH_TRASH)
+            self.bootenv = bootenv if bootenv is not None else UBootEnv()
 
-        bus = SystemBus()
-        self.systemd = bus.get('.systemd1')
+            self.mark_os_successful()
 
-        self.sysroot = OSTree.Sysroot.new_default()
-        self.sysroot.load(None)
-        self.logger.info("Cleaning the sysroot")
-        self.sysroot.cleanup(None)
+            self.bus = SystemBus()
+            self.systemd = self.bus.get('.systemd1')
 
-        [_, repo] = self.sysroot.get_repo()
-        self.repo_os = repo
+            self.sysroot = OSTree.Sysroot.new_default()
+            self.sysroot.load(None)
+            self.logger.info("Cleaning the sysroot")
+            self.sysroot.cleanup(None)
 
-        self.remote_name_os = None
-        self.repo_containers = OSTree.Repo.new(Gio.File.new_for_path(PATH_REPO_APPS))
-        if os.path.exists(PATH_REPO_APPS):
-            self.logger.info("Preinstalled OSTree for containers, we use it")
-            self.repo_containers.open(None)
-        else:
-            self.logger.info("No preinstalled OSTree for containers, we create one")
-            self.repo_containers.create(OSTree.RepoMode.BARE_USER_ONLY, None)
+            [_, repo] = self.sysroot.get_repo()
+            self.repo_os = repo
 
-    def mark_os_successful(self):
-        """ This method marks the currently running OS as successful by setting the init_var u-boot environment variable to 1.
+            self.remote_name_os = None
+            self.repo_containers = OSTree.Repo.new(Gio.File.new_for_path(PATH_REPO_APPS))
+            if os.path.exists(PATH_REPO_APPS):
+                self.logger.info("Preinstalled OSTree for containers, we use it")
+                self.repo_containers.open(None)
+            else:
+                self.logger.info("No preinstalled OSTree for containers, we create one")
+                self.repo_containers.create(OSTree.RepoMode.BARE_USER_ONLY, None)
 
-        :returns: - True if the variable was successfully set
-                  - False otherwise
-        :raises subprocess.CalledProcessError: Exception raised if u-boot environment variable failed to be set up to 1.
+    def mark_os_successful(self):
+        """ This method marks the currently running OS as successful by setting the success u-boot environment variable to 1.
+        The environment is not written when the variable is already set, which is the case of every boot but the first
+        one of a deployment.
         """
         try:
-            if subprocess.call(["fw_setenv", "success", "1"]) == 0:
-                self.logger.info("Setting success u-boot environment variable to 1 succeeded")
+            if self.bootenv.get('success') == '1':
+                self.logger.info("Success u-boot environment variable already set to 1")
             else:
-                self.logger.error("Setting success u-boot environment variable to 1 failed")
-
-        except subprocess.CalledProcessError as e:
-            self.logger.error("Ostree rollback post-process commands failed ({})".format(str(e)))
+                self.bootenv.set('success', '1')
+                self.logger.info("Setting success u-boot environment variable to 1 succeeded")
+        except BootEnvError as e:
+            self.logger.error("Setting success u-boot environment variable to 1 failed ({})".format(e))
 
     def check_for_rollback(self, revision):
         """
@@ -96,7 +250,7 @@ class AsyncUpdater(object):
         :param checksum revision: Checksum of revision stored on OSTree remote repository.
         :returns: - True when the system has rollbacked
                   - False otherwise
-        :raises subprocess.CalledProcessError: Exception raised if rollback post-processing fails.
+        :raises GLib.Error: Exception raised if rollback post-processing fails.
         """
         try:
             has_rollbacked = False
@@ -112,17 +266,28 @@ class AsyncUpdater(object):
                 self.logger.warning("The system rollbacked. Checking if we needed to undeploy")
                 if deployments[0] is not None:
                     self.logger.info("There is a pending deployment. Undeploying...")
-                    # 0 is the index of the pending deployment (if there is one)
-                    if subprocess.call(["ostree", "admin", "undeploy", "0"]) != 0:
-                        self.logger.error("Undeployment failed")
-                    else:
+                    # same as 'ostree admin undeploy 0', without forking: the pending deployment is the first one,
+                    # the sysroot is locked while the deployments are rewritten, then the undeployed tree is removed
+                    pending = (deployments[0].get_csum(), deployments[0].get_deployserial())
+                    try:
+                        self.sysroot.lock()
+                        try:
+                            self.sysroot.load(None)
+                            remaining = [d for d in self.sysroot.get_deployments()
+                                         if (d.get_csum(), d.get_deployserial()) != pending]
+                            self.sysroot.write_deployments(remaining, None)
+                            self.sysroot.cleanup(None)
+                        finally:
+                            self.sysroot.unlock()
                         self.logger.info("Undeployment successful")
+                    except GLib.Error as e:
+                        self.logger.error("Undeployment failed ({})".format(e))
             else:
                 self.logger.info("No undeployment needed")
 
             return has_rollbacked
 
-        except subprocess.CalledProcessError as e:
+        except GLib.Error as e:
             self.logger.error("Ostree rollback post-process commands failed ({})".format(str(e)))
             return False
 
@@ -131,12 +296,31 @@ class AsyncUpdater(object):
         This method initializes the OSTree remote repositories (both OS repo and containers repo).
 
         :param dictionnary ostree_remote_attributes: Dictionnary containing the name, the url and whether the images are signed with GPG or not.
+            The optional 'stall-timeout', 'pull-retries' and 'retry-delay' keys tune the pull retries, see pull_ostree_ref().
+            The optional 'mirrors' key lists the mirrors, see MirrorSet, and 'peers' the configured peers.
+            The optional 'keep-revisions' and 'disk-budget' keys set the pruning policy, see prune_containers_repo().
+            The optional 'scrub-rate' (bytes per second, 0 disables the scrub) and 'scrub-step' keys tune Scrubber.
+            The optional 'worker-nice' and 'worker-ionice' keys set the priority of the worker thread, see
+            set_worker_priority().
+            The optional 'free-margin' key sets the space a deployment leaves free, see UpdatePlan.
         :returns: - True if the initialization is successful
                   - False otherwise
         :raises GLib.Error: Exception raised if OSTree remote repositories initialization fails.
         """
         res = True
         self.ostree_remote_attributes = ostree_remote_attributes
+        self.mirrors = MirrorSet(ostree_remote_attributes.get('mirrors', ()))
+        self.peers = PeerSet(ostree_remote_attributes.get('peers', ()), ostree_remote_attributes.get('peer-token'))
+        if ostree_remote_attributes.get('scrub-rate'):
+            self.scrubber = Scrubber(self, PATH_REPO_APPS, PATH_APPS, ostree_remote_attributes['scrub-rate'],
+                                     ostree_remote_attributes.get('scrub-step', SCRUB_STEP))
+        if ostree_remote_attributes.get('worker-nice') or ostree_remote_attributes.get('worker-ionice'):
+            # applied by the worker thread itself, waited for so that a failure is reported
+            try:
+                self.executor.submit(self.set_worker_priority, ostree_remote_attributes.get('worker-nice', 0),
+                                     ostree_remote_attributes.get('worker-ionice', '')).result()
+            except Exception as e:
+                self.logger.error("Setting the worker priority failed ({})".format(e))
         opts = GLib.Variant('a{sv}', {'gpg-verify': GLib.Variant('b', ostree_remote_attributes['gpg-verify'])})
         try:
             self.logger.info("Initalize remotes for the OS ostree: {}".format(ostree_remote_attributes['name']))
@@ -147,6 +331,8 @@ class AsyncUpdater(object):
             self.remote_name_os = ostree_remote_attributes['name']
 
             [_, refs] = self.repo_containers.list_refs(None, None)
+            # skip the local refs pinning the kept revisions
+            refs = [ref for ref in refs if ':' in ref]
 
             self.logger.info("Initalize remotes for the containers ostree: {}".format(refs))
             for ref in refs:
@@ -163,6 +349,20 @@ class AsyncUpdater(object):
 
         return res
 
+    def set_worker_priority(self, nice, ionice):
+        """
+        This method lowers the CPU and I/O priority of the worker thread, so that the pulls, checkouts and chowns
+        do not compete with the containers. Run in the worker thread itself, see set_thread_priority().
+
+        :param int nice: Nice value of the worker thread.
+        :param string ionice: I/O scheduling class of the worker thread.
+        """
+        try:
+            set_thread_priority(nice, ionice)
+            self.logger.info("Worker priority set (nice {}, I/O class {})".format(nice, ionice or 'default'))
+        except (OSError, ValueError) as e:
+            self.logger.error("Setting the worker priority failed ({})".format(e))
+
     def set_current_revision(self, container_name, rev):
         """
         This method writes rev into a json file containing the current working rev for the containers.
@@ -182,6 +382,187 @@ class AsyncUpdater(object):
                 current_revs = {container_name: rev}
                 json.dump(current_revs, f, indent=4)
 
+        history = self.get_revision_history()
+        revs = [rev] + [r for r in history.get(container_name, []) if r != rev]
+        history[container_name] = revs[:KEEP_REVISIONS_MAX]
+        self.write_revision_history(history)
+
+    def get_revision_history(self):
+        """
+        This method returns the working revisions of the containers, the current one first.
+
+        :returns: Dictionnary {container_name: [rev, previous rev, ...]}
+        """
+        try:
+            with open(PATH_REVISION_HISTORY, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_revision_history(self, history):
+        try:
+            with open(PATH_REVISION_HISTORY, "w") as f:
+                json.dump(history, f, indent=4)
+        except IOError as e:
+            self.logger.error("Writing revision history failed ({})".format(e))
+
+    def forget_container_revisions(self, container_name):
+        """
+        This method drops the revisions of a removed container, so that the next prune reclaims its objects.
+
+        :param string container_name: Name of the container.
+        """
+        history = self.get_revision_history()
+        if history.pop(container_name, None) is not None:
+            self.write_revision_history(history)
+        owners = self.get_container_owners()
+        if owners.pop(container_name, None) is not None:
+            self.write_container_owners(owners)
+        try:
+            with open(PATH_CURRENT_REVISIONS, "r") as f:
+                current_revs = json.load(f)
+            if current_revs.pop(container_name, None) is not None:
+                with open(PATH_CURRENT_REVISIONS, "w") as f:
+                    json.dump(current_revs, f, indent=4)
+        except FileNotFoundError:
+            pass
+
+    def get_container_owners(self):
+        """
+        This method returns the target of a gateway owning each container.
+
+        :returns: Dictionnary {container_name: controller_id}
+        """
+        try:
+            with open(PATH_CONTAINER_OWNERS, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_container_owners(self, owners):
+        try:
+            with open(PATH_CONTAINER_OWNERS, "w") as f:
+                json.dump(owners, f, indent=4)
+        except IOError as e:
+            self.logger.error("Writing container owners failed ({})".format(e))
+
+    def claim_containers(self, controller_id, container_names, primary_target):
+        """
+        This method claims containers for a target of a gateway. The targets share the checkouts, units, notify
+        sockets and revision files of the containers, which are named after the container only: a container is
+        owned by the first target deploying it, until it is removed, and the other targets cannot deploy it. The
+        containers installed before the gateway belong to the primary target.
+
+        :param string controller_id: Target deploying the containers.
+        :param list container_names: Names of the containers.
+        :param string primary_target: Controller id of the primary target.
+        :returns: Dictionnary {container_name: controller_id} of the containers owned by another target, nothing
+            is claimed if it is not empty.
+        """
+        owners = self.get_container_owners()
+        claimed = {}
+        for container_name in container_names:
+            owner = owners.get(container_name)
+            if owner is None and os.path.isdir(PATH_APPS + '/' + container_name):
+                owner = primary_target
+            claimed[container_name] = owner or controller_id
+        conflicts = {name: owner for name, owner in claimed.items() if owner != controller_id}
+        if not conflicts and any(owners.get(name) != owner for name, owner in claimed.items()):
+            owners.update(claimed)
+            self.write_container_owners(owners)
+        return conflicts
+
+    def get_prefetched_revisions(self):
+        """
+        This method returns the revisions of the containers pulled ahead of their installation.
+
+        :returns: Dictionnary {container_name: [rev, ...]}
+        """
+        try:
+            with open(PATH_PREFETCHED_REVISIONS, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_prefetched_revisions(self, prefetched):
+        try:
+            with open(PATH_PREFETCHED_REVISIONS, "w") as f:
+                json.dump(prefetched, f, indent=4)
+        except IOError as e:
+            self.logger.error("Writing prefetched revisions failed ({})".format(e))
+
+    def prefetch_revision(self, is_container, rev, container_name=None, progress_callback=None):
+        """
+        This method pulls a revision ahead of its installation (download only deployments, closed maintenance
+        window). The revision is protected from the prunes until the container is updated, so that the update only
+        checks out objects already in the repository.
+
+        :param boolean is_container: - True to pull a container image
+                                     - False to pull an OS image
+        :param string rev: Commit revision.
+        :param string container_name: Name of the container.
+        :param callable progress_callback: See pull_ostree_ref().
+        """
+        if not is_container:
+            self.pull_ostree_ref(False, rev, progress_callback=progress_callback)
+            self.repo_os.set_ref_immediate(None, REF_PREFETCH_OS, rev, None)
+            return
+        self.init_container_remote(container_name)
+        self.pull_ostree_ref(True, rev, container_name, progress_callback)
+        prefetched = self.get_prefetched_revisions()
+        revs = [rev] + [r for r in prefetched.get(container_name, []) if r != rev]
+        prefetched[container_name] = revs[:KEEP_REVISIONS_MAX]
+        self.write_prefetched_revisions(prefetched)
+
+    def forget_prefetched_revisions(self, container_name=None):
+        """
+        This method releases the prefetched revisions of a container once it is updated, or the prefetched OS
+        revision once it is staged.
+
+        :param string container_name: Name of the container, None for the OS.
+        """
+        if container_name is None:
+            self.repo_os.set_ref_immediate(None, REF_PREFETCH_OS, None, None)
+            return
+        prefetched = self.get_prefetched_revisions()
+        if prefetched.pop(container_name, None) is not None:
+            self.write_prefetched_revisions(prefetched)
+
+    def get_commit_objects(self, is_container, rev, container_name=None):
+        """
+        This method resolves a revision against its remote before the update: only the commit object is pulled, if
+        it is not in the repository yet, and the objects listed by its ostree.sizes metadata are returned.
+
+        :param boolean is_container: - True for a container revision
+                                     - False for an OS revision
+        :param string rev: Commit revision.
+        :param string container_name: Name of the container.
+        :returns: The objects of the commit, see parse_sizes(), None if the commit lists no sizes.
+        :raises GLib.Error: The commit could not be pulled.
+        """
+        if is_container:
+            repo = self.repo_containers
+            remote_name = container_name
+            self.init_container_remote(container_name)
+        else:
+            repo = self.repo_os
+            remote_name = self.remote_name_os
+        try:
+            [_, commit, _] = repo.load_commit(rev)
+        except GLib.Error:
+            # the commit is marked partial, the update pulls the rest of it as usual
+            options = {'flags': GLib.Variant('i', OSTree.RepoPullFlags.COMMIT_ONLY),
+                       'refs': GLib.Variant('as', (rev,)),
+                       'depth': GLib.Variant('i', 0)}
+            repo.pull_with_options(remote_name, GLib.Variant('a{sv}', options), None, None)
+            [_, commit, _] = repo.load_commit(rev)
+        sizes = GLib.VariantDict.new(commit.get_child_value(0)).lookup_value(METADATA_SIZES,
+                                                                             GLib.VariantType.new('a(ayay)'))
+        if sizes is None:
+            return None
+        return [(checksum, OSTree.ObjectType(objtype), archived, unpacked)
+                for checksum, objtype, archived, unpacked in parse_sizes(sizes.unpack())]
+
     def get_previous_rev(self, container_name):
         """
         This method returns the previous working revision of a notify container.
@@ -199,6 +580,38 @@ class AsyncUpdater(object):
         except (FileNotFoundError, KeyError):
             return None
 
+    def get_checkout_revision(self, container_name):
+        """
+        This method returns the revision recorded in the checkout marker of a container.
+
+        :param string container_name: Name of the container.
+        :returns: - The rev sha checked out in PATH_APPS/container_name
+                  - None if the container is not checked out, or was checked out before revisions were recorded
+        """
+        try:
+            with open(PATH_APPS + '/' + container_name + '/' + VALIDATE_CHECKOUT, "r") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def is_container_up_to_date(self, container_name, rev, autostart):
+        """
+        This method checks whether a container update would be a no-op: the revision is both the current working
+        revision and the one checked out on disk, the unit is installed and the autostart setting is unchanged.
+
+        :param string container_name: Name of the container.
+        :param string rev: Commit revision requested by the server.
+        :param int autostart: Autostart setting requested by the server.
+        :returns: - True if the update can be skipped
+                  - False otherwise
+        """
+        if rev is None:
+            return False
+        return (self.get_previous_rev(container_name) == rev and
+                self.get_checkout_revision(container_name) == rev and
+                os.path.isfile(PATH_SYSTEMD_UNITS + container_name + '.service') and
+                os.path.isfile(PATH_APPS + '/' + container_name + '/' + FILE_AUTOSTART) == (autostart == 1))
+
     def init_checkout_existing_containers(self):
         """
         This method manages:
@@ -214,18 +627,24 @@ class AsyncUpdater(object):
         self.logger.info("Getting refs from repo:{}".format(PATH_REPO_APPS))
 
         try:
+            self.apply_staged_containers()
             [_, refs] = self.repo_containers.list_refs(None, None)
+            refs = [ref for ref in refs if ':' in ref]
             self.logger.info("There are {} containers to be started.".format(len(refs)))
             for ref in refs:
                 container_name = ref.split(':')[1]
-                if not os.path.isfile(PATH_APPS + '/' + container_name + '/' + VALIDATE_CHECKOUT):
+                if not os.path.isfile(PATH_APPS + '/' + container_name + '/' + VALIDATE_CHECKOUT) or \
+                        not self.verify_checkout(container_name):
                     self.checkout_container(container_name, None)
                     self.update_container_ids(container_name)
+                    self.write_checkout_manifest(container_name)
                 if not res:
                     self.logger.error("Error when checking out container:{}".format(container_name))
                     break
-                self.create_unit(container_name)
-            self.systemd.Reload()
+                # the unit of a blue/green container is an alias of the unit of its slot
+                if self.active_slot(container_name) is None:
+                    self.create_unit(container_name)
+            self.reload_units()
             for ref in refs:
                 container_name = ref.split(':')[1]
                 if os.path.isfile(PATH_APPS + '/' + container_name + '/' + FILE_AUTOSTART):
@@ -236,6 +655,7 @@ class AsyncUpdater(object):
         finally:
             return res
 
+    @traced('create_unit')
     def create_unit(self, container_name):
         """ 
         This method copies the .service file from /apps partition to /etc/systemd/system/ in order to create the unit for the relevant container.
@@ -246,6 +666,46 @@ class AsyncUpdater(object):
         shutil.copy(PATH_APPS + '/' + container_name + '/systemd.service',
                     PATH_SYSTEMD_UNITS + container_name + '.service')
 
+    @timed('systemd_reload')
+    @traced('systemd_reload')
+    def reload_units(self):
+        """
+        This method regenerates the systemd dependency tree, to take into account new or updated unit files.
+        """
+        self.systemd.Reload()
+
+    def unit_dependencies(self, container_names):
+        """
+        This method reads the ordering dependencies (After=, Requires=, Before=...) between the units of the given
+        containers, once they have been reloaded.
+
+        :param list container_names: Names of the containers.
+        :returns: Dictionnary {container_name: set of the container names it must start after}, empty if systemd
+            could not be queried.
+        """
+        units = {}
+        for container_name in container_names:
+            units[container_name + '.service'] = container_name
+            for slot in SLOTS:
+                units[self.slot_unit(container_name, slot)] = container_name
+        dependencies = {container_name: set() for container_name in container_names}
+        try:
+            for container_name in container_names:
+                unit = self.bus.get('.systemd1', self.systemd.LoadUnit(container_name + '.service'))
+                for prop in AFTER_PROPERTIES:
+                    dependencies[container_name].update(units[u] for u in getattr(unit, prop) if u in units)
+                for u in unit.Before:
+                    if u in units:
+                        dependencies[units[u]].add(container_name)
+        except Exception as e:
+            self.logger.warning("Reading the dependencies of the containers failed ({})".format(e))
+            return {}
+        for container_name in container_names:
+            dependencies[container_name].discard(container_name)
+        return dependencies
+
+    @timed('systemd_start')
+    @traced('systemd_start')
     def start_unit(self, container_name):
         """ 
         This method enables and then starts the systemd unit for the relevant container. 
@@ -257,6 +717,8 @@ class AsyncUpdater(object):
         self.logger.info("Since FILE_AUTOSTART is present, start the container using systemd")
         self.systemd.StartUnit(container_name + '.service', "replace")
 
+    @timed('systemd_stop')
+    @traced('systemd_stop')
     def stop_unit(self, container_name):
         """
         This method stops the systemd unit for the relevant container.
@@ -268,39 +730,205 @@ class AsyncUpdater(object):
         self.logger.info("Disable the container {}".format(container_name))
         self.systemd.DisableUnitFiles([container_name + '.service'], False)
 
-    def pull_ostree_ref(self, is_container, ref_sha, ref_name=None):
+    @timed('pull_ostree_ref')
+    @traced('pull_ostree_ref')
+    def pull_ostree_ref(self, is_container, ref_sha, ref_name=None, progress_callback=None, attempt=1):
         """
-        Wrapper method to pull a ref from an OSTree remote repository.
+        Wrapper method to pull a ref from an OSTree remote repository. Nothing is pulled if the commit is already
+        complete in the repository.
+
+        A pull which stalls (see PullWatchdog) or fails raises PullRetry with the delay of an exponential backoff,
+        up to the 'pull-retries' remote attribute; the caller waits out of the worker and calls again with the next
+        attempt number (see FullMetalUpdateDDIClient.pull()). The objects already fetched are kept in the
+        repository (and the commit stays marked as partial), so that a retry only downloads the missing ones.
+
+        The commit is fetched from the best mirror of self.mirrors, if any. A mirror which fails is
+        disabled and the pull moves on to the next one, then to the origin, without waiting nor counting a retry.
+        On the first attempt, the commit is pulled from the LAN peers holding it before any of them, see
+        pull_from_peers().
 
         :param boolean is_container: - True to pull a container image
                                      - False to pull an OS image
         :param string ref_sha: SHA checksum of the ref commit to pull.
         :param string ref_name: Name of the ref commit to pull (can be the name of the container, if None, the OS name will be set).
+        :param callable progress_callback: Called with the pull status on each progress change, see on_pull_progress().
+        :param int attempt: Number of the attempt, from 1.
+        :raises PullRetry: The attempt failed, the pull may be retried.
+        :raises Exception: The last attempt failed.
         """
-        res = True
-
         if is_container:
             repo = self.repo_containers
+            repo_name = 'containers'
         else:
             repo = self.repo_os
+            repo_name = 'os'
             ref_name = self.remote_name_os
 
+        if self.has_complete_commit(repo, ref_sha):
+            self.logger.info("{} ({}) already in the OSTree repo".format(ref_name, ref_sha))
+            return
+
+        attributes = self.ostree_remote_attributes or {}
+        stall_timeout = attributes.get('stall-timeout', PULL_STALL_TIMEOUT)
+        retries = attributes.get('pull-retries', PULL_RETRIES)
+        delay = min(attributes.get('retry-delay', PULL_RETRY_DELAY) * 2 ** (attempt - 1), PULL_RETRY_DELAY_MAX)
+
+        self.logger.info("Pulling remote {} from OSTree repo ({})".format(ref_name, ref_sha))
+        self.tracer.annotate(ref=ref_name, rev=ref_sha)
+        if attempt == 1 and self.pull_from_peers(repo, repo_name, ref_name, ref_sha, progress_callback,
+                                                 stall_timeout):
+            self.logger.info("Upgrader pulled {} from a peer ({})".format(ref_name, ref_sha))
+            return
+
+        while True:
+            mirror = self.mirrors.select()
+            override_url = mirror
+            if self.shaper is not None:
+                # through the local proxy capping the bandwidth
+                override_url = self.shaper.wrap(mirror or self.ostree_remote_attributes['url'])
+            [error, stalled, transferred, duration] = self.pull_attempt(repo, repo_name, ref_name, ref_sha,
+                                                                        progress_callback, stall_timeout,
+                                                                        override_url)
+            if error is None:
+                if mirror is not None:
+                    self.mirrors.record(mirror, transferred, duration)
+                break
+            self.tracer.annotate(attempts=attempt, error=error)
+            if mirror is not None:
+                self.logger.warning("Pulling {} from mirror {} failed ({}), failing over".format(
+                    ref_name, mirror, error))
+                self.mirrors.failed(mirror)
+                continue
+            if attempt > retries:
+                self.logger.error("Pulling {} from OSTree repo failed ({})".format(ref_name, error))
+                raise Exception("Pulling {} failed after {} attempts ({})".format(ref_name, attempt, error))
+            METRICS.inc('fmu_ostree_pull_retries_total', repo=repo_name, reason='stall' if stalled else 'error')
+            self.logger.warning("Pulling {} from OSTree repo failed ({}), attempt {}/{}".format(
+                ref_name, error, attempt, retries + 1))
+            raise PullRetry(error, delay)
+
+        self.logger.info("Upgrader pulled {} from OSTree repo ({})".format(ref_name, ref_sha))
+
+    def has_complete_commit(self, repo, rev):
+        """
+        This method checks whether a commit and all its objects are in a repository.
+
+        :param OSTree.Repo repo: Repository.
+        :param string rev: Checksum of the commit.
+        """
         try:
-            progress = OSTree.AsyncProgress.new()
-            progress.connect('changed', OSTree.Repo.pull_default_console_progress_changed, None)
+            [_, _, state] = repo.load_commit(rev)
+        except GLib.Error:
+            return False
+        return not state & OSTree.RepoCommitState.PARTIAL
 
-            opts = GLib.Variant('a{sv}', {'flags': GLib.Variant('i', OSTree.RepoPullFlags.NONE),
-                                          'refs': GLib.Variant('as', (ref_sha,)),
-                                          'depth': GLib.Variant('i', OSTREE_DEPTH)})
-            self.logger.info("Pulling remote {} from OSTree repo ({})".format(ref_name, ref_sha))
-            res = repo.pull_with_options(ref_name, opts, progress, None)
-            progress.finish()
-            self.logger.info("Upgrader pulled {} from OSTree repo ({})".format(ref_name, ref_sha))
-        except GLib.Error as e:
-            self.logger.error("Pulling {} from OSTree repo failed ({})".format(ref_name, str(e)))
-            raise
-        if not res:
-            raise Exception("Pulling {} failed (returned False)".format(ref_name))
+    def pull_attempt(self, repo, repo_name, remote_name, ref_sha, progress_callback, stall_timeout,
+                     override_url=None, http_headers=None):
+        """
+        Pull a commit once, cancelling the pull if it stalls.
+
+        :param OSTree.Repo repo: Repository to pull into.
+        :param string repo_name: 'containers' or 'os'.
+        :param string remote_name: Name of the remote.
+        :param string ref_sha: SHA checksum of the commit to pull.
+        :param callable progress_callback: See pull_ostree_ref().
+        :param float stall_timeout: See PullWatchdog.
+        :param string override_url: URL to pull from instead of the url of the remote (mirror, peer, shaping
+            proxy).
+        :param dictionnary http_headers: Headers added to the requests of the pull (peer token).
+        :returns: (error, stalled, bytes transferred, duration), error is None when the pull succeeded.
+        """
+        progress = OSTree.AsyncProgress.new()
+        progress.connect('changed', OSTree.Repo.pull_default_console_progress_changed, None)
+        if progress_callback is not None:
+            progress.connect('changed', self.on_pull_progress, progress_callback)
+        cancellable = Gio.Cancellable.new()
+
+        options = {'flags': GLib.Variant('i', OSTree.RepoPullFlags.NONE),
+                   'refs': GLib.Variant('as', (ref_sha,)),
+                   'depth': GLib.Variant('i', OSTREE_DEPTH)}
+        if override_url is not None:
+            options['override-url'] = GLib.Variant('s', override_url)
+        if http_headers:
+            options['http-headers'] = GLib.Variant('a(ss)', list(http_headers.items()))
+        start = time.monotonic()
+        with PullWatchdog(progress, cancellable, stall_timeout) as watchdog:
+            try:
+                res = repo.pull_with_options(remote_name, GLib.Variant('a{sv}', options), progress, cancellable)
+                error = None if res else "returned False"
+            except GLib.Error as e:
+                error = "stalled for {}s".format(stall_timeout) if watchdog.stalled else str(e)
+        duration = time.monotonic() - start
+        self.record_pull_metrics(progress, repo_name, duration)
+        progress.finish()
+        return (error, watchdog.stalled, progress.get_uint64('bytes-transferred'), duration)
+
+    def pull_from_peers(self, repo, repo_name, remote_name, ref_sha, progress_callback, stall_timeout):
+        """
+        Try to pull a commit from the peers of self.peers holding it, before the origin.
+
+        :returns: True if a peer provided the commit, False to pull it from the origin.
+        """
+        if not self.peers:
+            return False
+        tried = 0
+        for peer in self.peers.candidates():
+            if tried >= PEER_MAX_ATTEMPTS:
+                break
+            url = '{}/{}'.format(peer, repo_name)
+            if not self.peers.has_commit(url, ref_sha):
+                continue
+            tried += 1
+            self.logger.info("Pulling {} from peer {}".format(remote_name, peer))
+            [error, _, _, _] = self.pull_attempt(repo, repo_name, remote_name, ref_sha, progress_callback,
+                                                 stall_timeout, override_url=url, http_headers=self.peers.headers())
+            if error is None:
+                METRICS.inc('fmu_peer_pulls_total', result='success')
+                self.tracer.annotate(peer=peer)
+                return True
+            METRICS.inc('fmu_peer_pulls_total', result='failure')
+            self.logger.warning("Pulling {} from peer {} failed ({})".format(remote_name, peer, error))
+            self.peers.failed(peer)
+        return False
+
+    def on_pull_progress(self, progress, progress_callback):
+        """
+        Handler of the 'changed' signal of OSTree.AsyncProgress, forwards the pull status to progress_callback as a
+        dictionnary: {fetched, requested, outstanding_fetches, bytes_transferred, bytes_sec}.
+
+        :param OSTree.AsyncProgress progress: Progress of the pull.
+        :param callable progress_callback: Callback given to pull_ostree_ref().
+        """
+        if progress.get_status():
+            # metadata scanning, no object count yet
+            return
+        # start-time is in microseconds of the monotonic clock
+        elapsed = (GLib.get_monotonic_time() - progress.get_uint64('start-time')) / 1000000
+        transferred = progress.get_uint64('bytes-transferred')
+        try:
+            progress_callback({
+                'fetched': progress.get_uint('fetched'),
+                'requested': progress.get_uint('requested'),
+                'outstanding_fetches': progress.get_uint('outstanding-fetches'),
+                'bytes_transferred': transferred,
+                'bytes_sec': transferred / elapsed if elapsed > 0 else 0,
+            })
+        except Exception as e:
+            self.logger.warning("Pull progress callback failed ({})".format(e))
+
+    def record_pull_metrics(self, progress, repo_name, duration):
+        """
+        Record the bytes transferred by a pull and its throughput.
+
+        :param OSTree.AsyncProgress progress: Progress of the pull.
+        :param string repo_name: 'containers' or 'os'.
+        :param float duration: Duration of the pull in seconds.
+        """
+        transferred = progress.get_uint64('bytes-transferred')
+        self.tracer.annotate(bytes=transferred, fetched=progress.get_uint('fetched'))
+        METRICS.inc('fmu_ostree_pull_bytes_total', transferred, repo=repo_name)
+        if duration > 0:
+            METRICS.set('fmu_ostree_pull_throughput_bytes', transferred / duration, repo=repo_name)
 
     def init_container_remote(self, container_name):
         """
@@ -331,20 +959,27 @@ class AsyncUpdater(object):
             self.logger.error("Initializing {} remote failed ({})".format(container_name, str(e)))
             raise
 
-    def update_container_ids(self, container_name):
+    @timed('update_container_ids')
+    @traced('update_container_ids')
+    def update_container_ids(self, container_name, path=None):
         """
         By default, the container are checked out as root. This method sets the uid and
         gid of all the container related files to 1000 (UID) and 1000 (GID).
 
         :param string container_name: Name of the container.
+        :param string path: Checkout directory, defaults to PATH_APPS/container_name.
         """
+        path = path or PATH_APPS + '/' + container_name
         self.logger.info("Update the UID and GID of the rootfs")
-        os.chown(PATH_APPS + '/' + container_name, CONTAINER_UID, CONTAINER_GID)
-        for dirpath, dirnames, filenames in os.walk(PATH_APPS + '/' + container_name):
+        os.chown(path, CONTAINER_UID, CONTAINER_GID)
+        files = 0
+        for dirpath, dirnames, filenames in os.walk(path):
             for dname in dirnames:
                 os.lchown(os.path.join(dirpath, dname), CONTAINER_UID, CONTAINER_GID)
             for fname in filenames:
                 os.lchown(os.path.join(dirpath, fname), CONTAINER_UID, CONTAINER_GID)
+            files += len(dirnames) + len(filenames)
+        self.tracer.annotate(files=files)
 
     def handle_container(self, container_name, autostart, autoremove):
         """
@@ -360,7 +995,11 @@ class AsyncUpdater(object):
         try:
             if autoremove == 1:
                 self.logger.info("Remove the directory: {}".format(PATH_APPS + '/' + container_name))
-                shutil.rmtree(PATH_APPS + '/' + container_name)
+                if self.active_slot(container_name) is not None:
+                    self.leave_slots(container_name)
+                else:
+                    self.trash.move(PATH_APPS + '/' + container_name)
+                self.forget_container_revisions(container_name)
             else:
                 service = self.systemd.ListUnitsByNames([container_name + '.service'])
                 if service[0][2] == 'not-found':
@@ -381,6 +1020,8 @@ class AsyncUpdater(object):
             return False
         return True
 
+    @timed('checkout_container')
+    @traced('checkout_container')
     def checkout_container(self, container_name, rev_number):
         """
         This method checks out a container into its corresponding folder, to a given commit revision.
@@ -394,30 +1035,39 @@ class AsyncUpdater(object):
             self.logger.info("Stop the container {}".format(container_name))
             self.stop_unit(container_name)
 
+        if os.path.islink(PATH_APPS + '/' + container_name):
+            self.leave_slots(container_name)
+
+        self.logger.info("Getting rev from repo:{}".format(container_name + ':' + container_name))
+        if rev_number is None:
+            rev = self.repo_containers.resolve_rev(container_name + ':' + container_name, False)[1]
+        else:
+            rev = rev_number
+        self.logger.info("Rev value:{}".format(rev))
+        self.tracer.annotate(rev=rev)
+        self.checkout_to(container_name, rev, PATH_APPS + '/' + container_name)
+
+    def checkout_to(self, container_name, rev, path):
+        """
+        This method checks out a revision of a container into a new directory, replacing the previous one.
+
+        :param string container_name: Name of the container.
+        :param string rev: Commit revision.
+        :param string path: Checkout directory.
+        """
         res = True
         rootfs_fd = None
         try:
-            options = OSTree.RepoCheckoutAtOptions()
-            options.overwrite_mode = OSTree.RepoCheckoutOverwriteMode.UNION_IDENTICAL
-            options.process_whiteouts = True
-            options.bareuseronly_dirs = True
-            options.no_copy_fallback = True
-            options.mode = OSTree.RepoCheckoutMode.USER
-
-            self.logger.info("Getting rev from repo:{}".format(container_name + ':' + container_name))
-
-            if rev_number is None:
-                rev = self.repo_containers.resolve_rev(container_name + ':' + container_name, False)[1]
-            else:
-                rev = rev_number
-            self.logger.info("Rev value:{}".format(rev))
-            if os.path.isdir(PATH_APPS + '/' + container_name):
-                shutil.rmtree(PATH_APPS + '/' + container_name)
-            os.mkdir(PATH_APPS + '/' + container_name)
-            self.logger.info("Create directory {}/{}".format(PATH_APPS, container_name))
-            rootfs_fd = os.open(PATH_APPS + '/' + container_name, os.O_DIRECTORY)
-            res = self.repo_containers.checkout_at(options, rootfs_fd, PATH_APPS + '/' + container_name, rev)
-            open(PATH_APPS + '/' + container_name + '/' + VALIDATE_CHECKOUT, 'a').close()
+            options = self.checkout_options()
+            if os.path.isdir(path):
+                self.trash.move(path)
+            os.mkdir(path)
+            self.logger.info("Create directory {}".format(path))
+            rootfs_fd = os.open(path, os.O_DIRECTORY)
+            res = self.repo_containers.checkout_at(options, rootfs_fd, path, rev)
+            # the marker records the checked out revision, see is_container_up_to_date()
+            with open(path + '/' + VALIDATE_CHECKOUT, 'w') as f:
+                f.write(rev)
 
         except GLib.Error as e:
             self.logger.error("Checking out {} failed ({})".format(container_name, str(e)))
@@ -425,8 +1075,443 @@ class AsyncUpdater(object):
         if rootfs_fd is not None:
             os.close(rootfs_fd)
         if not res:
-            raise Exception("Checking out {} failed (returned False)")
+            raise Exception("Checking out {} failed (returned False)".format(container_name))
+
+    @traced('stage_container')
+    def stage_container(self, container_name, rev):
+        """
+        This method prepares the checkout of a container updated along with the OS, applied at the reboot by
+        apply_staged_containers(): the revision is checked out into PATH_STAGED/container_name and the running
+        container is left untouched, so that it restarts once, into the new OS.
+
+        :param string container_name: Name of the container.
+        :param string rev: Commit revision.
+        """
+        self.tracer.annotate(rev=rev)
+        path = PATH_STAGED + '/' + container_name
+        os.makedirs(PATH_STAGED, exist_ok=True)
+        self.checkout_to(container_name, rev, path)
+        self.update_container_ids(container_name, path)
+
+    def get_staged_containers(self):
+        """
+        This method returns the containers staged with an OS update.
+
+        :returns: Dictionnary {'os_rev': OS revision, 'containers': {container_name: {'rev', 'autostart',
+            'autoremove'}}}, None if no container is staged.
+        """
+        try:
+            with open(PATH_STAGED_CONTAINERS, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_staged_containers(self, os_rev, containers):
+        """
+        This method records the containers staged with an OS update, see stage_container().
+
+        :param string os_rev: Revision of the staged OS, the containers are applied when it boots.
+        :param dictionnary containers: {container_name: {'rev', 'autostart', 'autoremove'}}
+        """
+        # the containers staged with a previous OS, replaced by this one, will not be applied
+        previous = self.get_staged_containers()
+        if previous is not None and previous['os_rev'] != os_rev:
+            for container_name in previous['containers']:
+                if container_name not in containers and os.path.isdir(PATH_STAGED + '/' + container_name):
+                    self.trash.move(PATH_STAGED + '/' + container_name)
+        with open(PATH_STAGED_CONTAINERS, "w") as f:
+            json.dump({'os_rev': os_rev, 'containers': containers}, f, indent=4)
+
+    def drop_staged_container(self, container_name):
+        """
+        This method cancels the staged update of a container, when a later deployment updates it directly.
+
+        :param string container_name: Name of the container.
+        """
+        staged = self.get_staged_containers()
+        if staged is None or staged['containers'].pop(container_name, None) is None:
+            return
+        self.logger.info("Dropping the staged update of {}".format(container_name))
+        if os.path.isdir(PATH_STAGED + '/' + container_name):
+            self.trash.move(PATH_STAGED + '/' + container_name)
+        self.write_staged_containers(staged['os_rev'], staged['containers'])
+
+    def apply_staged_containers(self):
+        """
+        This method applies the container checkouts staged with an OS update, before the containers are started:
+            - once the staged OS is booted, the staged checkouts replace the current ones ;
+            - while the OS deployment is still pending (deferred reboot), they are kept ;
+            - otherwise the OS rolled back and they are dropped, the current revisions going with the current OS.
+        """
+        staged = self.get_staged_containers()
+        if staged is None:
+            return
+        booted = self.sysroot.get_booted_deployment()
+        if booted is None or booted.get_csum() != staged['os_rev']:
+            if self.is_os_staged(staged['os_rev']):
+                self.logger.info("Staged containers wait for the reboot into OS {}".format(staged['os_rev']))
+                return
+            self.logger.warning("OS {} is not booted, dropping the staged containers".format(staged['os_rev']))
+            for container_name in staged['containers']:
+                if os.path.isdir(PATH_STAGED + '/' + container_name):
+                    self.trash.move(PATH_STAGED + '/' + container_name)
+        else:
+            for container_name, container in staged['containers'].items():
+                try:
+                    self.apply_staged_container(container_name, container['rev'], container['autostart'],
+                                                container['autoremove'])
+                except (GLib.Error, OSError) as e:
+                    self.logger.error("Applying the staged update of {} failed ({})".format(container_name, e))
+        os.remove(PATH_STAGED_CONTAINERS)
+
+    def apply_staged_container(self, container_name, rev, autostart, autoremove):
+        """
+        This method replaces the checkout of a container with its staged one, see stage_container().
+
+        :param string container_name: Name of the container.
+        :param string rev: Staged commit revision.
+        :param int autostart: set to 1 if the container should be automatically started, 0 otherwise
+        :param int autoremove: if set to 1, the container's directory is deleted instead
+        """
+        self.logger.info("Applying the staged update of {}".format(container_name))
+        app_path = PATH_APPS + '/' + container_name
+        if self.active_slot(container_name) is not None:
+            self.leave_slots(container_name)
+        elif os.path.isdir(app_path):
+            self.trash.move(app_path)
+        if autoremove == 1:
+            self.forget_container_revisions(container_name)
+            return
+        os.rename(PATH_STAGED + '/' + container_name, app_path)
+        if autostart == 1:
+            open(app_path + '/' + FILE_AUTOSTART, 'a').close()
+        elif os.path.isfile(app_path + '/' + FILE_AUTOSTART):
+            os.remove(app_path + '/' + FILE_AUTOSTART)
+        self.write_checkout_manifest(container_name)
+        self.create_unit(container_name)
+        self.set_current_revision(container_name, rev)
+
+    def active_slot(self, container_name):
+        """
+        This method returns the slot a blue/green container runs from.
+
+        :param string container_name: Name of the container.
+        :returns: 'blue', 'green' or None when the container is not handled in blue/green mode.
+        """
+        path = PATH_APPS + '/' + container_name
+        if not os.path.islink(path):
+            return None
+        return os.path.basename(os.readlink(path))
+
+    def idle_slot(self, container_name):
+        """
+        This method returns the slot the next revision of a blue/green container is checked out into.
+
+        :param string container_name: Name of the container.
+        """
+        return SLOTS[1] if self.active_slot(container_name) == SLOTS[0] else SLOTS[0]
+
+    def slot_unit(self, container_name, slot):
+        return '{}-{}.service'.format(container_name, slot)
+
+    @timed('checkout_slot')
+    @traced('checkout_slot')
+    def checkout_slot(self, container_name, rev, slot):
+        """
+        This method prepares the idle slot of a blue/green container while the current revision keeps running: the
+        revision is checked out into PATH_SLOTS/container_name/slot, and the unit of the slot is created from the
+        systemd.service of the container, its paths pointing to the slot instead of PATH_APPS/container_name.
+
+        The container must support two instances running at once (e.g. SO_REUSEPORT), as the new one is started
+        before the old one is stopped.
+
+        :param string container_name: Name of the container.
+        :param string rev: Commit revision.
+        :param string slot: Slot to prepare, see idle_slot().
+        """
+        self.tracer.annotate(rev=rev, slot=slot)
+        path = PATH_SLOTS + '/' + container_name + '/' + slot
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.checkout_to(container_name, rev, path)
+        self.update_container_ids(container_name, path)
+
+        with open(path + '/systemd.service', 'r') as f:
+            unit = f.read()
+        unit = re.sub(re.escape(PATH_APPS + '/' + container_name) + r'(?=/|\s|$)', path, unit)
+        with open(PATH_SYSTEMD_UNITS + self.slot_unit(container_name, slot), 'w') as f:
+            f.write(unit)
+
+    def start_slot(self, container_name, slot):
+        """
+        This method starts the unit of a slot, next to the running instance of the container.
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot to start.
+        """
+        self.logger.info("Warm start of {} from slot {}".format(container_name, slot))
+        self.systemd.StartUnit(self.slot_unit(container_name, slot), "replace")
+
+    def wait_slot_active(self, container_name, slot, timeout=None):
+        """
+        This method waits for the unit of a slot to leave the activating state.
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot started by start_slot().
+        :param int timeout: Delay in seconds, defaults to SLOT_READY_TIMEOUT.
+        :returns: - True if the unit is active
+                  - False if it failed or is still activating after timeout
+        """
+        unit = self.bus.get('.systemd1', self.systemd.GetUnit(self.slot_unit(container_name, slot)))
+        deadline = time.monotonic() + (timeout or SLOT_READY_TIMEOUT)
+        while unit.ActiveState in ('activating', 'reloading') and time.monotonic() < deadline:
+            time.sleep(0.5)
+        return unit.ActiveState == 'active'
+
+    @timed('slot_cutover')
+    @traced('slot_cutover')
+    def cutover_slot(self, container_name, slot):
+        """
+        This method hands a blue/green container over to the slot started by start_slot(), once it is ready:
+            - the previous instance is stopped and disabled ;
+            - the unit of the container becomes an alias of the unit of the slot, so that the other methods keep
+              handling the container as container_name.service ;
+            - PATH_APPS/container_name becomes a link to the slot.
+        The previous slot is kept as it is, the next revision will be checked out into it.
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot taking over.
+        """
+        self.tracer.annotate(slot=slot)
+        unit_path = PATH_SYSTEMD_UNITS + container_name + '.service'
+        previous = self.active_slot(container_name)
+        previous_unit = self.slot_unit(container_name, previous) if previous else container_name + '.service'
+        if os.path.lexists(unit_path):
+            self.logger.info("Stop the previous instance of {} ({})".format(container_name, previous_unit))
+            self.systemd.StopUnit(previous_unit, "replace")
+            self.systemd.DisableUnitFiles([previous_unit], False)
+
+        tmp = unit_path + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(self.slot_unit(container_name, slot), tmp)
+        os.rename(tmp, unit_path)
+
+        app_path = PATH_APPS + '/' + container_name
+        if previous is None and os.path.isdir(app_path):
+            self.trash.move(app_path)
+        tmp = app_path + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(PATH_SLOTS + '/' + container_name + '/' + slot, tmp)
+        os.rename(tmp, app_path)
+
+        self.reload_units()
+        self.systemd.EnableUnitFiles([self.slot_unit(container_name, slot)], False, False)
+        self.write_checkout_manifest(container_name)
+        self.logger.info("{} now runs from slot {}".format(container_name, slot))
+
+    def abort_slot(self, container_name, slot):
+        """
+        This method stops the unit of a slot which failed to start, the previous instance keeps running.
+
+        :param string container_name: Name of the container.
+        :param string slot: Slot started by start_slot().
+        """
+        self.logger.warning("{} failed to start from slot {}, keeping the previous instance".format(container_name,
+                                                                                                 slot))
+        self.systemd.StopUnit(self.slot_unit(container_name, slot), "replace")
+
+    def leave_slots(self, container_name):
+        """
+        This method turns a blue/green container back into a plain checkout: the units of the slots are stopped
+        and removed, and the slots are deleted.
+
+        :param string container_name: Name of the container.
+        """
+        self.logger.info("{} leaves the blue/green mode".format(container_name))
+        for slot in SLOTS:
+            unit_file = PATH_SYSTEMD_UNITS + self.slot_unit(container_name, slot)
+            if os.path.exists(unit_file):
+                self.systemd.StopUnit(self.slot_unit(container_name, slot), "replace")
+                self.systemd.DisableUnitFiles([self.slot_unit(container_name, slot)], False)
+                os.remove(unit_file)
+        os.remove(PATH_SYSTEMD_UNITS + container_name + '.service')
+        os.remove(PATH_APPS + '/' + container_name)
+        self.trash.move(PATH_SLOTS + '/' + container_name)
+        self.reload_units()
+
+    def checkout_options(self, subpath=None):
+        """
+        Returns the options of the containers checkouts: hardlinks to the repository objects, owned by the user.
 
+        :param string subpath: Path of the commit to check out, None for the whole tree.
+        """
+        options = OSTree.RepoCheckoutAtOptions()
+        options.overwrite_mode = OSTree.RepoCheckoutOverwriteMode.UNION_IDENTICAL
+        options.process_whiteouts = True
+        options.bareuseronly_dirs = True
+        options.no_copy_fallback = True
+        options.mode = OSTree.RepoCheckoutMode.USER
+        if subpath is not None:
+            options.subpath = subpath
+        return options
+
+    def write_checkout_manifest(self, container_name):
+        """
+        This method writes the manifest of a checkout, once its ids have been updated: the revision and, for each
+        entry, its mode, owner, size, modification time and symbolic link target. It allows verify_checkout() to
+        check the checkout with a stat per entry instead of checking it out again.
+
+        :param string container_name: Name of the container.
+        """
+        path = PATH_APPS + '/' + container_name
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                entry_path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(entry_path, path)
+                if relpath in (VALIDATE_CHECKOUT, FILE_AUTOSTART, FILE_MANIFEST):
+                    continue
+                st = os.lstat(entry_path)
+                entries[relpath] = [st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns,
+                                    os.readlink(entry_path) if stat.S_ISLNK(st.st_mode) else None]
+        manifest = {'rev': self.get_checkout_revision(container_name), 'entries': entries}
+        with open(path + '/' + FILE_MANIFEST, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+
+    def find_damaged_entries(self, container_name, entries):
+        """
+        This method compares a checkout with its manifest entries.
+
+        :param string container_name: Name of the container.
+        :param dictionnary entries: Entries of the manifest.
+        :returns: Relative paths of the missing or altered entries, without the children of a damaged directory.
+        """
+        path = PATH_APPS + '/' + container_name
+        damaged = []
+        for relpath in sorted(entries):
+            if any(relpath.startswith(parent + '/') for parent in damaged):
+                continue
+            [mode, uid, gid, size, mtime_ns, target] = entries[relpath]
+            try:
+                st = os.lstat(os.path.join(path, relpath))
+            except FileNotFoundError:
+                damaged.append(relpath)
+                continue
+            if st.st_mode != mode or st.st_uid != uid or st.st_gid != gid or \
+                    (not stat.S_ISDIR(mode) and (st.st_size != size or st.st_mtime_ns != mtime_ns)) or \
+                    (target is not None and os.readlink(os.path.join(path, relpath)) != target):
+                damaged.append(relpath)
+        return damaged
+
+    @timed('verify_checkout')
+    @traced('verify_checkout')
+    def verify_checkout(self, container_name):
+        """
+        This method checks a checkout against its manifest and checks out again only its damaged entries, e.g.
+        after an unclean shutdown.
+
+        :param string container_name: Name of the container.
+        :returns: - True if the checkout is sound, or has been repaired, or has no manifest (checked out before
+                    manifests were written)
+                  - False if it must be checked out again entirely, or if entries are still damaged after their
+                    repair: their repository objects are then queued for a repair, see queue_object_repair()
+        """
+        path = PATH_APPS + '/' + container_name
+        try:
+            with open(path + '/' + FILE_MANIFEST, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return True
+        except ValueError:
+            self.logger.warning("Manifest of {} is unreadable".format(container_name))
+            return False
+        rev = self.get_checkout_revision(container_name)
+        if rev is None or manifest.get('rev') != rev:
+            self.logger.warning("Manifest of {} does not match its checkout".format(container_name))
+            return False
+
+        damaged = self.find_damaged_entries(container_name, manifest['entries'])
+        self.tracer.annotate(entries=len(manifest['entries']), damaged=len(damaged))
+        if not damaged:
+            return True
+        self.logger.warning("Checkout of {} has {} damaged entries, repairing them".format(container_name,
+                                                                                          len(damaged)))
+        try:
+            for relpath in damaged:
+                self.repair_checkout_entry(container_name, rev, relpath)
+        except (GLib.Error, OSError) as e:
+            self.logger.error("Repairing the checkout of {} failed ({})".format(container_name, e))
+            return False
+
+        still_damaged = self.find_damaged_entries(container_name, manifest['entries'])
+        if not still_damaged:
+            return True
+        for relpath in still_damaged:
+            # a file altered through its hardlink alters the repository object too, see Scrubber
+            self.logger.error("{}/{} is still damaged after its repair".format(container_name, relpath))
+        self.queue_object_repair(rev, still_damaged)
+        return False
+
+    def queue_object_repair(self, rev, relpaths):
+        """
+        This method schedules the repair of the repository objects of checkout entries altered through their
+        hardlinks: the scrubber deletes them and pulls them again (see Scrubber.repair()). Without a scrubber, the
+        commit is only marked partial, so that no peer is served from it.
+
+        :param string rev: Revision of the checkout.
+        :param list relpaths: Paths of the entries, relative to the checkout.
+        """
+        try:
+            if self.scrubber is None:
+                self.repo_containers.mark_commit_partial(rev, True)
+                return
+            [_, root, _] = self.repo_containers.read_commit(rev, None)
+            objects = []
+            for relpath in relpaths:
+                entry = root.resolve_relative_path(relpath)
+                entry.ensure_resolved()
+                if entry.query_file_type(Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None) != Gio.FileType.DIRECTORY:
+                    checksum = entry.get_checksum()
+                    objects.append('{}/{}.file'.format(checksum[:2], checksum[2:]))
+            self.scrubber.queue_repair(objects)
+        except GLib.Error as e:
+            self.logger.error("Queuing the repair of {} failed ({})".format(rev, e))
+
+    def repair_checkout_entry(self, container_name, rev, relpath):
+        """
+        This method checks out a single entry of a container again, with its ids.
+
+        :param string container_name: Name of the container.
+        :param string rev: Revision of the checkout.
+        :param string relpath: Path of the entry, relative to the checkout.
+        """
+        entry_path = os.path.join(PATH_APPS, container_name, relpath)
+        if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+            self.trash.move(entry_path)
+        elif os.path.lexists(entry_path):
+            os.remove(entry_path)
+
+        [_, root, _] = self.repo_containers.read_commit(rev, None)
+        info = root.resolve_relative_path(relpath).query_info('standard::type',
+                                                              Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)
+        parent_fd = os.open(os.path.dirname(entry_path), os.O_DIRECTORY)
+        try:
+            # a non directory subpath is checked out in the destination directory given as '.'
+            destination = os.path.basename(entry_path) if info.get_file_type() == Gio.FileType.DIRECTORY else '.'
+            if not self.repo_containers.checkout_at(self.checkout_options('/' + relpath), parent_fd, destination,
+                                                    rev):
+                raise OSError("Checking out {} failed".format(relpath))
+        finally:
+            os.close(parent_fd)
+
+        os.lchown(entry_path, CONTAINER_UID, CONTAINER_GID)
+        for dirpath, dirnames, filenames in os.walk(entry_path):
+            for name in dirnames + filenames:
+                os.lchown(os.path.join(dirpath, name), CONTAINER_UID, CONTAINER_GID)
+
+    @timed('ostree_stage_tree')
+    @traced('ostree_stage_tree')
     def ostree_stage_tree(self, rev_number):
         """ 
         Wrapper around sysroot.stage_tree()
@@ -453,16 +1538,168 @@ class AsyncUpdater(object):
         if not res:
             raise Exception("Failed while staging new OS tree (returned False)")
 
+    def is_os_staged(self, revision):
+        """
+        This method checks whether an OS revision is the pending deployment, staged and waiting for the reboot.
+
+        :param checksum revision: Checksum of the OS revision.
+        """
+        pending = self.sysroot.query_deployments_for(None)[0]
+        return pending is not None and pending.get_csum() == revision
+
+    def get_boot_deployments(self):
+        """
+        This method reloads the sysroot and returns the (staged, booted) OS deployments, each None if there is none.
+        Both are None if the sysroot could not be loaded.
+        """
+        try:
+            self.sysroot.load(None)
+            return self.sysroot.get_staged_deployment(), self.sysroot.get_booted_deployment()
+        except GLib.Error as e:
+            self.logger.error("Loading the sysroot failed ({})".format(e))
+            return None, None
+
+    def get_finalized_entry(self, staged):
+        """
+        This method returns the bootloader entry written for a staged OS deployment once it is finalized. The boot
+        version and serial of the deployment, hence the ostree= kernel argument of the entry, are only settled by the
+        finalization.
+
+        :param OSTree.Deployment staged: Deployment which was staged.
+        :returns: (root of the deployment, kernel arguments of its bootloader entry)
+        :raises OSError: The deployment is not finalized, or its entry has no ostree= argument.
+        """
+        try:
+            self.sysroot.load(None)
+            if self.sysroot.get_staged_deployment() is not None:
+                raise OSError("The staged deployment is not finalized")
+            for deployment in self.sysroot.get_deployments():
+                if (deployment.get_csum(), deployment.get_deployserial()) == \
+                        (staged.get_csum(), staged.get_deployserial()):
+                    break
+            else:
+                raise OSError("The staged deployment is not deployed")
+            bootconfig = deployment.get_bootconfig()
+            options = bootconfig.get('options') if bootconfig is not None else None
+            if not options or 'ostree=' not in options:
+                raise OSError("The bootloader entry of the staged deployment has no ostree= argument")
+            return os.path.join(self.sysroot.get_path().get_path(),
+                                self.sysroot.get_deployment_dirpath(deployment)), options
+        except GLib.Error as e:
+            raise OSError("Reading the finalized deployment failed ({})".format(e))
+
     def delete_init_var(self):
         """
         This method delete u-boot's environment variable init_var, to restart the rollback procedure.
         """
         try:
             self.logger.info("Deleting init_var u-boot environment variable")
-            if subprocess.call(["fw_setenv", "init_var"]) != 0:
-                self.logger.error("Deleting init_var variable from u-boot environment failed")
-            else:
-                self.logger.info("Deleting init_var variable from u-boot environment succeeded")
-        except subprocess.CalledProcessError as e:
+            self.bootenv.unset('init_var')
+            self.logger.info("Deleting init_var variable from u-boot environment succeeded")
+        except BootEnvError as e:
+            # the deployment is already staged, the new OS boots anyway
             self.logger.error("Deleting init_var variable from u-boot environment failed ({})".format(e))
-            raise
+
+    def keep_revisions(self):
+        """ Returns the number of previous revisions kept per container, the 'keep-revisions' remote attribute. """
+        attributes = self.ostree_remote_attributes or {}
+        return min(attributes.get('keep-revisions', KEEP_REVISIONS), KEEP_REVISIONS_MAX - 1)
+
+    def get_kept_revisions(self, keep):
+        """
+        This method returns the revisions of each container which must survive a prune: the current one, the one
+        checked out, the keep previous ones and those pulled ahead of their installation (prefetched or staged).
+
+        :param int keep: Number of previous revisions kept per container.
+        :returns: Dictionnary {container_name: set of revs}
+        """
+        kept = {}
+        for container_name, revs in self.get_revision_history().items():
+            kept[container_name] = set(revs[:keep + 1])
+        try:
+            with open(PATH_CURRENT_REVISIONS, "r") as f:
+                current_revs = json.load(f)
+        except FileNotFoundError:
+            current_revs = {}
+        for container_name, rev in current_revs.items():
+            kept.setdefault(container_name, set()).add(rev)
+        for container_name, revs in self.get_prefetched_revisions().items():
+            kept.setdefault(container_name, set()).update(revs)
+        staged = self.get_staged_containers()
+        if staged is not None:
+            for container_name, container in staged['containers'].items():
+                kept.setdefault(container_name, set()).add(container['rev'])
+        for container_name in list(kept):
+            checkout = self.get_checkout_revision(container_name)
+            if checkout is not None:
+                kept[container_name].add(checkout)
+        return kept
+
+    def pin_revisions(self, kept):
+        """
+        This method points a local ref (REF_KEEP_PREFIX<container>/<rev>) at each kept revision and deletes the
+        refs of the other ones. The '<container>:<container>' refs of the preinstalled containers are moved to
+        their current revision, so that they do not pin the factory revision forever.
+
+        :param dictionnary kept: Revisions to keep, see get_kept_revisions().
+        """
+        wanted = set()
+        for container_name, revs in kept.items():
+            for rev in revs:
+                [_, has_commit] = self.repo_containers.has_object(OSTree.ObjectType.COMMIT, rev, None)
+                if has_commit:
+                    wanted.add(REF_KEEP_PREFIX + container_name + '/' + rev)
+
+        [_, refs] = self.repo_containers.list_refs(None, None)
+        for ref in refs:
+            if ref.startswith(REF_KEEP_PREFIX) and ref not in wanted:
+                self.repo_containers.set_ref_immediate(None, ref, None, None)
+        for ref in wanted - set(refs):
+            self.repo_containers.set_ref_immediate(None, ref, ref.rsplit('/', 1)[1], None)
+
+        for ref in refs:
+            if ':' not in ref:
+                continue
+            [remote, container_name] = ref.split(':', 1)
+            current = self.get_previous_rev(container_name)
+            if remote == container_name and current is not None and current != refs[ref] and \
+                    REF_KEEP_PREFIX + container_name + '/' + current in wanted:
+                self.repo_containers.set_ref_immediate(remote, container_name, current, None)
+
+    @timed('prune')
+    @traced('prune')
+    def prune_containers_repo(self):
+        """
+        This method prunes the containers repository: every commit but the kept ones (see get_kept_revisions()) is
+        deleted, along with the objects no longer reachable. While the repository exceeds the 'disk-budget' remote
+        attribute, the oldest previous revisions are dropped too; the current revisions are always kept.
+
+        :returns: Space reclaimed, in bytes.
+        """
+        attributes = self.ostree_remote_attributes or {}
+        keep = self.keep_revisions()
+        budget = attributes.get('disk-budget', 0)
+
+        reclaimed = 0
+        while True:
+            self.pin_revisions(self.get_kept_revisions(keep))
+            [_, total, pruned, size] = self.repo_containers.prune(OSTree.RepoPruneFlags.REFS_ONLY, 0, None)
+            reclaimed += size
+            self.logger.info("Pruned {} of {} objects ({} bytes), keeping {} previous revisions".format(
+                pruned, total, size, keep))
+            if not budget:
+                break
+            usage = repo_disk_usage(PATH_REPO_APPS)
+            if usage <= budget:
+                break
+            if keep == 0:
+                self.logger.warning("The containers repository uses {} bytes, over its budget of {} bytes, "
+                                    "with the current revisions only".format(usage, budget))
+                break
+            keep -= 1
+
+        self.tracer.annotate(reclaimed=reclaimed)
+        METRICS.inc('fmu_ostree_pruned_bytes_total', reclaimed, repo='containers')
+        if budget:
+            METRICS.set('fmu_ostree_repo_bytes', usage, repo='containers')
+        return reclaimed
@@ -7,7 +7,8 @@ import json
 import hashlib
 import logging
 
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
 
 from .deployment_base import DeploymentBase
@@ -25,7 +26,18 @@ ConfigStatusResult = Enum('ConfigStatusResultFinished',
 
 
 class APIError(Exception):
-    pass
+    """
+    Error returned by the DDI API.
+
+    Keyword Args:
+        status(int): HTTP status code of the response, if any
+        retry_after(float): delay in seconds requested by the server through
+                            the ``Retry-After`` header, if any
+    """
+    def __init__(self, msg, status=None, retry_after=None):
+        super(APIError, self).__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
 
 
 class DDIClient(object):
@@ -41,11 +53,19 @@ class DDIClient(object):
         404: 'Resource not available or device unknown.',
         405: 'Method Not Allowed',
         406: 'Accept header is specified and is not application/json.',
-        429: 'Too many requests.'
+        429: 'Too many requests.',
+        503: 'Service unavailable.'
     }
 
-    def __init__(self, session, host, ssl, auth_token, tenant_id, controller_id, timeout=10):
+    def __init__(self, session, host, ssl, auth_token, tenant_id, controller_id, timeout=10,
+                 bulk_session=None, rate_limiter=None):
         self.session = session
+        # artifact downloads use their own connection pool when available,
+        # see HTTPTransport
+        self.bulk_session = bulk_session or session
+        # object whose 'await consume(size)' paces the artifact downloads,
+        # None for full speed
+        self.rate_limiter = rate_limiter
         self.host = host
         self.ssl = ssl
         self.logger = logging.getLogger('rauc_hawkbit')
@@ -227,8 +247,8 @@ class DDIClient(object):
         hash_md5 = hashlib.md5()
 
         self.logger.debug('GET binary {}'.format(url))
-        with async_timeout.timeout(timeout, loop=self.session.loop):
-            async with self.session.get(url, headers=get_bin_headers) as resp:
+        with async_timeout.timeout(timeout, loop=self.bulk_session.loop):
+            async with self.bulk_session.get(url, headers=get_bin_headers) as resp:
                 await self.check_http_status(resp)
                 with open(dl_location, 'wb') as fd:
                     while True:
@@ -236,8 +256,10 @@ class DDIClient(object):
                             chunk = await resp.content.read(chunk_size)
                             if not chunk:
                                 break
-                            fd.write(chunk)
-                            hash_md5.update(chunk)
+                        if self.rate_limiter is not None:
+                            await self.rate_limiter.consume(len(chunk))
+                        fd.write(chunk)
+                        hash_md5.update(chunk)
         return hash_md5.hexdigest()
 
     async def post_resource(self, api_path, data, **kwargs):
@@ -305,4 +327,31 @@ class DDIClient(object):
                 reason = resp.reason
 
             raise APIError('{status}: {reason}'.format(
-                status=resp.status, reason=reason))
+                status=resp.status, reason=reason), status=resp.status,
+                retry_after=self.parse_retry_after(
+                    resp.headers.get('Retry-After')))
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Parse a ``Retry-After`` header.
+
+        Args:
+            value(str): header value, either delay seconds or an HTTP date
+
+        Returns:
+            Delay in seconds or None if the header is absent or invalid
+        """
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0, (date - datetime.now(timezone.utc)).total_seconds())
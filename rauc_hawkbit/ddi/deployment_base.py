@@ -6,7 +6,7 @@ from enum import Enum
 # status of the action execution
 DeploymentStatusExecution = Enum('DeploymentStatusExecution',
                                  'closed proceeding canceled scheduled \
-                                 rejected resumed')
+                                 rejected resumed download downloaded')
 
 # defined status of the result
 DeploymentStatusResult = Enum('DeploymentStatusResultFinished',
@@ -29,8 +29,9 @@ class DeploymentBaseAction(object):
         self.action_id = action_id
 
     async def __call__(self, resource=None):
+        query_params = {'c': resource} if resource is not None else {}
         return await self.ddi.get_resource(
-            '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}', {'c': resource}, actionId=self.action_id)
+            '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}', query_params, actionId=self.action_id)
 
     async def feedback(self, status_execution, status_result,
                        status_details=(), **kwstatus_result_progress):
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from collections import OrderedDict
+
+from .client import APIError
+
+
+class DocumentParseError(APIError):
+    """Raised when a DDI document is missing fields or has bad values."""
+    pass
+
+
+def _get(doc, *keys):
+    """Walk nested dictionaries, raising DocumentParseError on missing keys."""
+    value = doc
+    for key in keys:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            raise DocumentParseError('Missing field {}'.format('.'.join(
+                str(k) for k in keys)))
+    return value
+
+
+class BaseResource(object):
+    """
+    Parsed base poll resource (/{tenant}/controller/v1/{targetid}).
+
+    Attributes:
+        sleep(str): polling interval suggested by the server ('HH:MM:SS')
+        config_data(bool): the server requests configData
+        deployment_action(str): action id of the pending deployment, if any
+        deployment_resource(str): resource hash of the pending deployment
+        cancel_action(str): action id of the pending cancelation, if any
+    """
+    __slots__ = ('sleep', 'config_data', 'deployment_action',
+                 'deployment_resource', 'cancel_action')
+
+    def __init__(self, sleep, config_data=False, deployment_action=None,
+                 deployment_resource=None, cancel_action=None):
+        self.sleep = sleep
+        self.config_data = config_data
+        self.deployment_action = deployment_action
+        self.deployment_resource = deployment_resource
+        self.cancel_action = cancel_action
+
+
+class Artifact(object):
+    """Artifact of a deployment chunk."""
+    __slots__ = ('filename', 'size', 'hashes', 'links')
+
+    def __init__(self, filename, size, hashes, links):
+        self.filename = filename
+        self.size = size
+        self.hashes = hashes
+        self.links = links
+
+    @property
+    def download_url(self):
+        """
+        Download URL, https ('download') is preferred over http
+        ('download-http'). HawkBit provides either only https, only http or
+        both.
+        """
+        for rel in ('download', 'download-http'):
+            if rel in self.links:
+                return self.links[rel]
+        return None
+
+
+class Chunk(object):
+    """
+    Deployment chunk (software module).
+
+    Attributes:
+        metadata(dict): metadata key/value pairs, values of the integer keys
+                        given to parse_deployment() are already converted
+    """
+    __slots__ = ('part', 'name', 'version', 'metadata', 'artifacts')
+
+    def __init__(self, part, name, version, metadata, artifacts):
+        self.part = part
+        self.name = name
+        self.version = version
+        self.metadata = metadata
+        self.artifacts = artifacts
+
+    @property
+    def size(self):
+        """Total size of the artifacts of the chunk."""
+        return sum(artifact.size for artifact in self.artifacts)
+
+
+class Deployment(object):
+    """
+    Parsed deploymentBase resource
+    (/{tenant}/controller/v1/{targetid}/deploymentBase/{actionId}).
+
+    Attributes:
+        action_id(str): id of the action
+        download(str): download handling type ('skip', 'attempt', 'forced')
+        update(str): update handling type ('skip', 'attempt', 'forced')
+        maintenance_window(str): 'available', 'unavailable' or None when the
+                                 action has no maintenance window
+        chunks(list): chunks of the deployment
+    """
+    __slots__ = ('action_id', 'download', 'update', 'maintenance_window',
+                 'chunks')
+
+    def __init__(self, action_id, download, update, maintenance_window,
+                 chunks):
+        self.action_id = action_id
+        self.download = download
+        self.update = update
+        self.maintenance_window = maintenance_window
+        self.chunks = chunks
+
+
+def parse_base(doc):
+    """
+    Parse the base poll resource.
+
+    Args:
+        doc(dict): JSON document returned by the server
+
+    Returns:
+        BaseResource
+    """
+    sleep = _get(doc, 'config', 'polling', 'sleep')
+    links = doc.get('_links', {})
+    base = BaseResource(sleep, config_data='configData' in links)
+
+    if 'deploymentBase' in links:
+        href = _get(links, 'deploymentBase', 'href')
+        match = re.search(r'/deploymentBase/([^?]+)(?:\?c=(.+))?$', href)
+        if match is None:
+            raise DocumentParseError('Bad deploymentBase link {}'.format(href))
+        base.deployment_action, base.deployment_resource = match.groups()
+
+    if 'cancelAction' in links:
+        href = _get(links, 'cancelAction', 'href')
+        match = re.search('/cancelAction/(.+)$', href)
+        if match is None:
+            raise DocumentParseError('Bad cancelAction link {}'.format(href))
+        base.cancel_action, = match.groups()
+
+    return base
+
+
+def parse_deployment(doc, int_metadata=()):
+    """
+    Parse a deploymentBase resource.
+
+    Args:
+        doc(dict): JSON document returned by the server
+    Keyword Args:
+        int_metadata: metadata keys whose values must be integers, they are
+                      converted here so that a bad value fails the whole
+                      deployment before anything is installed
+
+    Returns:
+        Deployment
+    """
+    action_id = str(_get(doc, 'id'))
+    deployment = _get(doc, 'deployment')
+    chunks = []
+
+    for index, chunk in enumerate(_get(deployment, 'chunks')):
+        metadata = {}
+        for meta in chunk.get('metadata', ()):
+            key = _get(meta, 'key')
+            value = meta.get('value')
+            if key in int_metadata:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise DocumentParseError(
+                        'Chunk {} has a non integer {} metadata: {!r}'.format(
+                            chunk.get('name', index), key, value))
+            metadata[key] = value
+
+        artifacts = []
+        for artifact in chunk.get('artifacts', ()):
+            artifacts.append(Artifact(
+                _get(artifact, 'filename'),
+                artifact.get('size', 0),
+                artifact.get('hashes', {}),
+                {rel: link['href'] for rel, link in
+                 artifact.get('_links', {}).items() if 'href' in link}))
+
+        chunks.append(Chunk(_get(chunk, 'part'), _get(chunk, 'name'),
+                            _get(chunk, 'version'), metadata, artifacts))
+
+    return Deployment(action_id, deployment.get('download', 'forced'),
+                      deployment.get('update', 'forced'),
+                      deployment.get('maintenanceWindow'), chunks)
+
+
+def parse_cancel(doc):
+    """
+    Parse a cancelAction resource.
+
+    Returns:
+        stop id of the action to cancel
+    """
+    return str(_get(doc, 'cancelAction', 'stopId'))
+
+
+class DeploymentCache(object):
+    """
+    Parsed deployments indexed by action id and resource hash: as long as
+    HawkBit announces the same action with the same resource hash, the
+    deployment is neither downloaded nor parsed again.
+
+    Keyword Args:
+        size(int): number of deployments kept
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.deployments = OrderedDict()
+
+    def get(self, action_id, resource):
+        key = (action_id, resource)
+        if resource is None or key not in self.deployments:
+            return None
+        self.deployments.move_to_end(key)
+        return self.deployments[key]
+
+    def put(self, action_id, resource, deployment):
+        if resource is None:
+            return
+        self.deployments[(action_id, resource)] = deployment
+        while len(self.deployments) > self.size:
+            self.deployments.popitem(last=False)
+
+    async def fetch(self, ddi, action_id, resource, int_metadata=()):
+        """
+        Returns the parsed deployment, downloading it only when it is not
+        cached yet.
+
+        Args:
+            ddi(DDIClient): client used to download the deployment
+            action_id(str): id of the action
+            resource(str): resource hash from the deploymentBase link
+        Keyword Args:
+            int_metadata: see parse_deployment()
+        """
+        deployment = self.get(action_id, resource)
+        if deployment is None:
+            doc = await ddi.deploymentBase[action_id](resource)
+            deployment = parse_deployment(doc, int_metadata)
+            self.put(action_id, resource, deployment)
+        return deployment
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import aiohttp
+import logging
+import ssl
+
+
+class TransportProfile(object):
+    """
+    Connection settings of the HTTP transport used by DDIClient.
+
+    Control-plane requests (polling, feedback, configData) and bulk artifact
+    downloads use separate connection pools so that a long download never
+    delays a poll or a feedback.
+
+    Keyword Args:
+        limit(int): maximum number of simultaneous connections per pool
+        limit_per_host(int): maximum number of connections to the same host
+                             in the control pool
+        keepalive_timeout(float): seconds an idle control connection is kept
+                                  open for reuse
+        dns_cache_ttl(int): seconds a DNS resolution is cached
+                            (None caches forever)
+        bulk_limit_per_host(int): maximum number of connections to the same
+                                  host in the bulk pool
+        bulk_keepalive_timeout(float): seconds an idle bulk connection is kept
+                                       open for reuse
+        ssl_verify(bool): verify the server certificate
+        ca_file(str): CA bundle used to verify the server certificate
+    """
+
+    def __init__(self, limit=10, limit_per_host=4, keepalive_timeout=75,
+                 dns_cache_ttl=300, bulk_limit_per_host=2,
+                 bulk_keepalive_timeout=15, ssl_verify=True, ca_file=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.bulk_limit_per_host = bulk_limit_per_host
+        self.bulk_keepalive_timeout = bulk_keepalive_timeout
+        self.ssl_verify = ssl_verify
+        self.ca_file = ca_file
+
+    @classmethod
+    def from_config(cls, config, section='client'):
+        """
+        Build a profile from the ``http_*`` options of a config section.
+
+        Args:
+            config(ConfigParser): parsed configuration file
+            section(str): section holding the options
+        """
+        return cls(
+            limit=config.getint(section, 'http_limit', fallback=10),
+            limit_per_host=config.getint(section, 'http_limit_per_host',
+                                         fallback=4),
+            keepalive_timeout=config.getfloat(
+                section, 'http_keepalive_timeout', fallback=75),
+            dns_cache_ttl=config.getint(section, 'http_dns_cache_ttl',
+                                        fallback=300),
+            bulk_limit_per_host=config.getint(
+                section, 'http_bulk_limit_per_host', fallback=2),
+            bulk_keepalive_timeout=config.getfloat(
+                section, 'http_bulk_keepalive_timeout', fallback=15),
+            ssl_verify=config.getboolean(section, 'http_ssl_verify',
+                                         fallback=True),
+            ca_file=config.get(section, 'http_ca_file', fallback=None))
+
+
+class TransportStats(object):
+    """Connection reuse counters of a connection pool."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    @property
+    def reuse_ratio(self):
+        """Share of the connections which were reused from the pool."""
+        total = self.connections_created + self.connections_reused
+        return self.connections_reused / total if total else 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': round(self.reuse_ratio, 3),
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses,
+        }
+
+    def trace_config(self):
+        """Returns an aiohttp TraceConfig updating these counters."""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.connections_reused += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace
+
+
+class HTTPTransport(object):
+    """
+    Shared HTTP transport: one aiohttp session for control-plane JSON
+    requests and one for bulk artifact downloads, both using a single TLS
+    context.
+
+    TLS sessions are not resumed across connections by the asyncio SSL
+    layer, so handshakes are saved by keeping connections alive and reusing
+    them instead.
+
+    Use as an async context manager::
+
+        async with HTTPTransport(profile) as transport:
+            ddi = DDIClient(transport.session, ...,
+                            bulk_session=transport.bulk_session)
+
+    Args:
+        profile(TransportProfile): connection settings
+    Keyword Args:
+        trace_configs: additional aiohttp TraceConfig added to both sessions
+    """
+
+    def __init__(self, profile=None, trace_configs=()):
+        self.logger = logging.getLogger('rauc_hawkbit')
+        self.profile = profile or TransportProfile()
+        self.trace_configs = list(trace_configs)
+        self.ssl_context = None
+        self.session = None
+        self.bulk_session = None
+        self.stats = {'control': TransportStats(), 'bulk': TransportStats()}
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def open(self):
+        """Create the TLS context and both sessions."""
+        if self.profile.ssl_verify:
+            self.ssl_context = ssl.create_default_context(
+                cafile=self.profile.ca_file)
+        else:
+            self.ssl_context = False
+
+        self.session = self.new_session(
+            'control', self.profile.limit_per_host,
+            self.profile.keepalive_timeout)
+        self.bulk_session = self.new_session(
+            'bulk', self.profile.bulk_limit_per_host,
+            self.profile.bulk_keepalive_timeout)
+
+    def new_session(self, pool, limit_per_host, keepalive_timeout):
+        connector = aiohttp.TCPConnector(
+            limit=self.profile.limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.profile.dns_cache_ttl,
+            ssl=self.ssl_context)
+        return aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[self.stats[pool].trace_config()] +
+            self.trace_configs)
+
+    async def close(self):
+        """Close both sessions and log the connection reuse statistics."""
+        for pool, session in (('control', self.session),
+                              ('bulk', self.bulk_session)):
+            if session is not None:
+                self.logger.info('HTTP {} pool: {}'.format(
+                    pool, self.stats[pool].as_dict()))
+                await session.close()
+        self.session = None
+        self.bulk_session = None
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import random
+
+from datetime import datetime
+
+# HTTP status codes telling the client that the server is overloaded
+THROTTLING_STATUSES = (429, 503)
+
+
+class PollScheduler(object):
+    """
+    Computes the delay before the next poll of the DDI base resource.
+
+    On success, the polling interval suggested by HawkBit is spread by a
+    bounded random jitter so that a fleet does not stay synchronized. On
+    error, the delay grows exponentially with the number of consecutive
+    failures and is drawn uniformly below that ceiling ("full jitter"), so
+    devices coming back after an outage do not hammer the server in
+    lockstep. A ``Retry-After`` given by the server is always honored.
+
+    The sleep between two polls can be interrupted with trigger(), so that a
+    single device can check for updates on demand, unless the server asked
+    the device to back off (429/503).
+
+    :param float jitter: Relative spread applied to the server interval (0.1 means +/- 10%).
+    :param float backoff_base: Ceiling of the first retry delay, in seconds.
+    :param float backoff_max: Maximum ceiling of the retry delay, in seconds.
+    """
+
+    def __init__(self, jitter=0.1, backoff_base=10, backoff_max=3600, rng=None):
+        assert 0 <= jitter < 1, 'jitter must be in [0, 1)'
+        assert 0 < backoff_base <= backoff_max, \
+            'backoff_base must be positive and lower than backoff_max'
+
+        self.logger = logging.getLogger('rauc_hawkbit')
+        self.jitter = jitter
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self.throttled = False
+        self.random = rng or random.Random()
+        self.wakeup = asyncio.Event()
+
+    @staticmethod
+    def parse_sleep(sleep_str):
+        """
+        Convert the 'HH:MM:SS' polling interval sent by HawkBit in seconds.
+
+        :param string sleep_str: Polling interval from the base resource.
+        :returns: Interval in seconds.
+        """
+        t = datetime.strptime(sleep_str, '%H:%M:%S')
+        return t.hour * 3600 + t.minute * 60 + t.second
+
+    def on_success(self, sleep_str):
+        """
+        Reset the error backoff and return the delay before the next poll.
+
+        :param string sleep_str: Polling interval from the base resource.
+        :returns: Delay in seconds.
+        """
+        self.failures = 0
+        self.throttled = False
+        interval = self.parse_sleep(sleep_str)
+        spread = interval * self.jitter
+        return max(0, interval + self.random.uniform(-spread, spread))
+
+    def on_error(self, error=None):
+        """
+        Register a failed poll and return the delay before the next retry.
+
+        :param Exception error: Error raised by the poll, its ``status`` and ``retry_after``
+            attributes are used when present (see APIError).
+        :returns: Delay in seconds.
+        """
+        self.failures += 1
+        ceiling = min(self.backoff_max,
+                      self.backoff_base * 2 ** min(self.failures - 1, 32))
+
+        status = getattr(error, 'status', None)
+        retry_after = getattr(error, 'retry_after', None)
+        self.throttled = retry_after is not None or status in THROTTLING_STATUSES
+
+        if retry_after is not None:
+            # the server told us when to come back, spread the fleet after it
+            delay = retry_after + self.random.uniform(0, retry_after * self.jitter)
+        elif status in THROTTLING_STATUSES:
+            # server overloaded: never retry earlier than half the ceiling
+            delay = self.random.uniform(ceiling / 2, ceiling)
+        else:
+            delay = self.random.uniform(0, ceiling)
+
+        self.logger.debug('Poll failure #{} (status {}), backoff ceiling {}s'.format(
+            self.failures, status, ceiling))
+        return delay
+
+    def trigger(self):
+        """
+        Request an immediate poll: interrupts the current wait(), or makes the
+        next one return at once if no wait is in progress.
+        """
+        self.logger.info('Immediate poll requested')
+        self.wakeup.set()
+
+    async def wait(self, delay):
+        """
+        Sleep until the next poll.
+
+        :param float delay: Delay in seconds, as returned by on_success() or on_error().
+        :returns: True if the sleep was interrupted by trigger(), False otherwise.
+        """
+        if self.throttled:
+            # the server asked us to back off, do not let local triggers bypass it, nor cut the next wait short
+            await asyncio.sleep(delay)
+            self.wakeup.clear()
+            return False
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            return False
+        self.wakeup.clear()
+        return True
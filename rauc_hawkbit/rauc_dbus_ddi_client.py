@@ -3,13 +3,13 @@
 import asyncio
 from aiohttp.client_exceptions import ClientOSError, ClientResponseError
 from gi.repository import GLib
-from datetime import datetime, timedelta
 import os
 import os.path
 import re
 import logging
 
 from .dbus_client import AsyncDBUSClient
+from .poll_scheduler import PollScheduler
 from .ddi.client import DDIClient, APIError
 from .ddi.client import (
     ConfigStatusExecution, ConfigStatusResult)
@@ -17,6 +17,8 @@ from .ddi.deployment_base import (
     DeploymentStatusExecution, DeploymentStatusResult)
 from .ddi.cancel_action import (
     CancelStatusExecution, CancelStatusResult)
+from .ddi.model import (
+    DeploymentCache, DocumentParseError, parse_base, parse_cancel)
 
 
 class RaucDBUSDDIClient(AsyncDBUSClient):
@@ -25,14 +27,18 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
     interface.
     """
     def __init__(self, session, host, ssl, tenant_id, target_name, auth_token,
-                 attributes, bundle_dl_location, result_callback, step_callback=None, lock_keeper=None):
+                 attributes, bundle_dl_location, result_callback, step_callback=None, lock_keeper=None,
+                 poll_scheduler=None, bulk_session=None):
         super(RaucDBUSDDIClient, self).__init__()
 
         self.attributes = attributes
 
         self.logger = logging.getLogger('rauc_hawkbit')
-        self.ddi = DDIClient(session, host, ssl, auth_token, tenant_id, target_name)
+        self.ddi = DDIClient(session, host, ssl, auth_token, tenant_id,
+                             target_name, bulk_session=bulk_session)
         self.action_id = None
+        self.scheduler = poll_scheduler or PollScheduler()
+        self.deployments = DeploymentCache()
 
         bundle_dir = os.path.dirname(bundle_dl_location)
         assert os.path.isdir(bundle_dir), 'Bundle directory must exist'
@@ -127,25 +133,30 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
         await self.ddi.deploymentBase[self.action_id].feedback(
                 status_execution, status_result, [last_error])
 
-    async def start_polling(self, wait_on_error=60):
+    async def start_polling(self):
         """Wrapper around self.poll_base_resource() for exception handling."""
         while True:
+            error = None
             try:
                 await self.poll_base_resource()
             except asyncio.CancelledError:
                 self.logger.info('Polling cancelled')
                 break
-            except asyncio.TimeoutError:
+            except asyncio.TimeoutError as e:
                 self.logger.warning('Polling failed due to TimeoutError')
+                error = e
             except (APIError, TimeoutError, ClientOSError, ClientResponseError) as e:
                 # log error and start all over again
                 self.logger.warning('Polling failed with a temporary error: {}'.format(e))
-            except:
+                error = e
+            except Exception as e:
                 self.logger.exception('Polling failed with an unexpected exception:')
+                error = e
             self.action_id = None
-            self.logger.info('Retry will happen in {} seconds'.format(
+            wait_on_error = self.scheduler.on_error(error)
+            self.logger.info('Retry will happen in {:.0f} seconds'.format(
                 wait_on_error))
-            await asyncio.sleep(wait_on_error)
+            await self.scheduler.wait(wait_on_error)
 
     async def identify(self, base):
         """Identify target against HawkBit."""
@@ -157,13 +168,8 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
 
     async def cancel(self, base):
         self.logger.info('Received cancelation request')
-        # retrieve action id from URL
-        deployment = base['_links']['cancelAction']['href']
-        match = re.search('/cancelAction/(.+)$', deployment)
-        action_id, = match.groups()
         # retrieve stop_id
-        stop_info = await self.ddi.cancelAction[action_id]()
-        stop_id = stop_info['cancelAction']['stopId']
+        stop_id = parse_cancel(await self.ddi.cancelAction[base.cancel_action]())
         # Reject cancel request
         self.logger.info('Rejecting cancelation request')
         await self.ddi.cancelAction[stop_id].feedback(
@@ -185,15 +191,21 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
             self.logger.info('Deployment is already in progress')
             return
 
-        # retrieve action id and resource parameter from URL
-        deployment = base['_links']['deploymentBase']['href']
-        match = re.search('/deploymentBase/(.+)\?c=(.+)$', deployment)
-        action_id, resource = match.groups()
+        action_id = base.deployment_action
         self.logger.info('Deployment found for this target')
         # fetch deployment information
-        deploy_info = await self.ddi.deploymentBase[action_id](resource)
         try:
-            chunk = deploy_info['deployment']['chunks'][0]
+            deployment = await self.deployments.fetch(
+                self.ddi, action_id, base.deployment_resource)
+        except DocumentParseError as e:
+            # send negative feedback to HawkBit
+            await self.ddi.deploymentBase[action_id].feedback(
+                    DeploymentStatusExecution.closed,
+                    DeploymentStatusResult.failure,
+                    ['Malformed deployment: {}'.format(e)])
+            raise
+        try:
+            chunk = deployment.chunks[0]
         except IndexError:
             # send negative feedback to HawkBit
             status_execution = DeploymentStatusExecution.closed
@@ -204,7 +216,7 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
             raise APIError(msg)
 
         try:
-            artifact = chunk['artifacts'][0]
+            artifact = chunk.artifacts[0]
         except IndexError:
             # send negative feedback to HawkBit
             status_execution = DeploymentStatusExecution.closed
@@ -215,14 +227,10 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
             raise APIError(msg)
 
         # prefer https ('download') over http ('download-http')
-        # HawkBit provides either only https, only http or both
-        if 'download' in artifact['_links']:
-            download_url = artifact['_links']['download']['href']
-        else:
-            download_url = artifact['_links']['download-http']['href']
+        download_url = artifact.download_url
 
         # download artifact, check md5 and report feedback
-        md5_hash = artifact['hashes']['md5']
+        md5_hash = artifact.hashes.get('md5')
         self.logger.info('Starting bundle download')
         await self.download_artifact(action_id, download_url, md5_hash)
 
@@ -280,24 +288,24 @@ class RaucDBUSDDIClient(AsyncDBUSClient):
         raise APIError(status_msg)
 
     async def sleep(self, base):
-        """Sleep time suggested by HawkBit."""
-        sleep_str = base['config']['polling']['sleep']
-        self.logger.info('Will sleep for {}'.format(sleep_str))
-        t = datetime.strptime(sleep_str, '%H:%M:%S')
-        delta = timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
-        await asyncio.sleep(delta.total_seconds())
+        """Sleep time suggested by HawkBit, spread by the poll scheduler."""
+        sleep_str = base.sleep
+        delay = self.scheduler.on_success(sleep_str)
+        self.logger.info('Will sleep for {:.0f} seconds (suggested {})'.format(
+            delay, sleep_str))
+        if await self.scheduler.wait(delay):
+            self.logger.info('Woken up before the end of the polling interval')
 
     async def poll_base_resource(self):
         """Poll DDI API base resource."""
         while True:
-            base = await self.ddi()
-
-            if '_links' in base:
-                if 'configData' in base['_links']:
-                    await self.identify(base)
-                if 'deploymentBase' in base['_links']:
-                    await self.process_deployment(base)
-                if 'cancelAction' in base['_links']:
-                    await self.cancel(base)
+            base = parse_base(await self.ddi())
+
+            if base.config_data:
+                await self.identify(base)
+            if base.deployment_action is not None:
+                await self.process_deployment(base)
+            if base.cancel_action is not None:
+                await self.cancel(base)
 
             await self.sleep(base)
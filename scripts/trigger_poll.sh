@@ -0,0 +1,10 @@
+#!/bin/sh
+
+# Ask FullMetalUpdate to poll the HawkBit server right away.
+# An optional controller id restricts the poll to a single target.
+
+SOCKET_PATH="/tmp/fullmetalupdate/fullmetalupdate_trigger.sock"
+
+test -e ${SOCKET_PATH} || { echo "FullMetalUpdate is not running"; exit 1; }
+
+echo "poll $1" | socat - UNIX-CONNECT:${SOCKET_PATH}
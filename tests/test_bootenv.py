@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from fullmetalupdate.bootenv import BootEnv, BootEnvError, FileEnv, parse_env
+
+
+class MemoryEnv(BootEnv):
+    """ Environment kept in memory, recording the writes. """
+
+    def __init__(self, values=None, fail=False):
+        super(MemoryEnv, self).__init__()
+        self.stored = dict(values or {})
+        self.writes = []
+        self.loads = 0
+        self.fail = fail
+
+    def load(self):
+        self.loads += 1
+        return dict(self.stored)
+
+    def store(self, changes):
+        if self.fail:
+            raise BootEnvError("write failed")
+        self.writes.append(changes)
+        for name, value in changes.items():
+            if value is None:
+                self.stored.pop(name, None)
+            else:
+                self.stored[name] = value
+
+
+def test_parse_env():
+    assert parse_env("success=1\nbootcmd=run a=b\nnoise\n") == {'success': '1', 'bootcmd': 'run a=b'}
+
+
+def test_set_outside_transaction_commits():
+    env = MemoryEnv()
+    env.set('success', 1)
+    assert env.writes == [{'success': '1'}]
+    assert env.get('success') == '1'
+
+
+def test_transaction_groups_writes():
+    env = MemoryEnv({'init_var': '1'})
+    with env.transaction():
+        env.set('success', '1')
+        env.unset('init_var')
+        assert env.writes == []
+        assert env.get('init_var') is None
+    assert env.writes == [{'success': '1', 'init_var': None}]
+    assert env.stored == {'success': '1'}
+
+
+def test_nested_transactions_write_once():
+    env = MemoryEnv()
+    with env.transaction():
+        with env.transaction():
+            env.set('a', '1')
+        assert env.writes == []
+        env.set('b', '2')
+    assert env.writes == [{'a': '1', 'b': '2'}]
+
+
+def test_transaction_dropped_when_block_raises():
+    env = MemoryEnv({'success': '0'})
+    with pytest.raises(RuntimeError):
+        with env.transaction():
+            env.set('success', '1')
+            raise RuntimeError()
+    assert env.writes == []
+    assert env.get('success') == '0'
+
+
+def test_noop_writes_dropped():
+    env = MemoryEnv({'success': '1'})
+    env.set('success', '1')
+    env.unset('missing')
+    assert env.writes == []
+    assert env.commit() is False
+
+
+def test_failed_store_reloads_cache():
+    env = MemoryEnv({'success': '0'})
+    assert env.get('success') == '0'
+    env.fail = True
+    with pytest.raises(BootEnvError):
+        env.set('success', '1')
+    assert env.loads == 1
+    env.stored['success'] = '2'
+    assert env.get('success') == '2'
+    assert env.loads == 2
+
+
+def test_new_line_refused():
+    env = MemoryEnv()
+    with pytest.raises(BootEnvError):
+        env.set('bootcmd', 'a\nb')
+
+
+def test_file_env(tmp_path):
+    path = tmp_path / 'uboot.env'
+    env = FileEnv(str(path))
+    assert env.get('success') is None
+    with env.transaction():
+        env.set('success', '1')
+        env.set('init_var', '1')
+    assert path.read_text() == 'init_var=1\nsuccess=1\n'
+    env.unset('init_var')
+    assert FileEnv(str(path)).get('init_var') is None
+    assert FileEnv(str(path)).get('success') == '1'
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from fullmetalupdate.journal import STEP_PULLED, STEP_STARTED, STEP_VERDICT, DeploymentJournal
+
+
+def test_record_survives_restart(tmp_path):
+    journal = DeploymentJournal(7, str(tmp_path))
+    journal.record('app', 'rev1', STEP_PULLED)
+    journal.record('app', 'rev1', STEP_VERDICT, [True, 'started'])
+    journal = DeploymentJournal(7, str(tmp_path))
+    assert journal.done('app', 'rev1', STEP_PULLED)
+    assert journal.get('app', 'rev1', STEP_VERDICT) == [True, 'started']
+    assert not journal.done('app', 'rev1', STEP_STARTED)
+    assert not journal.done('other', 'rev1', STEP_PULLED)
+
+
+def test_revision_change_resets_chunk(tmp_path):
+    journal = DeploymentJournal(7, str(tmp_path))
+    journal.record('app', 'rev1', STEP_PULLED)
+    journal.record('app', 'rev1', STEP_STARTED)
+    assert not journal.done('app', 'rev2', STEP_PULLED)
+    journal.record('app', 'rev2', STEP_PULLED)
+    assert journal.chunks['app'] == {'rev': 'rev2', 'steps': {STEP_PULLED: True}}
+
+
+def test_other_actions_discarded(tmp_path):
+    DeploymentJournal(6, str(tmp_path)).record('app', 'rev1', STEP_PULLED)
+    DeploymentJournal(7, str(tmp_path))
+    assert [p.name for p in tmp_path.iterdir()] == []
+
+
+def test_unreadable_journal_starts_over(tmp_path):
+    (tmp_path / '7.json').write_text('{')
+    journal = DeploymentJournal(7, str(tmp_path))
+    assert journal.chunks == {}
+    journal.record('app', 'rev1', STEP_PULLED)
+    assert json.loads((tmp_path / '7.json').read_text()) == {'app': {'rev': 'rev1', 'steps': {STEP_PULLED: True}}}
+
+
+def test_close_removes_journal_and_ignores_records(tmp_path):
+    journal = DeploymentJournal(7, str(tmp_path))
+    journal.record('app', 'rev1', STEP_PULLED)
+    journal.close()
+    assert not (tmp_path / '7.json').exists()
+    journal.record('app', 'rev1', STEP_STARTED)
+    assert not (tmp_path / '7.json').exists()
+    assert not journal.done('app', 'rev1', STEP_STARTED)
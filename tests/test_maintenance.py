@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pytest
+
+from fullmetalupdate.maintenance import MaintenanceWindow, parse_time
+
+
+def at(hour, minute=0):
+    return datetime.datetime(2020, 1, 1, hour, minute)
+
+
+def test_parse_time():
+    assert parse_time('00:00') == 0
+    assert parse_time(' 13:30 ') == 13 * 60 + 30
+
+
+@pytest.mark.parametrize('text', ['13', '24:00', '12:60', 'ab:cd', ''])
+def test_parse_time_malformed(text):
+    with pytest.raises(ValueError):
+        parse_time(text)
+
+
+def test_malformed_window():
+    with pytest.raises(ValueError):
+        MaintenanceWindow('01:00')
+    with pytest.raises(ValueError):
+        MaintenanceWindow('01:00-25:00')
+
+
+def test_window_open():
+    window = MaintenanceWindow('01:00-03:00,13:00-13:30')
+    assert window.is_open(at(1))
+    assert window.is_open(at(13, 15))
+    assert not window.is_open(at(3))
+    assert str(window) == '01:00-03:00,13:00-13:30'
+
+
+def test_seconds_until_next_range():
+    window = MaintenanceWindow('01:00-03:00,13:00-13:30')
+    assert window.seconds_until_open(at(12)) == 3600
+    assert window.seconds_until_open(at(14)) == 11 * 3600
+
+
+def test_window_spanning_midnight():
+    window = MaintenanceWindow('22:00-04:00')
+    assert window.is_open(at(23))
+    assert window.is_open(at(3, 59))
+    assert window.seconds_until_open(at(4)) == 18 * 3600
+
+
+def test_whole_day_window():
+    assert MaintenanceWindow('00:00-00:00').is_open(at(12))
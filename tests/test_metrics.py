@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from fullmetalupdate import metrics
+from fullmetalupdate.metrics import CONTENT_TYPE, MetricsServer, Registry, timed
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    registry.histogram('fmu_phase_duration_seconds', 'Duration of the update phases.', buckets=(1, 10))
+    registry.counter('fmu_phase_failures_total', 'Number of failed update phases.')
+    return registry
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    registry.counter('requests_total', 'Requests.')
+    registry.gauge('temperature', 'Temperature.')
+    registry.inc('requests_total', method='GET')
+    registry.inc('requests_total', 2, method='GET')
+    registry.set('temperature', 21.5)
+    assert registry.render() == (
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{method="GET"} 3\n'
+        '# HELP temperature Temperature.\n'
+        '# TYPE temperature gauge\n'
+        'temperature 21.5\n')
+
+
+def test_labels_sorted_and_escaped():
+    registry = Registry()
+    registry.gauge('info', 'Info.')
+    registry.set('info', 1, path='C:\\apps', title='say "hi"')
+    assert 'info{path="C:\\\\apps",title="say \\"hi\\""} 1\n' in registry.render()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    for value in (0.5, 5, 50):
+        registry.observe('fmu_phase_duration_seconds', value, phase='pull')
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'fmu_phase_duration_seconds_bucket{le="1.0",phase="pull"} 1',
+        'fmu_phase_duration_seconds_bucket{le="10.0",phase="pull"} 2',
+        'fmu_phase_duration_seconds_bucket{le="+Inf",phase="pull"} 3',
+        'fmu_phase_duration_seconds_count{phase="pull"} 3',
+        'fmu_phase_duration_seconds_sum{phase="pull"} 55.5',
+        '# HELP fmu_phase_failures_total Number of failed update phases.',
+        '# TYPE fmu_phase_failures_total counter',
+    ]
+
+
+def test_same_metric_registered_once():
+    registry = Registry()
+    assert registry.counter('a_total', 'A.') is registry.counter('a_total', 'A.')
+
+
+def test_collectors_run_before_rendering():
+    registry = Registry()
+    registry.gauge('pool', 'Pool.')
+    registry.add_collector(lambda r: r.set('pool', 4))
+    assert 'pool 4\n' in registry.render()
+
+
+def test_timed_records_failures(registry, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS', registry)
+
+    @timed('checkout')
+    def checkout(fail):
+        if fail:
+            raise OSError()
+        return 'done'
+
+    assert checkout(False) == 'done'
+    with pytest.raises(OSError):
+        checkout(True)
+    assert registry.metrics['fmu_phase_duration_seconds'].values[(('phase', 'checkout'),)][1] == 2
+    assert registry.metrics['fmu_phase_failures_total'].values == {(('phase', 'checkout'),): 1}
+
+
+def test_server_content_type(registry):
+    server = MetricsServer('unix:unused', registry)
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(server.handle_metrics(None))
+    finally:
+        loop.close()
+    assert response.headers['Content-Type'] == CONTENT_TYPE == 'text/plain; version=0.0.4; charset=utf-8'
+    assert response.body == registry.render().encode('utf-8')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from fullmetalupdate import mirrors
+from fullmetalupdate.mirrors import (EWMA_WEIGHT, FAILURE_COOLDOWN, FAILURE_COOLDOWN_MAX, PROBE_TIMEOUT,
+                                     REFERENCE_BYTES, Mirror, MirrorSet)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class ProbedMirrorSet(MirrorSet):
+    """ Mirrors whose probes measure the given latencies instead of downloading. """
+
+    def __init__(self, latencies, **kwargs):
+        super(ProbedMirrorSet, self).__init__(list(latencies), **kwargs)
+        self.latencies = latencies
+        self.probes = []
+
+    def probe(self, mirror):
+        self.probes.append(mirror.url)
+        mirror.latency = Mirror.average(mirror.latency, self.latencies[mirror.url])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mirrors.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def test_average():
+    assert Mirror.average(None, 2.0) == 2.0
+    assert Mirror.average(1.0, 2.0) == pytest.approx(1 + EWMA_WEIGHT)
+
+
+def test_score():
+    mirror = Mirror('http://a/')
+    assert mirror.url == 'http://a'
+    assert mirror.score == PROBE_TIMEOUT
+    mirror.latency = 0.1
+    mirror.throughput = REFERENCE_BYTES
+    assert mirror.score == pytest.approx(1.1)
+
+
+def test_no_mirror_selects_origin():
+    assert MirrorSet(()).select() is None
+    assert not MirrorSet(())
+
+
+def test_lowest_latency_selected(clock):
+    mirror_set = ProbedMirrorSet({'http://far': 0.5, 'http://near': 0.05})
+    assert mirror_set.select() == 'http://near'
+
+
+def test_throughput_outweighs_latency(clock):
+    mirror_set = ProbedMirrorSet({'http://slow': 0.01, 'http://fast': 0.1})
+    mirror_set.select()
+    mirror_set.record('http://slow', REFERENCE_BYTES, 1.0)
+    mirror_set.record('http://fast', 10 * REFERENCE_BYTES, 1.0)
+    assert mirror_set.select() == 'http://fast'
+
+
+def test_small_pulls_not_measured(clock):
+    mirror_set = ProbedMirrorSet({'http://a': 0.1})
+    mirror_set.select()
+    mirror_set.record('http://a', REFERENCE_BYTES - 1, 0.001)
+    assert mirror_set.mirrors['http://a'].throughput is None
+
+
+def test_probes_once_per_interval(clock):
+    mirror_set = ProbedMirrorSet({'http://a': 0.1}, probe_interval=60)
+    mirror_set.select()
+    mirror_set.select()
+    clock.now += 60
+    mirror_set.select()
+    assert mirror_set.probes == ['http://a', 'http://a']
+
+
+def test_failure_cooldown(clock):
+    mirror_set = ProbedMirrorSet({'http://a': 0.01, 'http://b': 0.1})
+    assert mirror_set.select() == 'http://a'
+    mirror_set.failed('http://a')
+    assert mirror_set.select() == 'http://b'
+    clock.now += FAILURE_COOLDOWN
+    assert mirror_set.select() == 'http://a'
+    mirror_set.failed('http://a')
+    clock.now += FAILURE_COOLDOWN
+    assert mirror_set.select() == 'http://b'
+    clock.now += FAILURE_COOLDOWN
+    assert mirror_set.select() == 'http://a'
+
+
+def test_cooldown_capped(clock):
+    mirror_set = ProbedMirrorSet({'http://a': 0.01})
+    mirror_set.select()
+    for _ in range(20):
+        mirror_set.failed('http://a')
+    assert mirror_set.mirrors['http://a'].down_until == clock.now + FAILURE_COOLDOWN_MAX
+    mirror_set.record('http://a', 0, 0)
+    assert mirror_set.mirrors['http://a'].failures == 0
+
+
+def test_every_mirror_down_selects_origin(clock):
+    mirror_set = ProbedMirrorSet({'http://a': 0.01})
+    mirror_set.select()
+    mirror_set.failed('http://a')
+    assert mirror_set.select() is None
+
+
+def test_mirrorlist(tmp_path, clock):
+    mirrorlist = tmp_path / 'mirrorlist'
+    mirrorlist.write_text('# regional caches\nhttp://a/\n\n  http://b\n')
+    mirror_set = MirrorSet(['mirrorlist=' + mirrorlist.as_uri(), 'http://c'])
+    mirror_set.probe = lambda mirror: None
+    mirror_set.refresh()
+    assert sorted(mirror_set.mirrors) == ['http://a', 'http://b', 'http://c']
+
+
+def test_unreachable_mirrorlist(tmp_path):
+    assert MirrorSet(()).fetch_mirrorlist((tmp_path / 'missing').as_uri()) == []
+
+
+def test_probe_measures_latency(tmp_path):
+    (tmp_path / 'config').write_text('[core]\n')
+    mirror_set = MirrorSet([tmp_path.as_uri()])
+    mirror_set.refresh()
+    assert mirror_set.mirrors[tmp_path.as_uri()].latency is not None
+
+
+def test_failed_probe_disables_mirror(tmp_path, clock):
+    url = (tmp_path / 'missing').as_uri()
+    mirror_set = MirrorSet([url])
+    mirror_set.refresh()
+    assert mirror_set.mirrors[url].down_until == clock.now + FAILURE_COOLDOWN
+    assert mirror_set.select() is None
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from rauc_hawkbit.ddi.model import DeploymentCache, DocumentParseError, parse_base, parse_cancel, parse_deployment
+
+
+BASE = 'https://hawkbit/DEFAULT/controller/v1/target'
+
+
+def deployment_doc(action_id=7, metadata=()):
+    return {
+        'id': action_id,
+        'deployment': {
+            'download': 'attempt',
+            'update': 'forced',
+            'maintenanceWindow': 'available',
+            'chunks': [{
+                'part': 'os',
+                'name': 'os',
+                'version': '1.0',
+                'metadata': list(metadata),
+                'artifacts': [
+                    {'filename': 'a', 'size': 10, '_links': {'download-http': {'href': 'http://a'}}},
+                    {'filename': 'b', 'size': 5,
+                     '_links': {'download': {'href': 'https://b'}, 'download-http': {'href': 'http://b'}}},
+                ],
+            }],
+        },
+    }
+
+
+class FakeDDI(object):
+    """ Serves deploymentBase documents, counting the downloads. """
+
+    def __init__(self):
+        self.downloads = 0
+        self.deploymentBase = self
+
+    def __getitem__(self, action_id):
+        async def get(resource):
+            self.downloads += 1
+            return deployment_doc(action_id)
+        return get
+
+
+def test_parse_base():
+    base = parse_base({
+        'config': {'polling': {'sleep': '00:05:00'}},
+        '_links': {
+            'configData': {'href': BASE + '/configData'},
+            'deploymentBase': {'href': BASE + '/deploymentBase/7?c=-2129030598'},
+        },
+    })
+    assert base.sleep == '00:05:00'
+    assert base.config_data
+    assert (base.deployment_action, base.deployment_resource) == ('7', '-2129030598')
+    assert base.cancel_action is None
+
+
+def test_parse_base_cancel():
+    base = parse_base({
+        'config': {'polling': {'sleep': '00:01:00'}},
+        '_links': {'cancelAction': {'href': BASE + '/cancelAction/8'}},
+    })
+    assert not base.config_data
+    assert base.deployment_action is None
+    assert base.cancel_action == '8'
+
+
+def test_parse_base_malformed():
+    with pytest.raises(DocumentParseError):
+        parse_base({'config': {}})
+    with pytest.raises(DocumentParseError):
+        parse_base({'config': {'polling': {'sleep': '00:01:00'}},
+                    '_links': {'cancelAction': {'href': BASE + '/other'}}})
+
+
+def test_parse_deployment():
+    deployment = parse_deployment(deployment_doc(metadata=[{'key': 'rev', 'value': 'abc'}]))
+    assert deployment.action_id == '7'
+    assert (deployment.download, deployment.update) == ('attempt', 'forced')
+    assert deployment.maintenance_window == 'available'
+    chunk, = deployment.chunks
+    assert (chunk.part, chunk.name, chunk.version, chunk.size) == ('os', 'os', '1.0', 15)
+    assert chunk.metadata == {'rev': 'abc'}
+    assert [a.download_url for a in chunk.artifacts] == ['http://a', 'https://b']
+
+
+def test_parse_deployment_int_metadata():
+    doc = deployment_doc(metadata=[{'key': 'autostart', 'value': '1'}])
+    assert parse_deployment(doc, ('autostart',)).chunks[0].metadata == {'autostart': 1}
+    doc = deployment_doc(metadata=[{'key': 'autostart', 'value': 'yes'}])
+    with pytest.raises(DocumentParseError):
+        parse_deployment(doc, ('autostart',))
+
+
+def test_parse_deployment_missing_field():
+    doc = deployment_doc()
+    del doc['deployment']['chunks'][0]['version']
+    with pytest.raises(DocumentParseError):
+        parse_deployment(doc)
+
+
+def test_parse_cancel():
+    assert parse_cancel({'id': '8', 'cancelAction': {'stopId': 7}}) == '7'
+    with pytest.raises(DocumentParseError):
+        parse_cancel({'id': '8'})
+
+
+def test_cache_evicts_least_recently_used():
+    cache = DeploymentCache(size=2)
+    cache.put('1', 'a', 'one')
+    cache.put('2', 'b', 'two')
+    assert cache.get('1', 'a') == 'one'
+    cache.put('3', 'c', 'three')
+    assert cache.get('2', 'b') is None
+    assert cache.get('1', 'a') == 'one'
+    assert cache.get('1', 'other') is None
+
+
+def test_cache_ignores_missing_resource():
+    cache = DeploymentCache()
+    cache.put('1', None, 'one')
+    assert cache.get('1', None) is None
+
+
+def test_cache_fetch_downloads_once():
+    ddi = FakeDDI()
+    cache = DeploymentCache()
+    loop = asyncio.new_event_loop()
+    try:
+        first = loop.run_until_complete(cache.fetch(ddi, '7', 'a'))
+        second = loop.run_until_complete(cache.fetch(ddi, '7', 'a'))
+        loop.run_until_complete(cache.fetch(ddi, '7', 'b'))
+    finally:
+        loop.close()
+    assert first is second
+    assert ddi.downloads == 2
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from rauc_hawkbit.ddi.model import Artifact, Chunk
+
+from fullmetalupdate.ordering import order_chunks, order_restarts
+
+
+def chunk(name, part='bApp', size=0, priority=None):
+    metadata = {} if priority is None else {'priority': priority}
+    return Chunk(part, name, '1.0', metadata, [Artifact(name, size, {}, {})])
+
+
+def names(chunks):
+    return [c.name for c in chunks]
+
+
+def test_os_first():
+    assert names(order_chunks([chunk('app'), chunk('os', part='os', size=100)])) == ['os', 'app']
+
+
+def test_priority_then_size():
+    chunks = [chunk('big', size=100), chunk('small', size=10), chunk('critical', size=500, priority=10)]
+    assert names(order_chunks(chunks)) == ['critical', 'small', 'big']
+
+
+def test_hawkbit_order_breaks_ties():
+    assert names(order_chunks([chunk('b'), chunk('a'), chunk('c')])) == ['b', 'a', 'c']
+
+
+def test_order_chunks_returns_new_list():
+    chunks = [chunk('big', size=100), chunk('small', size=10)]
+    order_chunks(chunks)
+    assert names(chunks) == ['big', 'small']
+
+
+def test_restarts_follow_dependencies():
+    dependencies = {'web': ['db', 'cache'], 'cache': ['db']}
+    assert order_restarts(['web', 'cache', 'db'], dependencies) == ['db', 'cache', 'web']
+
+
+def test_restarts_ignore_unknown_and_self_dependencies():
+    assert order_restarts(['a', 'b'], {'a': ['network', 'a']}) == ['a', 'b']
+
+
+def test_restarts_keep_cycles_at_the_end():
+    dependencies = {'a': ['b'], 'b': ['a']}
+    assert order_restarts(['a', 'b', 'c'], dependencies) == ['c', 'a', 'b']
+
+
+def test_planned_transfer_size_first():
+    chunks = [chunk('cached', size=10), chunk('fresh', size=500), chunk('unplanned', size=50)]
+    assert names(order_chunks(chunks, {'cached': 1000, 'fresh': 0})) == ['fresh', 'unplanned', 'cached']
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from fullmetalupdate import plan
+from fullmetalupdate.plan import OBJECT_TYPE_FILE, UpdatePlan, parse_sizes, read_varint
+
+
+class FakeRepo(object):
+
+    def __init__(self, checksums=()):
+        self.checksums = set(checksums)
+
+    def has_object(self, objtype, checksum, cancellable):
+        return (True, checksum in self.checksums)
+
+
+def checksum(n):
+    return bytes([n]) * 32
+
+
+def test_read_varint():
+    assert read_varint(b'\x05', 0) == (5, 1)
+    assert read_varint(b'\x00\xac\x02', 1) == (300, 3)
+
+
+def test_read_varint_truncated():
+    with pytest.raises(ValueError):
+        read_varint(b'\x80', 0)
+
+
+def test_parse_sizes():
+    objects = parse_sizes([(checksum(1), b'\xac\x02\x05'), (checksum(2), b'\x01\x02\x03')])
+    assert objects == [(checksum(1).hex(), OBJECT_TYPE_FILE, 300, 5), (checksum(2).hex(), 3, 1, 2)]
+
+
+def test_parse_sizes_malformed():
+    with pytest.raises(ValueError):
+        parse_sizes([(b'\x01' * 20, b'\x01\x02')])
+    with pytest.raises(ValueError):
+        parse_sizes([(checksum(1), b'\x01')])
+
+
+@pytest.fixture
+def disks(monkeypatch):
+    """ /apps and /ostree on separate filesystems of 1000 free bytes each. """
+    monkeypatch.setattr(plan, 'free_space', lambda path: (path, 1000))
+
+
+def test_plan_counts_missing_objects(disks):
+    update = UpdatePlan(margin=0)
+    objects = [('a', OBJECT_TYPE_FILE, 10, 100), ('b', OBJECT_TYPE_FILE, 20, 200)]
+    update.add('app', FakeRepo(['a']), '/apps', objects)
+    assert update.chunks == [{'name': 'app', 'known': True, 'objects': 2, 'missing': 1, 'download': 20,
+                              'disk': 200}]
+    assert update.fits()
+
+
+def test_plan_counts_shared_objects_once(disks):
+    update = UpdatePlan(margin=0)
+    update.add('app1', FakeRepo(), '/apps', [('a', OBJECT_TYPE_FILE, 10, 600)])
+    update.add('app2', FakeRepo(), '/apps', [('a', OBJECT_TYPE_FILE, 10, 600)])
+    assert update.chunks[1]['missing'] == 0
+    assert update.fits()
+
+
+def test_plan_shortage(disks):
+    update = UpdatePlan(margin=100)
+    update.add('app', FakeRepo(), '/apps', [('a', OBJECT_TYPE_FILE, 10, 950)])
+    update.add('os', FakeRepo(), '/ostree', [('b', OBJECT_TYPE_FILE, 10, 500)])
+    assert update.shortages() == [(['/apps'], 950, 1000)]
+    assert not update.fits()
+    assert update.summary()[-1].startswith('Plan: /apps needs')
+
+
+def test_plan_shares_filesystems(monkeypatch):
+    monkeypatch.setattr(plan, 'free_space', lambda path: ('root', 1000))
+    update = UpdatePlan(margin=0)
+    update.add('app', FakeRepo(), '/apps', [('a', OBJECT_TYPE_FILE, 10, 600)])
+    update.add('os', FakeRepo(), '/ostree', [('b', OBJECT_TYPE_FILE, 10, 600)])
+    assert update.shortages() == [(['/apps', '/ostree'], 1200, 1000)]
+
+
+def test_plan_unknown_sizes(disks):
+    update = UpdatePlan()
+    update.add('app', FakeRepo(), '/apps', None)
+    assert update.fits()
+    assert update.summary() == ['Plan app: size unknown']
+
+
+def test_plan_download_sizes(disks):
+    update = UpdatePlan()
+    update.add('app', FakeRepo(['a']), '/apps', [('a', OBJECT_TYPE_FILE, 10, 100), ('b', OBJECT_TYPE_FILE, 20, 200)])
+    update.add('other', FakeRepo(), '/apps', None)
+    assert update.download_sizes() == {'app': 20}
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+
+import pytest
+
+from rauc_hawkbit.poll_scheduler import PollScheduler
+
+
+class Error(Exception):
+
+    def __init__(self, status=None, retry_after=None):
+        super(Error, self).__init__()
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Ceiling(random.Random):
+    """ Always draws the upper bound. """
+
+    def uniform(self, a, b):
+        return b
+
+
+def test_parse_sleep():
+    assert PollScheduler.parse_sleep('01:02:03') == 3723
+
+
+def test_success_jitter_is_bounded():
+    scheduler = PollScheduler(jitter=0.1, rng=random.Random(0))
+    for _ in range(100):
+        assert 270 <= scheduler.on_success('00:05:00') <= 330
+
+
+def test_backoff_grows_up_to_max():
+    scheduler = PollScheduler(backoff_base=10, backoff_max=60, rng=Ceiling())
+    assert [scheduler.on_error() for _ in range(5)] == [10, 20, 40, 60, 60]
+
+
+def test_success_resets_backoff():
+    scheduler = PollScheduler(backoff_base=10, rng=Ceiling())
+    scheduler.on_error()
+    scheduler.on_error()
+    scheduler.on_success('00:01:00')
+    assert scheduler.on_error() == 10
+
+
+def test_retry_after_is_honored():
+    scheduler = PollScheduler(jitter=0.1, rng=random.Random(0))
+    delay = scheduler.on_error(Error(status=429, retry_after=120))
+    assert 120 <= delay <= 132
+    assert scheduler.throttled
+
+
+def test_throttling_status_waits_half_the_ceiling():
+    scheduler = PollScheduler(backoff_base=100, rng=random.Random(0))
+    for _ in range(20):
+        scheduler.failures = 0
+        assert 50 <= scheduler.on_error(Error(status=503)) <= 100
+
+
+def test_invalid_parameters():
+    with pytest.raises(AssertionError):
+        PollScheduler(jitter=1)
+    with pytest.raises(AssertionError):
+        PollScheduler(backoff_base=10, backoff_max=5)
+
+
+def test_trigger_interrupts_wait():
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        scheduler = PollScheduler()
+        loop.call_later(0.01, scheduler.trigger)
+        assert loop.run_until_complete(scheduler.wait(10)) is True
+        assert loop.run_until_complete(scheduler.wait(0.01)) is False
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_trigger_ignored_when_throttled():
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        scheduler = PollScheduler()
+        scheduler.on_error(Error(status=429))
+        scheduler.trigger()
+        assert loop.run_until_complete(scheduler.wait(0.01)) is False
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_trigger_while_throttled_dropped():
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        scheduler = PollScheduler()
+        scheduler.on_error(Error(status=429))
+        loop.call_later(0.01, scheduler.trigger)
+        assert loop.run_until_complete(scheduler.wait(0.05)) is False
+        scheduler.on_success('00:01:00')
+        assert loop.run_until_complete(scheduler.wait(0.01)) is False
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from fullmetalupdate.bootenv import FileEnv
+from fullmetalupdate.reboot import Rebooter, find_kernel
+
+
+class Deployment(object):
+
+    def __init__(self, bootcsum):
+        self.bootcsum = bootcsum
+
+    def get_bootcsum(self):
+        return self.bootcsum
+
+
+class Systemd(object):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.started = []
+
+    def StartUnit(self, unit, mode):
+        if self.fail:
+            raise RuntimeError("start failed")
+        self.started.append(unit)
+
+
+class CountingEnv(FileEnv):
+
+    def __init__(self, path):
+        super(CountingEnv, self).__init__(path)
+        self.stores = 0
+
+    def store(self, changes):
+        self.stores += 1
+        super(CountingEnv, self).store(changes)
+
+
+class Updater(object):
+
+    def __init__(self, bootenv, systemd):
+        self.bootenv = bootenv
+        self.systemd = systemd
+
+
+@pytest.mark.parametrize('strategy, staged, booted, expected', [
+    ('soft', 'a', 'a', ['soft', 'kexec', 'full']),
+    ('soft', 'b', 'a', ['kexec', 'full']),
+    ('kexec', 'a', 'a', ['kexec', 'full']),
+    ('full', 'a', 'a', ['full']),
+])
+def test_strategies(strategy, staged, booted, expected):
+    rebooter = Rebooter(None, strategy)
+    assert rebooter.strategies(Deployment(staged), Deployment(booted)) == expected
+
+
+def test_strategies_without_deployments():
+    rebooter = Rebooter(None, 'soft')
+    assert rebooter.strategies(None, Deployment('a')) == ['full']
+    assert rebooter.strategies(Deployment('a'), None) == ['full']
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        Rebooter(None, 'fast')
+
+
+def test_find_kernel(tmp_path):
+    modules = tmp_path / 'usr/lib/modules/5.10'
+    modules.mkdir(parents=True)
+    (modules / 'vmlinuz').write_text('')
+    assert find_kernel(str(tmp_path), 'abc') == (str(modules / 'vmlinuz'), None)
+
+
+def test_find_kernel_legacy_layout(tmp_path):
+    boot = tmp_path / 'usr/lib/ostree-boot'
+    boot.mkdir(parents=True)
+    (boot / 'vmlinuz-abc').write_text('')
+    (boot / 'initramfs-abc.img').write_text('')
+    assert find_kernel(str(tmp_path), 'abc') == (str(boot / 'vmlinuz-abc'), str(boot / 'initramfs-abc.img'))
+    with pytest.raises(FileNotFoundError):
+        find_kernel(str(tmp_path), 'def')
+
+
+def test_boot_unit_arms_trial(tmp_path):
+    path = tmp_path / 'uboot.env'
+    path.write_text('success=1\n')
+    updater = Updater(CountingEnv(str(path)), Systemd())
+    Rebooter(updater, 'soft').boot_unit('soft-reboot.target')
+    assert path.read_text() == 'init_var=1\nsuccess=0\n'
+    assert updater.bootenv.stores == 1
+    assert updater.systemd.started == ['soft-reboot.target']
+
+
+def test_boot_unit_failure_disarms_trial(tmp_path):
+    path = tmp_path / 'uboot.env'
+    path.write_text('success=1\n')
+    updater = Updater(CountingEnv(str(path)), Systemd(fail=True))
+    with pytest.raises(RuntimeError):
+        Rebooter(updater, 'soft').boot_unit('soft-reboot.target')
+    assert path.read_text() == 'success=1\n'
+    assert updater.bootenv.stores == 2
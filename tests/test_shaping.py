@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+
+import pytest
+
+from fullmetalupdate import shaping
+from fullmetalupdate.shaping import BandwidthProfile, TokenBucket, parse_ionice
+
+
+class Clock(object):
+    """ Monotonic clock advanced by hand, asyncio.sleep() recording the delays instead of waiting. """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shaping.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(shaping.asyncio, 'sleep', clock.sleep)
+    return clock
+
+
+def consume(bucket, size):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(bucket.consume(size))
+    finally:
+        loop.close()
+
+
+def at(hour):
+    return datetime.datetime(2020, 1, 1, hour)
+
+
+def test_parse_ionice():
+    assert parse_ionice('idle') == 3 << 13
+    assert parse_ionice('best-effort') == (2 << 13) | 4
+    assert parse_ionice('realtime:0') == 1 << 13
+
+
+@pytest.mark.parametrize('ionice', ['low', 'best-effort:8', 'best-effort:a', 'realtime:'])
+def test_parse_ionice_malformed(ionice):
+    with pytest.raises(ValueError):
+        parse_ionice(ionice)
+
+
+def test_profile_first_match_applies():
+    profile = BandwidthProfile('08:00-18:00=256, *=2048')
+    assert profile.rate(at(12)) == 256 * 1024
+    assert profile.rate(at(20)) == 2048 * 1024
+    assert str(profile) == '08:00-18:00=256, *=2048'
+
+
+def test_profile_unmatched_is_unlimited():
+    assert BandwidthProfile('08:00-18:00=256').rate(at(20)) == 0
+
+
+@pytest.mark.parametrize('spec', ['256', '08:00-18:00=fast', '08:00=256'])
+def test_profile_malformed(spec):
+    with pytest.raises(ValueError):
+        BandwidthProfile(spec)
+
+
+def test_bucket_burst_then_debt(clock):
+    bucket = TokenBucket(BandwidthProfile('*=1'), burst=1024)
+    consume(bucket, 1024)
+    assert clock.sleeps == []
+    consume(bucket, 512)
+    assert clock.sleeps == [0.5]
+
+
+def test_bucket_refills(clock):
+    bucket = TokenBucket(BandwidthProfile('*=1'), burst=1024)
+    consume(bucket, 1024)
+    clock.now += 10
+    consume(bucket, 1024)
+    assert clock.sleeps == []
+
+
+def test_bucket_unlimited(clock):
+    bucket = TokenBucket(BandwidthProfile('*=0'), burst=1024)
+    consume(bucket, 10 * 1024)
+    assert clock.sleeps == []
+    assert bucket.tokens == 1024
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+import pytest
+
+from fullmetalupdate.tracing import Span, Tracer, traced
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    return Tracer(str(tmp_path / 'traces.json'))
+
+
+def names(span):
+    return [child.name for child in span.children]
+
+
+def test_spans_nest_in_a_thread(tracer):
+    root = tracer.start_trace('deployment', action_id=1)
+    with tracer.span('update_container', container='app') as outer:
+        with tracer.span('pull'):
+            tracer.annotate(rev='abc')
+    assert names(root) == ['update_container']
+    assert names(outer) == ['pull']
+    assert outer.children[0].attributes == {'rev': 'abc'}
+    assert tracer.current() is root
+
+
+def test_other_threads_attach_to_root(tracer):
+    root = tracer.start_trace('deployment')
+
+    def verdict():
+        with tracer.span('notify_verdict'):
+            pass
+
+    with tracer.span('update_container'):
+        thread = Thread(target=verdict)
+        thread.start()
+        thread.join()
+    assert names(root) == ['update_container', 'notify_verdict']
+
+
+def test_explicit_parent(tracer):
+    tracer.start_trace('deployment')
+    with tracer.span('update_container') as parent:
+        pass
+    with tracer.span('notify_verdict', parent=parent):
+        pass
+    assert names(parent) == ['notify_verdict']
+
+
+def test_wrap_across_executor(tracer):
+    root = tracer.start_trace('deployment')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with tracer.span('update_container') as parent:
+            def step():
+                with tracer.span('checkout'):
+                    return tracer.current().name
+            assert executor.submit(tracer.wrap(step)).result() == 'checkout'
+        # the worker thread is left without the span once the call returns
+        assert executor.submit(tracer.current).result() is root
+    assert names(parent) == ['checkout']
+
+
+def test_error_recorded(tracer):
+    tracer.start_trace('deployment')
+    with pytest.raises(OSError):
+        with tracer.span('pull') as span:
+            raise OSError('stalled')
+    assert span.attributes == {'error': 'stalled'}
+    assert span.end is not None
+
+
+def test_traced_decorator(tracer):
+    class Updater(object):
+        def __init__(self):
+            self.tracer = tracer
+
+        @traced('checkout')
+        def checkout(self):
+            return tracer.current().name
+
+    root = tracer.start_trace('deployment')
+    assert Updater().checkout() == 'checkout'
+    assert names(root) == ['checkout']
+
+
+def test_summary():
+    root = Span('deployment')
+    root.start, root.end = 0, 12
+    update = Span('update_container', container='app')
+    update.start, update.end = 0, 10
+    pull = Span('pull')
+    pull.start, pull.end = 0, 7.5
+    update.add_child(pull)
+    reboot = Span('reboot')
+    reboot.start, reboot.end = 10, 12
+    root.add_child(update)
+    root.add_child(reboot)
+    assert Tracer.summary(root) == ['Timeline: deployment took 12.0s',
+                                    ' - update_container app 10.0s (pull 7.5s)',
+                                    ' - reboot 2.0s']
+    assert Tracer.summary(None) == []
+
+
+def test_finish_trace_writes_json(tracer, tmp_path):
+    assert tracer.finish_trace() is None
+    tracer.start_trace('deployment', action_id=3)
+    with tracer.span('pull'):
+        pass
+    root = tracer.finish_trace()
+    assert tracer.root is None
+    trace = json.loads((tmp_path / 'traces.json').read_text())
+    assert trace['name'] == 'deployment'
+    assert trace['attributes'] == {'action_id': 3}
+    assert trace['end'] == round(root.end, 3)
+    assert [child['name'] for child in trace['children']] == ['pull']
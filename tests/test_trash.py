@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import time
+
+import pytest
+
+from fullmetalupdate.trash import TrashReaper
+
+
+def make_tree(path, files=10):
+    os.makedirs(os.path.join(path, 'sub', 'deeper'))
+    for i in range(files):
+        with open(os.path.join(path, 'sub', 'file{}'.format(i)), 'w') as f:
+            f.write('x')
+    os.symlink('sub', os.path.join(path, 'link'))
+    os.symlink('/nonexistent', os.path.join(path, 'dangling'))
+
+
+def wait_empty(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while os.listdir(path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not os.listdir(path)
+
+
+@pytest.fixture
+def trash(tmp_path):
+    return str(tmp_path / 'trash')
+
+
+def test_move_then_reap(tmp_path, trash):
+    reaper = TrashReaper(trash, batch=3, pause=0)
+    app = str(tmp_path / 'app')
+    make_tree(app)
+    reaper.move(app)
+    assert not os.path.exists(app)
+    assert wait_empty(trash)
+
+
+def test_reap_by_batches(tmp_path, trash, monkeypatch):
+    reaper = TrashReaper(trash, batch=4, pause=0.5)
+    pauses = []
+    monkeypatch.setattr('fullmetalupdate.trash.time.sleep', pauses.append)
+    path = str(tmp_path / 'app')
+    make_tree(path, files=10)
+    reaper.reap(path)
+    assert not os.path.lexists(path)
+    assert pauses and set(pauses) == {0.5}
+
+
+def test_leftovers_reaped_at_start(trash):
+    make_tree(os.path.join(trash, 'app-1234'))
+    TrashReaper(trash, pause=0)
+    assert wait_empty(trash)
+
+
+def test_move_while_reaping(tmp_path, trash):
+    make_tree(os.path.join(trash, 'old-1234'), files=50)
+    reaper = TrashReaper(trash, batch=5, pause=0.01)
+    app = str(tmp_path / 'app')
+    make_tree(app)
+    reaper.move(app)
+    assert wait_empty(trash)
+
+
+def test_entry_already_gone(tmp_path, trash):
+    reaper = TrashReaper(trash, pause=0)
+    reaper.reap(str(tmp_path / 'missing'))
+
+
+def test_trash_removed(tmp_path, trash):
+    reaper = TrashReaper(trash, pause=0)
+    shutil.rmtree(trash)
+    reaper.wakeup.set()
+    app = str(tmp_path / 'app')
+    make_tree(app)
+    reaper.move(app)
+    assert wait_empty(trash)
+    assert reaper.thread.is_alive()
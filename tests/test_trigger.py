@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+
+from fullmetalupdate.trigger import TriggerServer
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.triggers = 0
+
+    def trigger(self):
+        self.triggers += 1
+
+
+def test_poll_every_target():
+    schedulers = {'a': Scheduler(), 'b': Scheduler()}
+    assert TriggerServer('unused', schedulers).handle_request('poll\n') == 'ok'
+    assert [s.triggers for s in schedulers.values()] == [1, 1]
+
+
+def test_poll_one_target():
+    schedulers = {'a': Scheduler(), 'b': Scheduler()}
+    assert TriggerServer('unused', schedulers).handle_request('poll b') == 'ok'
+    assert (schedulers['a'].triggers, schedulers['b'].triggers) == (0, 1)
+
+
+def test_unknown_target():
+    schedulers = {'a': Scheduler()}
+    assert TriggerServer('unused', schedulers).handle_request('poll c') == 'error: unknown target c'
+    assert schedulers['a'].triggers == 0
+
+
+def test_unknown_request():
+    server = TriggerServer('unused', {'a': Scheduler()})
+    for line in ('', 'reboot', 'poll a b'):
+        assert server.handle_request(line) == 'error: unknown request'
+
+
+def test_socket(tmp_path):
+    path = str(tmp_path / 'trigger.sock')
+    schedulers = {'a': Scheduler()}
+    server = TriggerServer(path, schedulers)
+
+    async def request(line):
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(line)
+        answer = await reader.readline()
+        writer.close()
+        return answer
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        assert loop.run_until_complete(request(b'poll a\n')) == b'ok\n'
+        assert loop.run_until_complete(request(b'poll z\n')) == b'error: unknown target z\n'
+        server.close()
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert schedulers['a'].triggers == 1
+    assert not os.path.exists(path)